@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+"""
+Measures the startup time of export_pipeline_trace.
+
+Each scenario runs in a fresh interpreter several times. The median time is reported after
+subtracting the median startup time of a bare interpreter. The scenarios are:
+
+  import:   Importing the module, i.e. everything before the first GitLab API call.
+  console:  Importing the module and building a tracer for the 'console' endpoint.
+  grpc:     Importing the module and building a tracer for a GRPC endpoint.
+
+The modules loaded by each scenario are checked for the OpenTelemetry SDK and GRPC.
+
+Usage, with trace_utils installed in the environment or from this directory:
+
+PYTHONPATH=../src ./startup-benchmark.py --runs 20
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+SCENARIOS = {
+    "import": "import trace_utils.export_pipeline_trace as m",
+    "console": (
+        "import trace_utils.export_pipeline_trace as m\n"
+        "from opentelemetry.sdk.trace import TracerProvider\n"
+        "TracerProvider().add_span_processor(m._span_processor('console'))"
+    ),
+    "grpc": (
+        "import trace_utils.export_pipeline_trace as m\n"
+        "from opentelemetry.sdk.trace import TracerProvider\n"
+        "TracerProvider().add_span_processor(m._span_processor('http://localhost:4518'))"
+    ),
+}
+# Prints which of the heavy modules a scenario loaded.
+LOADED = "\nimport sys\nprint(','.join(m for m in ('opentelemetry.sdk', 'grpc') if m in sys.modules) or '-')"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Measure the startup time of export_pipeline_trace.")
+    parser.add_argument("--runs", type=int, default=10, help="Runs per scenario. Default is 10.")
+    parser.add_argument(
+        "--scenario", action="append", choices=list(SCENARIOS), help="A scenario to run. Default is all scenarios."
+    )
+    args = parser.parse_args()
+
+    bare = median_seconds("pass", args.runs)[0]
+    print(f"{'scenario':<10} {'median ms':>10}  loaded")
+    for name in args.scenario or SCENARIOS:
+        seconds, loaded = median_seconds(SCENARIOS[name] + LOADED, args.runs)
+        print(f"{name:<10} {(seconds - bare) * 1000:>10.0f}  {loaded}")
+
+    return 0
+
+
+def median_seconds(code: str, runs: int) -> tuple:
+    """Run code in fresh interpreters.
+
+    Returns:
+        tuple: The median wall time in seconds and the output of the last run.
+    """
+    times = []
+    output = ""
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+        times.append(time.perf_counter() - start)
+        output = result.stdout.strip()
+    return statistics.median(times), output
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -16,12 +16,18 @@ setup(
         "python-dateutil",
         "python-gitlab",
     ],
+    extras_require={
+        # Concurrent GitLab API requests with asyncio, see async_gitlab.py. A thread pool is used without it.
+        "async": ["httpx"],
+    },
     package_dir={"trace_utils": "src/trace_utils"},
     include_package_data=True,
     entry_points={
         "console_scripts": [
+            "critical_path = trace_utils.critical_path:main",
             "export_pipeline_trace = trace_utils.export_pipeline_trace:main",
             "find_pipelines = trace_utils.find_pipelines:main",
+            "runner_utilization = trace_utils.runner_utilization:main",
         ]
     },
 )
@@ -0,0 +1,167 @@
+"""
+Concurrent reads from the GitLab API with asyncio.
+
+python-gitlab waits for each response before sending the next request. The exporter and the
+finder read in bulk through AsyncGitlab instead when given a concurrency, so that up to that many
+requests are in flight from one thread, e.g. the pipelines, jobs, bridges and downstream pipelines
+of a batch of exports, or the pages of a search.
+
+The requests are sent with httpx when it is installed (pip install trace_utils[async]). Otherwise
+they are sent from a thread pool through the HTTP session of gitlab_common. Only that session uses
+the HTTP cache and self-tracing of GitLab API requests. The pool has at most POOL_MAXSIZE threads,
+the connections the session keeps open, so that no connection is dropped and opened again.
+
+The JSON of the responses is returned as is. The callers wrap it in python-gitlab objects, e.g.
+ProjectPipeline(project.pipelines, attrs), and use these like objects retrieved by python-gitlab.
+
+
+# # # Usage: Python API
+
+from trace_utils.async_gitlab import AsyncGitlab
+
+async def pipelines(async_gitlab, project_id, pipeline_ids):
+    return await asyncio.gather(*(async_gitlab.get(f"/projects/{project_id}/pipelines/{i}") for i in pipeline_ids))
+
+async_gitlab = AsyncGitlab(gl_client, concurrency=32)
+pipelines = async_gitlab.run(pipelines, async_gitlab, 7, [23221, 23222])
+"""
+
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from trace_utils.gitlab_common import PAGINATION_COUNT, POOL_MAXSIZE, http_session
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# Failures to send a request or to receive its response, e.g. a dropped connection or a timeout.
+NETWORK_ERRORS = (requests.RequestException,) + ((httpx.TransportError,) if httpx else ())
+DEFAULT_CONCURRENCY = 32
+# Seconds to wait for a response when the client has no timeout.
+DEFAULT_TIMEOUT = 60.0
+
+
+class AsyncGitlab:
+    """Sends GET requests to the API of a python-gitlab client concurrently, up to a limit."""
+
+    def __init__(self, gl_client, concurrency: int = DEFAULT_CONCURRENCY) -> None:
+        """
+        Args:
+            gl_client (gitlab.Gitlab): The client providing the URL and the access token.
+            concurrency (int, optional): The most requests in flight at the same time. Defaults to DEFAULT_CONCURRENCY.
+        """
+        self.api_url = gl_client.api_url
+        self.headers = {"PRIVATE-TOKEN": gl_client.private_token or ""}
+        self.timeout = gl_client.timeout or DEFAULT_TIMEOUT
+        self.concurrency = concurrency
+        # Set up by run() for the event loop of the run.
+        self._semaphore = None
+        self._client = None
+        self._executor = None
+
+    def run(self, coroutine_function, *args, **kwargs) -> any:
+        """Run a coroutine function sending requests with this object and return its result.
+
+        Args:
+            coroutine_function: An 'async def' function, called with args and kwargs.
+            *args: The positional arguments of the function.
+            **kwargs (dict): The keyword arguments of the function.
+        """
+        return asyncio.run(self._run(coroutine_function(*args, **kwargs)))
+
+    async def get(self, path: str, **params) -> any:
+        """The JSON of the response to a GET request.
+
+        Args:
+            path (str): The path of the request below the API URL, e.g. /projects/7/pipelines/23221.
+            **params (dict): Query parameters.
+
+        Raises:
+            RuntimeError: The request failed, or no response was received.
+        """
+        body, _ = await self._get(self.api_url + path, params)
+        return body
+
+    async def list(self, path: str, **params) -> list:
+        """All items of a list, following the pages of the response one after the other.
+
+        Args:
+            path (str): The path of the request below the API URL, e.g. /projects/7/pipelines/23221/jobs.
+            **params (dict): Query parameters.
+
+        Raises:
+            RuntimeError: A request failed.
+        """
+        params.setdefault("per_page", PAGINATION_COUNT)
+        items, next_url = await self._get(self.api_url + path, params)
+        while next_url:
+            page, next_url = await self._get(next_url, None)
+            items.extend(page)
+        return items
+
+    async def pages(self, path: str, first_page: int, count: int, **params) -> list:
+        """Several pages of a list at the same time, by page number.
+
+        Args:
+            path (str): The path of the request below the API URL, e.g. /projects/7/pipelines.
+            first_page (int): The number of the first page, starting at 1.
+            count (int): The number of pages.
+            **params (dict): Query parameters.
+
+        Raises:
+            RuntimeError: A request failed.
+
+        Returns:
+            list: The items of each page, in page order. Pages past the end of the list are empty.
+        """
+        params.setdefault("per_page", PAGINATION_COUNT)
+        pages = [self.get(path, page=page, **params) for page in range(first_page, first_page + count)]
+        return await asyncio.gather(*pages)
+
+    async def _run(self, coroutine) -> any:
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        try:
+            if httpx:
+                limits = httpx.Limits(max_connections=self.concurrency)
+                async with httpx.AsyncClient(headers=self.headers, timeout=self.timeout, limits=limits) as client:
+                    self._client = client
+                    return await coroutine
+            # More threads than pooled connections would drop and reopen connections.
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, POOL_MAXSIZE)) as executor:
+                self._executor = executor
+                return await coroutine
+        finally:
+            self._semaphore = self._client = self._executor = None
+
+    async def _get(self, url: str, params: dict) -> tuple:
+        """The JSON of a response and the URL of its next page, or None."""
+        async with self._semaphore:
+            try:
+                if self._client:
+                    response = await self._client.get(url, params=params)
+                    ok, text = response.is_success, response.text
+                else:
+                    loop = asyncio.get_running_loop()
+                    # The request runs in the context of the caller, e.g. under its self-tracing span.
+                    blocking_get = functools.partial(contextvars.copy_context().run, self._blocking_get, url, params)
+                    response = await loop.run_in_executor(self._executor, blocking_get)
+                    ok, text = response.ok, response.text
+            except NETWORK_ERRORS as e:
+                raise RuntimeError(f"GET {url} failed: {type(e).__name__}: {e}") from e
+        if not ok:
+            raise RuntimeError(f"GET {url} failed: {response.status_code} {text[:200]}")
+        next_link = response.links.get("next")
+        try:
+            body = response.json()
+        except ValueError as e:
+            raise RuntimeError(f"GET {url} returned no JSON: {e}") from e
+        return body, next_link["url"] if next_link else None
+
+    def _blocking_get(self, url: str, params: dict) -> any:
+        return http_session().get(url, params=params, headers=self.headers, timeout=self.timeout)
@@ -9,44 +9,234 @@ for the production instance of Grafana.
 
 Important: If you  run this script multiple times with using the same
 group, project, and time setting, the data will be duplicated in Grafana.
-While not harmful, per se, visualizations will be inaccurate.
+While not harmful, per se, visualizations will be inaccurate. Pass --checkpoint
+to resume an interrupted backfill without exporting pipelines twice.
 
 Though this script is only meant to be executed in rare circumstances
 using production endpoints, the script has been left here
 as an illustration the usage of trace_utils classes.
+
+The pipelines in the date range are found first. They are then split into windows of
+--window-hours by creation date, and the windows are exported by a pool of --processes
+processes, each with its own PipelineExporter. Building and serializing spans holds the GIL,
+so processes rather than threads keep every core busy on long backfills. The exported and
+failed pipeline IDs of the windows are merged into the checkpoint file as they complete.
+The checkpoint does not depend on the windows, so a rerun with other dates or window hours
+skips the pipelines already exported.
+
+./backfill-pipeline-traces.py --start-date 2024-06-03T00:00:00Z --end-date 2024-06-04T23:59:59Z --checkpoint backfill.json
 """
 
+import argparse
+import json
+import os
 import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import timedelta
 
 from dateutil.parser import parse
 
 from trace_utils.base_logger import get_logger
 from trace_utils.find_pipelines import PipelineFinder
 from trace_utils.export_pipeline_trace import PipelineExporter
+from trace_utils.gitlab_common import get_gitlab_token
 
 # Export trace data to the terminal where the script is run.
 DEFAULT_GRPC_ENDPOINT = "console"
 # A developer running the otel-demo stack locally.
 # DEFAULT_GRPC_ENDPOINT = "http://localhost:4518"
 GITLAB_URL = "https://gitlab.mydomain.com"
+DEFAULT_WINDOW_HOURS = 24.0
 
 log = get_logger(__name__)
 
+# The PipelineExporter of a worker process, created by _init_worker().
+_exporter = None
 
-def main() -> int:
-    finder = PipelineFinder("robot", "ApplicationRepo")
-    exporter = PipelineExporter("robot", "ApplicationRepo")
 
-    start_date = parse("2024-06-03T00:00:00.000Z")
-    end_date = parse("2024-06-04T23:59:59.999Z")
-    pipelines = finder.pipelines_by_date(start_date, end_date)
-    # pipelines => [[22382, '2024-06-01T01:03:08.100Z'], [22383, '2024-06-01T01:03:08.192Z'], ...]
+def main() -> int:
+    args = parse_args()
+    gitlab_token = get_gitlab_token()
+
+    finder = PipelineFinder(args.group, args.project, gitlab_token, concurrency=args.concurrency)
+    pipelines = finder.pipelines_by_date(args.start_date, args.end_date)
+    # pipelines => [(22382, datetime(2024, 6, 1, 1, 3, 8, 100000)), (22383, ...), ...]
+    windows = split_windows(pipelines, args.start_date, timedelta(hours=args.window_hours))
+
+    checkpoint = load_checkpoint(args.checkpoint)
+    pending = {}
+    for window, pipeline_ids in windows.items():
+        remaining = [pipeline_id for pipeline_id in pipeline_ids if pipeline_id not in checkpoint["exported"]]
+        if remaining:
+            pending[window] = remaining
+    log.info(
+        f"Exporting {sum(len(ids) for ids in pending.values())} of {len(pipelines)} pipelines "
+        f"in {len(pending)} windows with {args.processes} processes."
+    )
+
+    failed = set()
+    # Each worker process opens connections of its own, see gitlab_common._reset_after_fork().
+    worker_args = (args.group, args.project, gitlab_token, args.concurrency, args.downstream_depth)
+    with ProcessPoolExecutor(args.processes, initializer=_init_worker, initargs=worker_args) as executor:
+        futures = {
+            executor.submit(export_window, pipeline_ids, args.endpoint): window
+            for window, pipeline_ids in pending.items()
+        }
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                window = futures.pop(future)
+                try:
+                    window_exported, window_failed = future.result()
+                except Exception:
+                    log.exception(f"Export of window {window} failed.")
+                    window_exported, window_failed = [], pending[window]
+                merge_results(checkpoint, window_exported, window_failed)
+                failed.update(window_failed)
+                if args.checkpoint:
+                    save_checkpoint(args.checkpoint, checkpoint)
+                log.info(f"Window {window}: exported {len(window_exported)}, failed {len(window_failed)}.")
+
+    # Only the pipelines of this run are reported, not the others of the checkpoint.
+    exported = sum(1 for pipeline_id, _ in pipelines if pipeline_id in checkpoint["exported"])
+    print(f"Exported {exported} of {len(pipelines)} pipeline traces to {args.endpoint}.")
+    if failed:
+        print(f"Failed pipelines: {', '.join(str(pipeline_id) for pipeline_id in sorted(failed))}")
+        return 1
+    return 0
 
-    for p in pipelines:
-        log.info(f"Exporting pipeline: {p}")
-        exporter.generate_trace(pipeline_id=p[0], endpoint=DEFAULT_GRPC_ENDPOINT)
 
-    return 0
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="backfill-pipeline-traces",
+        description="Export the traces of all pipelines run between two dates, in parallel processes.",
+    )
+    parser.add_argument("--group", default="robot", help="The GitLab group where the project resides.")
+    parser.add_argument(
+        "--project",
+        default="ApplicationRepo",
+        help="The GitLab project (Git repository) where the pipelines were executed.",
+    )
+    parser.add_argument("--start-date", required=True, help="The earliest execution date of a pipeline.")
+    parser.add_argument("--end-date", required=True, help="The latest execution date of a pipeline.")
+    parser.add_argument(
+        "--endpoint",
+        default=DEFAULT_GRPC_ENDPOINT,
+        help=f"'console' or the URL of a GRPC endpoint. Default is {DEFAULT_GRPC_ENDPOINT}.",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count(),
+        help="Processes exporting windows at the same time. Default is the number of CPUs.",
+    )
+    parser.add_argument(
+        "--window-hours",
+        type=float,
+        default=DEFAULT_WINDOW_HOURS,
+        help=f"The hours of pipelines exported by a process at a time. Default is {DEFAULT_WINDOW_HOURS:g}.",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="A JSON file recording the exported and failed pipelines. Rerunning with the file exports "
+        "only the pipelines not exported yet.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=0,
+        help="GitLab API requests in flight per process when retrieving pipelines. Default is 0, one at a time.",
+    )
+    parser.add_argument(
+        "--downstream-depth",
+        type=int,
+        default=0,
+        help="Levels of child and multi-project pipelines to include under their trigger jobs. Default is 0.",
+    )
+
+    args = parser.parse_args()
+    args.start_date = parse(args.start_date)
+    args.end_date = parse(args.end_date)
+    if args.processes < 1 or args.window_hours <= 0:
+        parser.error("--processes and --window-hours must be positive.")
+
+    return args
+
+
+def split_windows(pipelines: list, start_date, window: timedelta) -> dict:
+    """Group pipelines into windows of their creation dates.
+
+    Args:
+        pipelines (list): (pipeline ID, creation date) tuples, as returned by PipelineFinder.pipelines_by_date().
+        start_date (datetime): The start of the first window.
+        window (timedelta): The length of each window.
+
+    Returns:
+        dict: The ISO start date of a window -> the IDs of its pipelines, in the order of the windows.
+    """
+    windows = {}
+    for pipeline_id, pipeline_date in pipelines:
+        window_start = start_date + window * ((pipeline_date - start_date) // window)
+        windows.setdefault(window_start.isoformat(), []).append(pipeline_id)
+    return dict(sorted(windows.items()))
+
+
+def export_window(pipeline_ids: list, endpoint: str) -> tuple:
+    """Export the pipelines of a window in a worker process.
+
+    Returns:
+        tuple: The IDs of the exported pipelines and the IDs of the failed pipelines.
+    """
+    exported = []
+    failed = []
+    try:
+        _exporter.prefetch(pipeline_ids)
+        for pipeline_id in pipeline_ids:
+            try:
+                _exporter.generate_trace(pipeline_id=pipeline_id, endpoint=endpoint)
+                exported.append(pipeline_id)
+            except Exception:
+                log.exception(f"Export of pipeline trace failed for pipeline #{pipeline_id}.")
+                failed.append(pipeline_id)
+    finally:
+        # Sends the remaining spans of the window.
+        _exporter.close()
+    return exported, failed
+
+
+def _init_worker(group: str, project: str, gitlab_token: str, concurrency: int, downstream_depth: int) -> None:
+    global _exporter
+    _exporter = PipelineExporter(
+        group, project, gitlab_token, downstream_depth=downstream_depth, concurrency=concurrency
+    )
+
+
+def load_checkpoint(path: str) -> dict:
+    """The pipelines exported and failed in earlier runs.
+
+    Returns:
+        dict: "exported" and "failed" -> a set of pipeline IDs. The sets are empty without a checkpoint file.
+    """
+    checkpoint = {"exported": set(), "failed": set()}
+    if path and os.path.exists(path):
+        with open(path) as f:
+            checkpoint.update((key, set(pipeline_ids)) for key, pipeline_ids in json.load(f).items())
+    return checkpoint
+
+
+def merge_results(checkpoint: dict, exported: list, failed: list) -> None:
+    """Add the results of a window to the results of earlier runs."""
+    checkpoint["exported"].update(exported)
+    checkpoint["failed"].update(failed)
+    checkpoint["failed"] -= checkpoint["exported"]
+
+
+def save_checkpoint(path: str, checkpoint: dict) -> None:
+    # Written to a temporary file first so that an interrupted run leaves the previous checkpoint intact.
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({key: sorted(pipeline_ids) for key, pipeline_ids in checkpoint.items()}, f, indent=2)
+    os.replace(tmp_path, path)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,37 @@
+"""
+Logging for the trace_utils modules.
+
+Records are formatted only when they are emitted. Hot paths pass arguments rather than
+formatted strings, wrap expensive values in lazy() and check log.isEnabledFor() before
+building debug data, so debug logging costs nothing when the level is INFO.
+
+Key/value pairs passed with extra=fields(...) are added to records. They are appended to
+text records and become members of JSON records. JSON records are selected with the
+CI_TRACE_EXPORT_LOG_FORMAT environment variable.
+
+Messages logged for each job of a pipeline pass extra=SAMPLED. At most SAMPLE_BURST of them
+are emitted per call site every SAMPLE_SECONDS seconds, unless debugging is enabled. The number
+of suppressed messages is added to the next message emitted.
+"""
+
+import json
 import logging
 import os
 import sys
+import threading
+import time
+
+# Messages emitted per call site of sampled messages in each window.
+SAMPLE_BURST = 10
+# The length of a sampling window in seconds.
+SAMPLE_SECONDS = 60.0
+# Extra for per-job messages that are rate limited.
+SAMPLED = {"sampled": True}
+
+FORMAT_STR = "%(asctime)s [%(levelname)s] %(name)s #%(lineno)s:  %(message)s"
 
 # Root logger
-log = logging.getLogger(__name__)
+log = logging.getLogger()
 
 
 def debug_per_environment():
@@ -22,24 +50,22 @@ def debug_per_environment():
             return False
 
 
+def json_per_environment() -> bool:
+    """Determine if JSON records are selected via the environment"""
+    return os.environ.get("CI_TRACE_EXPORT_LOG_FORMAT", "").strip().lower() == "json"
+
+
 def get_logger(name, level=logging.INFO):
     """Provide a logger for a module."""
-    global log
-    format_str = "%(asctime)s [%(levelname)s] %(name)s #%(lineno)s:  %(message)s"
     if debug_per_environment():
         level = logging.DEBUG
 
-    # The first caller of this function initializes
-    # logging for this execution space.
-    if len(log.handlers) > 0:
-        logging.basicConfig(level=level, format=format_str)
-        formatter = logging.Formatter()
-        logging_stdout = logging.StreamHandler(sys.stdout)
-        logging_stdout.setFormatter(formatter)
-        logging_stdout.setLevel(level)
-
-        log.addHandler(logging_stdout)
-        log.setLevel(level)
+    # The first caller of this function initializes logging for this execution space,
+    # unless the application has configured logging already.
+    if len(log.handlers) == 0:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(JsonFormatter() if json_per_environment() else TextFormatter(FORMAT_STR))
+        log.addHandler(handler)
 
     # Modules pulled in as dependencies known to be noisy at logging.INFO.
     logging.getLogger("urllib3").setLevel(logging.WARNING)
@@ -47,5 +73,92 @@ def get_logger(name, level=logging.INFO):
 
     module_logger = logging.getLogger(name)
     module_logger.setLevel(level)
+    if not any(isinstance(f, SampleFilter) for f in module_logger.filters):
+        module_logger.addFilter(SampleFilter())
 
     return module_logger
+
+
+def fields(**kwargs) -> dict:
+    """Extra for a log call adding key/value pairs to the record.
+
+    e.g. log.debug("Job span generated.", extra=fields(job_id=job.id, span=lazy(span.to_json)))
+    """
+    return {"fields": kwargs}
+
+
+class lazy:
+    """A log argument or field computed only when the record is emitted.
+
+    e.g. log.debug("Pipeline: %s", lazy(pipeline.asdict))
+    """
+
+    __slots__ = ("func", "args")
+
+    def __init__(self, func, *args) -> None:
+        self.func = func
+        self.args = args
+
+    def __str__(self) -> str:
+        return str(self.func(*self.args))
+
+    def value(self) -> any:
+        return self.func(*self.args)
+
+
+class TextFormatter(logging.Formatter):
+    """The usual text records, with the fields of the record appended as key=value pairs."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        record_fields = getattr(record, "fields", None)
+        if record_fields:
+            text += "  " + " ".join(f"{key}={value}" for key, value in record_fields.items())
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """Records as JSON objects, one per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "line": record.lineno,
+            "message": record.getMessage(),
+        }
+        for key, value in getattr(record, "fields", {}).items():
+            entry[key] = value.value() if isinstance(value, lazy) else value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SampleFilter(logging.Filter):
+    """Rate limits records logged with extra=SAMPLED, per call site."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._lock = threading.Lock()
+        # (path, line) -> [window start, emitted in window, suppressed]
+        self._sites = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "sampled", False) or logging.getLogger(record.name).isEnabledFor(logging.DEBUG):
+            return True
+
+        now = time.monotonic()
+        with self._lock:
+            site = self._sites.setdefault((record.pathname, record.lineno), [now, 0, 0])
+            if now - site[0] >= SAMPLE_SECONDS:
+                site[0], site[1] = now, 0
+            if site[1] >= SAMPLE_BURST:
+                site[2] += 1
+                return False
+            site[1] += 1
+            suppressed, site[2] = site[2], 0
+
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+        return True
@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+
+"""
+This module locates the critical path of GitLab CI pipelines.
+
+The critical path is the chain of dependent jobs that determines the wall time of a pipeline.
+Shortening any job on the critical path shortens the pipeline. Shortening a job that is not on
+the critical path does not, up to the amount of slack the job has.
+
+Job dependencies are built from the `needs` keyword of each job and from stage ordering. A job
+without `needs` waits for every job in all earlier stages. A job with `needs` waits only for
+the jobs it names. The analysis is the classic critical path method applied to the job graph and
+runs in time linear to the number of jobs and dependencies. Job durations exclude queued time
+since queueing depends on runner capacity rather than on the job itself.
+
+
+# # # Usage Option 1: Python API
+
+from trace_utils.critical_path import CriticalPathAnalyzer
+
+analyzer = CriticalPathAnalyzer("robot", "ApplicationRepo")
+critical_path = analyzer.analyze(23221)
+print(critical_path.jobs, critical_path.duration, critical_path.slack)
+
+# # # Usage Option 2: Parameters on the Command Line
+
+critical_path -h
+usage: critical_path [-h] --group GROUP --project PROJECT [--pipeline PIPELINE [PIPELINE ...]]
+                     [--start-date START_DATE] [--end-date END_DATE] [--top TOP] [--debug]
+
+Individual pipelines are analyzed with --pipeline. All pipelines run between two dates are
+analyzed with --start-date and --end-date. A summary of the jobs found most often on the
+critical path, with the seconds they spent on it, is printed after the pipelines are analyzed.
+"""
+
+import argparse
+import logging
+import re
+import sys
+from collections import defaultdict, deque
+from datetime import datetime, timezone
+
+import gitlab
+from dateutil.parser import parse
+
+from trace_utils.base_logger import get_logger
+from trace_utils.find_pipelines import PipelineFinder
+
+# Jobs with less slack than this, in seconds, are on the critical path.
+SLACK_TOLERANCE = 0.001
+
+# Parallel and matrix jobs are named "<job> 1/3" or "<job>: [a, b]". A `needs` entry names the base job.
+PARALLEL_SUFFIX_PATTERN = re.compile(r"^(.+?)(?: \d+/\d+|: \[.*\])$")
+
+JOB_DEPENDENCIES_QUERY = """
+query($fullPath: ID!, $pipelineId: CiPipelineID!, $after: String) {
+  project(fullPath: $fullPath) {
+    pipeline(id: $pipelineId) {
+      stages {
+        nodes {
+          name
+        }
+      }
+      jobs(after: $after) {
+        pageInfo {
+          hasNextPage
+          endCursor
+        }
+        nodes {
+          name
+          schedulingType
+          needs {
+            nodes {
+              name
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+log = get_logger(__name__)
+
+
+def main() -> int:
+    args = parse_args()
+    if args.debug:
+        log.setLevel(logging.DEBUG)
+
+    try:
+        analyzer = CriticalPathAnalyzer(args.group, args.project)
+    except RuntimeError:
+        log.exception("Could not create a CriticalPathAnalyzer object.")
+        return 1
+
+    if args.pipeline:
+        pipeline_ids = args.pipeline
+    else:
+        pipeline_ids = [p[0] for p in analyzer.pipelines_by_date(args.start_date, args.end_date)]
+
+    results = analyzer.analyze_many(pipeline_ids)
+    for pipeline_id, critical_path in results.items():
+        print(f"Pipeline {pipeline_id}: {critical_path}")
+
+    print(format_summary(results.values(), args.top))
+
+    return 0 if len(results) == len(pipeline_ids) else 1
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="critical_path",
+        description="Find the chain of jobs that determines the duration of GitLab pipelines.",
+    )
+    parser.add_argument("--group", required=True, help="The GitLab group where the project resides.")
+    parser.add_argument(
+        "--project",
+        required=True,
+        help="The GitLab project (Git repository) where the pipelines were executed.",
+    )
+    parser.add_argument("--pipeline", type=int, nargs="+", help="One or more completed pipelines to analyze.")
+    parser.add_argument("--start-date", help="Analyze pipelines started on or after this date.")
+    parser.add_argument("--end-date", help="Analyze pipelines started before this date. Defaults to the current time.")
+    parser.add_argument(
+        "--top", type=int, default=10, help="The number of jobs listed in the critical path summary. Default is 10."
+    )
+    parser.add_argument("--debug", action="store_true")
+
+    args = parser.parse_args()
+    if not args.pipeline and not args.start_date:
+        parser.error("Either --pipeline or --start-date must be supplied.")
+
+    # Convert string input to Python objects.
+    if args.start_date:
+        args.start_date = parse(args.start_date)
+    if args.end_date:
+        args.end_date = parse(args.end_date)
+    else:
+        args.end_date = datetime.now(timezone.utc)
+
+    return args
+
+
+class CriticalPath:
+    """The result of a critical path analysis of the jobs in a pipeline."""
+
+    def __init__(self, jobs: list, duration: float, slack: dict, job_durations: dict = None) -> None:
+        """
+        Args:
+            jobs (list): Job names on the critical path in execution order.
+            duration (float): The summed duration, in seconds, of the jobs on the critical path.
+            slack (dict): Job name to the number of seconds the job could be delayed
+                without delaying the pipeline.
+            job_durations (dict, optional): Job name to the duration, in seconds, of each job
+                on the critical path. Defaults to no durations.
+        """
+        self.jobs = jobs
+        self.duration = duration
+        self.slack = slack
+        self.job_durations = job_durations or {}
+
+    def is_critical(self, job_name: str) -> bool:
+        return self.slack.get(job_name, 0.0) < SLACK_TOLERANCE
+
+    def job_attributes(self, job_name: str) -> dict:
+        """Span attributes for a job in the analyzed pipeline."""
+        return {
+            "critical_path": self.is_critical(job_name),
+            "slack_seconds": round(self.slack.get(job_name, 0.0), 3),
+        }
+
+    def pipeline_attributes(self) -> dict:
+        """Span attributes for the analyzed pipeline."""
+        return {
+            "critical_path_jobs": self.jobs,
+            "critical_path_seconds": round(self.duration, 3),
+        }
+
+    def __str__(self) -> str:
+        return f"{self.duration:.1f}s: {' -> '.join(self.jobs)}"
+
+
+class CriticalPathAnalyzer(PipelineFinder):
+    """Analyzes the critical path of pipelines run in a GitLab project.
+
+    Pipelines can be analyzed one at a time, in batches, or located by date
+    with the inherited PipelineFinder methods and then analyzed.
+    """
+
+    def analyze(self, pipeline_id: int) -> CriticalPath:
+        """Find the critical path of a single pipeline.
+
+        Args:
+            pipeline_id (int): The ID of a completed pipeline.
+
+        Raises:
+            RuntimeError: The pipeline or its jobs could not be retrieved.
+
+        Returns:
+            CriticalPath: The critical path of the pipeline.
+        """
+        try:
+            pipeline = self.project.pipelines.get(pipeline_id)
+            jobs = pipeline.jobs.list(get_all=True)
+        except gitlab.exceptions.GitlabError as e:
+            raise RuntimeError(f"Could not retrieve pipeline {pipeline_id}: {e.error_message}") from e
+
+        return critical_path_for_jobs(self.gl_client, self.project, pipeline, jobs)
+
+    def analyze_many(self, pipeline_ids: list) -> dict:
+        """Find the critical path of each pipeline in a batch.
+
+        Pipelines that cannot be analyzed are logged and left out of the results.
+
+        Args:
+            pipeline_ids (list): The IDs of completed pipelines.
+
+        Returns:
+            dict: Pipeline ID to CriticalPath in the order the pipelines were supplied.
+        """
+        results = {}
+        for pipeline_id in pipeline_ids:
+            try:
+                results[pipeline_id] = self.analyze(pipeline_id)
+            except RuntimeError:
+                log.exception(f"Critical path analysis failed for pipeline {pipeline_id}.")
+        return results
+
+
+def base_job_name(job_name: str) -> str:
+    """The name a `needs` entry uses to refer to a parallel or matrix job."""
+    match = PARALLEL_SUFFIX_PATTERN.match(job_name)
+    return match.group(1) if match else job_name
+
+
+def critical_path_for_jobs(gl_client, project, pipeline, jobs: list) -> CriticalPath:
+    """Find the critical path of a pipeline from jobs already retrieved from GitLab.
+
+    Args:
+        gl_client (gitlab.Gitlab): The client used to query job dependencies.
+        project (Project): The GitLab project the pipeline ran in.
+        pipeline (ProjectPipeline): The pipeline the jobs belong to.
+        jobs (list): The GitLab job objects of the pipeline.
+
+    Returns:
+        CriticalPath: The critical path of the pipeline.
+    """
+    try:
+        stage_names, needs = retrieve_job_dependencies(gl_client, project.path_with_namespace, pipeline.id)
+    except RuntimeError as e:
+        # Without `needs` every job is assumed to wait for the stages before it.
+        log.warning(f"Job dependencies unavailable for pipeline {pipeline.id}, using stage order only: {e}")
+        stage_names, needs = stage_order_from_jobs(jobs), {}
+
+    durations = {job.name: float(job.duration or 0) for job in jobs}
+    stages = {job.name: job.stage for job in jobs}
+    return find_critical_path(durations, stages, stage_names, needs)
+
+
+def find_critical_path(durations: dict, stages: dict, stage_names: list, needs: dict) -> CriticalPath:
+    """Find the critical path of a pipeline job graph.
+
+    Each stage is given a zero-length barrier node that depends on the jobs of that stage and on
+    the barrier of the stage before it. A job without `needs` depends on the barrier of the
+    preceding stage. This keeps the number of edges linear in the number of jobs.
+
+    Args:
+        durations (dict): Job name to job duration in seconds.
+        stages (dict): Job name to the name of the stage the job ran in.
+        stage_names (list): Stage names in pipeline order.
+        needs (dict): Job name to the list of job names from its `needs` keyword. Jobs scheduled
+            by stage alone are absent or map to None.
+
+    Raises:
+        RuntimeError: The job dependencies contain a cycle.
+
+    Returns:
+        CriticalPath: The critical path of the pipeline.
+    """
+    # Stages without jobs, e.g. every job was skipped by rules, are left out.
+    used_stages = set(stages.values())
+    stage_index = {}
+    for name in stage_names:
+        if name in used_stages and name not in stage_index:
+            stage_index[name] = len(stage_index)
+    for name in stages.values():
+        # Stages missing from the pipeline definition are placed last rather than dropped.
+        stage_index.setdefault(name, len(stage_index))
+
+    barriers = [("stage", i) for i in range(len(stage_index))]
+    weight = dict(durations)
+    weight.update((b, 0.0) for b in barriers)
+    predecessors = defaultdict(list)
+
+    jobs_by_base_name = defaultdict(list)
+    for job_name in durations:
+        jobs_by_base_name[base_job_name(job_name)].append(job_name)
+
+    for job_name in durations:
+        position = stage_index[stages[job_name]]
+        predecessors[barriers[position]].append(job_name)
+
+        job_needs = needs.get(job_name)
+        if job_needs is None:
+            if position > 0:
+                predecessors[job_name].append(barriers[position - 1])
+            continue
+        for needed in job_needs:
+            # Optional needs and needs of other pipelines are not part of this graph.
+            needed_jobs = [needed] if needed in durations else jobs_by_base_name.get(needed, [])
+            predecessors[job_name].extend(needed_jobs)
+
+    for position in range(1, len(barriers)):
+        predecessors[barriers[position]].append(barriers[position - 1])
+
+    order = _topological_order(weight, predecessors)
+
+    # Forward pass: earliest finish of each node.
+    earliest_finish = {}
+    for node in order:
+        earliest_start = max((earliest_finish[p] for p in predecessors[node]), default=0.0)
+        earliest_finish[node] = earliest_start + weight[node]
+    duration = max(earliest_finish.values(), default=0.0)
+
+    # Backward pass: latest finish of each node that does not delay the pipeline.
+    latest_finish = dict.fromkeys(order, duration)
+    for node in reversed(order):
+        latest_start = latest_finish[node] - weight[node]
+        for p in predecessors[node]:
+            if latest_start < latest_finish[p]:
+                latest_finish[p] = latest_start
+
+    slack = {job_name: latest_finish[job_name] - earliest_finish[job_name] for job_name in durations}
+
+    # Walk back from the node finishing last through the predecessors that finish last.
+    path = []
+    node = max(order, key=lambda n: earliest_finish[n], default=None)
+    while node is not None:
+        if node in durations:
+            path.append(node)
+        node = max(predecessors[node], key=lambda n: earliest_finish[n], default=None)
+    path.reverse()
+
+    return CriticalPath(path, duration, slack, {job_name: durations[job_name] for job_name in path})
+
+
+def _topological_order(nodes, predecessors: dict) -> list:
+    """Order the nodes of the job graph so every node follows its predecessors (Kahn's algorithm)."""
+    successors = defaultdict(list)
+    in_degree = dict.fromkeys(nodes, 0)
+    for node in nodes:
+        for p in predecessors[node]:
+            successors[p].append(node)
+            in_degree[node] += 1
+
+    ready = deque(node for node, degree in in_degree.items() if degree == 0)
+    order = []
+    while ready:
+        node = ready.popleft()
+        order.append(node)
+        for s in successors[node]:
+            in_degree[s] -= 1
+            if in_degree[s] == 0:
+                ready.append(s)
+
+    if len(order) != len(in_degree):
+        raise RuntimeError("The job dependencies of the pipeline contain a cycle.")
+
+    return order
+
+
+def format_summary(critical_paths, top: int = 10) -> str:
+    """Summarize the jobs found most often on the critical path of a batch of pipelines.
+
+    Args:
+        critical_paths (iterable): CriticalPath objects.
+        top (int, optional): The number of jobs to include. Defaults to 10.
+
+    Returns:
+        str: A printable report of critical path count, total critical seconds, and job name.
+            The critical seconds of a job are its own durations in the pipelines where it was
+            on the critical path.
+    """
+    counts = defaultdict(int)
+    seconds = defaultdict(float)
+    num_pipelines = 0
+    for critical_path in critical_paths:
+        num_pipelines += 1
+        for job_name in critical_path.jobs:
+            counts[job_name] += 1
+            seconds[job_name] += critical_path.job_durations.get(job_name, 0.0)
+
+    ranked = sorted(counts, key=lambda name: (-counts[name], -seconds[name], name))[:top]
+    lines = [f"Jobs most often on the critical path of {num_pipelines} pipelines:"]
+    lines.append(f"  {'count':>5}  {'seconds':>10}  job")
+    lines += [f"  {counts[name]:>5}  {seconds[name]:>10.1f}  {name}" for name in ranked]
+    return "\n".join(lines)
+
+
+def retrieve_job_dependencies(gl_client, project_path: str, pipeline_id: int) -> tuple:
+    """Retrieve stage order and the `needs` of each job of a pipeline.
+
+    The REST API does not expose job `needs`, so the GraphQL API is used.
+
+    Args:
+        gl_client (gitlab.Gitlab): An authenticated GitLab client.
+        project_path (str): The full path of the project, e.g. "robot/ApplicationRepo".
+        pipeline_id (int): The pipeline ID.
+
+    Raises:
+        RuntimeError: The GraphQL query failed.
+
+    Returns:
+        tuple: (<stage names in pipeline order: list>, <job name to needed job names or None: dict>)
+    """
+    variables = {"fullPath": project_path, "pipelineId": f"gid://gitlab/Ci::Pipeline/{pipeline_id}", "after": None}
+    stage_names = []
+    needs = {}
+    while True:
+        try:
+            response = gl_client.http_post(
+                f"{gl_client.url}/api/graphql",
+                post_data={"query": JOB_DEPENDENCIES_QUERY, "variables": variables},
+            )
+        except gitlab.exceptions.GitlabError as e:
+            raise RuntimeError(f"Cannot retrieve job dependencies: {e.error_message}") from e
+
+        if response.get("errors"):
+            raise RuntimeError(f"Cannot retrieve job dependencies: {response['errors']}")
+        pipeline = ((response.get("data") or {}).get("project") or {}).get("pipeline")
+        if not pipeline:
+            raise RuntimeError(f"Pipeline {pipeline_id} not found in {project_path}.")
+
+        if not stage_names:
+            stage_names = [stage["name"] for stage in pipeline["stages"]["nodes"]]
+        for job in pipeline["jobs"]["nodes"]:
+            if job["schedulingType"] == "dag":
+                needs[job["name"]] = [need["name"] for need in job["needs"]["nodes"]]
+            else:
+                needs[job["name"]] = None
+
+        page_info = pipeline["jobs"]["pageInfo"]
+        if not page_info["hasNextPage"]:
+            break
+        variables["after"] = page_info["endCursor"]
+
+    log.debug("Job dependencies for pipeline %s: stages = %s, needs = %s", pipeline_id, stage_names, needs)
+    return stage_names, needs
+
+
+def stage_order_from_jobs(jobs: list) -> list:
+    """Approximate stage order by the earliest start time of the jobs in each stage."""
+    first_start = {}
+    for job in jobs:
+        started_at = job.started_at or job.finished_at or ""
+        if job.stage not in first_start or (started_at and started_at < first_start[job.stage]):
+            first_start[job.stage] = started_at
+    # Stages that never started sort last.
+    return sorted(first_start, key=lambda stage: (not first_start[stage], first_start[stage]))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,6 +8,11 @@ A new trace ID is generated each time this code is executed. Thefore running the
 for the same pipeline ID will generate a duplicate event in the data source since this
 exporter does not query the data source for pre-existing traces with matching attributes.
 
+Pipelines that are still running can be followed instead. In follow mode each job span is
+exported as soon as the job finishes and the pipeline span is exported when the pipeline
+completes. The trace ID and the pipeline span ID are derived from the pipeline so that job
+spans exported early attach to the pipeline span exported last.
+
 The functionality of this Python module can be used on the command line or by importing
 the main class into another Python module or script.
 
@@ -20,14 +25,38 @@ Environment:
   Developer: GITLAB_TOKEN: Set your credential in your environment before executing this code.
 
 ./export_pipeline_trace.py  cli-args -h
-usage: ./export_pipeline_trace.py cli-args [-h] --group GROUP --project PROJECT --pipeline PIPELINE [--endpoint ENDPOINT]
+usage: ./export_pipeline_trace.py cli-args [-h] --group GROUP --project PROJECT --pipeline PIPELINE [PIPELINE ...] [--endpoint ENDPOINT]
 
 optional arguments:
   -h, --help           show this help message and exit
   --group GROUP        The GitLab group where the project resides.
   --project PROJECT    The GitLab project (Git repository) where the pipeline was executed.
-  --pipeline PIPELINE  The completed CI pipeline to produce traces for.
+  --pipeline PIPELINE [PIPELINE ...]
+                       The completed CI pipelines to produce traces for. See "Pipeline IDs" below.
   --endpoint ENDPOINT  The destination for the trace. Can be 'console' or a URL for a GRPC endpoint. The default is the production Grafana instance.
+  --critical-path      Tag the jobs on the critical path of the pipeline and the slack time of every job.
+  --metrics            Also export job and pipeline duration histograms as OTLP metrics to the endpoint.
+  --follow             Export job spans as jobs finish until the pipeline completes.
+  --poll-interval POLL_INTERVAL
+                       Seconds between checks for finished jobs in follow mode.
+  --downstream-depth DOWNSTREAM_DEPTH
+                       Levels of child and multi-project pipelines to include under their trigger jobs.
+  --profile PROFILE    Profile the phases of the exports. Writes PROFILE/<phase>.prof and prints the hot functions.
+  --concurrency CONCURRENCY
+                       Retrieve pipelines ahead of their exports with up to this many GitLab API requests in flight.
+  --self-trace SELF_TRACE
+                       Trace the work of the exporter itself, including every GitLab API request, to 'console'
+                       or a GRPC endpoint. The spans belong to the service trace-utils-exporter.
+
+Pipeline IDs:
+  Several pipelines are exported in one run, through one GitLab client and one connection to the
+  endpoint. The IDs are separated by commas or whitespace. Each item is one of:
+    23221         A pipeline ID.
+    23221-23240   A range of pipeline IDs, including both ends.
+    @ids.txt      A file of pipeline IDs in the same format. Lines starting with '#' are comments.
+    -             Standard input, in the same format as a file.
+  e.g. --pipeline 23221,23225-23230 @more-ids.txt
+  A summary of the exported and failed pipelines is printed at the end. The exit code is 1 if any failed.
 
 NOTE: Some CI Docker images come with this module pre-installed. The CI user operates
 in a shell using a Python virtual environment. The export_pipeline command
@@ -43,9 +72,20 @@ usage: ./export_pipeline_trace.py
 
 CI_TRACE_EXPORT_GROUP
 CI_TRACE_EXPORT_PROJECT
-CI_TRACE_EXPORT_PIPELINE
+CI_TRACE_EXPORT_PIPELINE # Pipeline IDs in the format of --pipeline
 CI_TRACE_EXPORT_GRPC_ENDPOINT # Optional
+CI_TRACE_EXPORT_CRITICAL_PATH # Optional
+CI_TRACE_EXPORT_METRICS # Optional
+CI_TRACE_EXPORT_FOLLOW # Optional
+CI_TRACE_EXPORT_POLL_INTERVAL # Optional
+CI_TRACE_EXPORT_DOWNSTREAM_DEPTH # Optional
 CI_TRACE_EXPORT_DEBUG # Optional
+CI_TRACE_EXPORT_LOG_FORMAT # Optional: 'json' for JSON log records
+CI_TRACE_EXPORT_PROFILE # Optional: a directory for profiles, see --profile
+CI_TRACE_EXPORT_SELF_TRACE # Optional: an endpoint for spans of the exporter itself, see --self-trace
+CI_TRACE_EXPORT_HTTP_CACHE # Optional: an SQLite file caching GitLab API responses, see http_cache.py
+CI_TRACE_EXPORT_HTTP_CACHE_MB # Optional: the size cap of the cache in megabytes
+CI_TRACE_EXPORT_CONCURRENCY # Optional: GitLab API requests in flight when prefetching, see --concurrency
 GITLAB_CI_PAT | GITLAB_TOKEN
 
 # # # Usage Option 3: Python API
@@ -62,25 +102,77 @@ Extra key/value pairs are propagated to all spans.
 
 Using the otel-demo stack in tools/ExportTracesRepo to test locally:
     pipeline_exporter.generate_trace(endpoint="http://localhost:4518")
+
+Critical path attributes are added to spans when requested (see critical_path.py):
+    pipeline_exporter = PipelineExporter("robot", "ApplicationRepo", critical_path=True)
+
+Pre-aggregated duration histograms are sent alongside the trace when requested:
+    pipeline_exporter = PipelineExporter("robot", "ApplicationRepo", metrics=True)
+  The histograms have delta temporality and are stamped with the time of the export, not the time
+  the pipeline ran, so backfilled pipelines are not rejected as too old. Each PipelineExporter is a
+  separate writer, identified by the service.instance.id resource attribute, whose data points
+  follow each other without overlapping. Backends that only store cumulative histograms, e.g.
+  Prometheus and Mimir, need a collector with the deltatocumulative processor in front of them.
+
+Child and multi-project pipelines started by trigger (bridge) jobs are nested under the
+trigger job span when a depth is given. Downstream pipelines are retrieved concurrently:
+    pipeline_exporter = PipelineExporter("robot", "ApplicationRepo", downstream_depth=2)
+
+Following a running pipeline returns when the pipeline completes:
+    pipeline_exporter.follow_pipeline(23221, endpoint="http://localhost:4518", poll_interval=15)
+
+Profiles of the phases of the exports are collected by a PhaseProfiler (see profiling.py):
+    pipeline_exporter = PipelineExporter("robot", "ApplicationRepo", profiler=PhaseProfiler())
+
+The exporter traces its own work, e.g. its GitLab API requests, to a separate service (see self_tracing.py):
+    pipeline_exporter = PipelineExporter("robot", "ApplicationRepo", self_tracer=SelfTracer("http://localhost:4518"))
+
+Traces of several pipelines share the connection to an endpoint. Close the exporter when done:
+    for pipeline_id in parse_pipeline_ids(["23221-23240"]):
+        pipeline_exporter.generate_trace(pipeline_id)
+    pipeline_exporter.close()
+
+Pipelines are retrieved concurrently ahead of their exports when a concurrency is given (see async_gitlab.py):
+    pipeline_exporter = PipelineExporter("robot", "ApplicationRepo", concurrency=32)
+    pipeline_exporter.prefetch(pipeline_ids)
 """
 import argparse
+import contextvars
+import hashlib
 import logging
 import os
+import random
 import sys
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import gitlab
 from dateutil.parser import parse
-from opentelemetry import trace
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
-from opentelemetry.sdk.resources import Resource
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import ConsoleSpanExporter, SimpleSpanProcessor
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
 
-from trace_utils.base_logger import get_logger
-from trace_utils.gitlab_common import GitlabProjectBase, get_gitlab_token
+from trace_utils.base_logger import SAMPLED, fields, get_logger, lazy
+from trace_utils.critical_path import critical_path_for_jobs
+from trace_utils.gitlab_common import (
+    FINISHED_STATUSES,
+    GITLAB_URL,
+    GitlabProjectBase,
+    env_flag,
+    get_gitlab_token,
+    traced,
+)
+from trace_utils.profiling import PhaseProfiler, report
+
+# The OpenTelemetry SDK and the GRPC exporter take longer to import than the rest of this module.
+# They are imported where spans are built, after the first GitLab API call, and the GRPC exporter
+# only for GRPC endpoints. asyncio is imported only when pipelines are prefetched.
+# dev/startup-benchmark.py measures the import times.
 
 DEFAULT_GRPC_ENDPOINT = "http://redacted:4518"
+DEFAULT_POLL_SECONDS = 15
+# The most downstream pipelines retrieved from GitLab at the same time.
+DOWNSTREAM_WORKERS = 8
+# Pipelines prefetched at a time when a concurrency is given. Prefetched pipelines are held in memory until exported.
+PREFETCH_BATCH = 50
 
 
 log = get_logger(__name__)
@@ -98,16 +190,60 @@ def main() -> int:
     if args.debug:
         log.setLevel(logging.DEBUG)
 
+    profiler = PhaseProfiler() if args.profile else None
+    self_tracer = None
+    if args.self_trace:
+        from trace_utils.self_tracing import SelfTracer
+
+        self_tracer = SelfTracer(args.self_trace, gitlab_group=args.group, gitlab_project=args.project)
     try:
-        log.info(f"Sending trace {args.group}:{args.project}:{args.pipeline} to {args.endpoint}.")
-        trace_exporter = PipelineExporter(args.group, args.project, gitlab_token)
-        trace_exporter.generate_trace(args.pipeline, args.endpoint)
-        log.info(f"Trace successfully exported for pipeline #{args.pipeline}")
-        return 0
+        trace_exporter = PipelineExporter(
+            args.group,
+            args.project,
+            gitlab_token,
+            critical_path=args.critical_path,
+            metrics=args.metrics,
+            downstream_depth=args.downstream_depth,
+            profiler=profiler,
+            self_tracer=self_tracer,
+            concurrency=args.concurrency,
+        )
     except Exception:
-        log.exception(f"Export of pipeline trace failed.")
+        log.exception("Export of pipeline traces failed.")
+        if self_tracer:
+            self_tracer.shutdown()
         return 1
 
+    exported = []
+    failed = []
+    try:
+        for i, pipeline_id in enumerate(args.pipeline):
+            if not args.follow and i % PREFETCH_BATCH == 0:
+                trace_exporter.prefetch(args.pipeline[i : i + PREFETCH_BATCH])
+            log.info(f"Sending trace {args.group}:{args.project}:{pipeline_id} to {args.endpoint}.")
+            try:
+                if args.follow:
+                    trace_exporter.follow_pipeline(pipeline_id, args.endpoint, args.poll_interval)
+                else:
+                    trace_exporter.generate_trace(pipeline_id, args.endpoint)
+                log.info(f"Trace successfully exported for pipeline #{pipeline_id}")
+                exported.append(pipeline_id)
+            except Exception:
+                log.exception(f"Export of pipeline trace failed for pipeline #{pipeline_id}.")
+                failed.append(pipeline_id)
+    finally:
+        trace_exporter.close()
+        if self_tracer:
+            self_tracer.shutdown()
+
+    if profiler:
+        report(profiler, args.profile)
+    print(f"Exported {len(exported)} of {len(args.pipeline)} pipeline traces to {args.endpoint}.")
+    if failed:
+        print(f"Failed pipelines: {', '.join(str(pipeline_id) for pipeline_id in failed)}")
+        return 1
+    return 0
+
 
 def parse_args() -> any:
     """Manage command line arguments.
@@ -154,13 +290,66 @@ def _parse_args_cli():
         "--project",
         help="The GitLab project (Git repository) where the pipeline was executed.",
     )
-    cli_parser.add_argument("--pipeline", type=int, help="The completed CI pipeline to produce traces for.")
+    cli_parser.add_argument(
+        "--pipeline",
+        nargs="+",
+        help="The completed CI pipelines to produce traces for: IDs, ranges such as 23221-23240, "
+        "@file for a file of IDs or '-' for IDs on stdin.",
+    )
     cli_parser.add_argument(
         "--endpoint",
         default=DEFAULT_GRPC_ENDPOINT,
         help="The destination for the trace. Can be 'console' or a GRPC endpoint. "
         "Default is the production Grafana instance.",
     )
+    cli_parser.add_argument(
+        "--critical-path",
+        action="store_true",
+        default=False,
+        help="Tag the jobs on the critical path of the pipeline and the slack time of every job.",
+    )
+    cli_parser.add_argument(
+        "--metrics",
+        action="store_true",
+        default=False,
+        help="Also export job and pipeline duration histograms as OTLP metrics to the endpoint.",
+    )
+    cli_parser.add_argument(
+        "--follow",
+        action="store_true",
+        default=False,
+        help="Export job spans as jobs finish until the pipeline completes.",
+    )
+    cli_parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=DEFAULT_POLL_SECONDS,
+        help=f"Seconds between checks for finished jobs in follow mode. Default is {DEFAULT_POLL_SECONDS}.",
+    )
+    cli_parser.add_argument(
+        "--downstream-depth",
+        type=int,
+        default=0,
+        help="Levels of child and multi-project pipelines to include under their trigger jobs. Default is 0.",
+    )
+    cli_parser.add_argument(
+        "--profile",
+        metavar="DIRECTORY",
+        help="Profile the phases of the exports. Writes DIRECTORY/<phase>.prof and prints the hot functions.",
+    )
+    cli_parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=0,
+        help="Retrieve pipelines ahead of their exports with up to this many GitLab API requests in flight. "
+        "Default is 0, one request at a time.",
+    )
+    cli_parser.add_argument(
+        "--self-trace",
+        metavar="ENDPOINT",
+        help="Trace the work of the exporter itself, including every GitLab API request, to 'console' "
+        "or a GRPC endpoint. The spans belong to the service trace-utils-exporter.",
+    )
     cli_parser.add_argument("--debug", action="store_true", default=False)
 
     args = parser.parse_args()
@@ -174,6 +363,12 @@ def _parse_args_cli():
         # An empty Namespace object is returned.
         pass
 
+    if getattr(args, "pipeline", None):
+        try:
+            args.pipeline = parse_pipeline_ids(args.pipeline)
+        except (OSError, ValueError) as e:
+            cli_parser.error(f"Invalid --pipeline: {e}")
+
     return args
 
 
@@ -188,7 +383,15 @@ def _parse_args_env():
         "project": "CI_TRACE_EXPORT_PROJECT",
         "pipeline": "CI_TRACE_EXPORT_PIPELINE",
         "endpoint": "CI_TRACE_EXPORT_GRPC_ENDPOINT",
+        "critical_path": "CI_TRACE_EXPORT_CRITICAL_PATH",
+        "metrics": "CI_TRACE_EXPORT_METRICS",
+        "follow": "CI_TRACE_EXPORT_FOLLOW",
+        "poll_interval": "CI_TRACE_EXPORT_POLL_INTERVAL",
+        "downstream_depth": "CI_TRACE_EXPORT_DOWNSTREAM_DEPTH",
         "debug": "CI_TRACE_EXPORT_DEBUG",
+        "profile": "CI_TRACE_EXPORT_PROFILE",
+        "self_trace": "CI_TRACE_EXPORT_SELF_TRACE",
+        "concurrency": "CI_TRACE_EXPORT_CONCURRENCY",
     }
     # A simplistic parser provides a namespace and helps manage errors.
     parser = argparse.ArgumentParser(usage="")
@@ -206,15 +409,131 @@ def _parse_args_env():
     if missing_values:
         parser.error(f"The following variables must be defined in the environment: {missing_values}")
 
-    # Optional value
+    try:
+        args.pipeline = parse_pipeline_ids([args.pipeline])
+    except (OSError, ValueError) as e:
+        parser.error(f"Invalid {supported_params['pipeline']}: {e}")
+
+    # Optional values
     if not args.endpoint:
         args.endpoint = DEFAULT_GRPC_ENDPOINT
+    args.critical_path = env_flag(supported_params["critical_path"])
+    args.metrics = env_flag(supported_params["metrics"])
+    args.follow = env_flag(supported_params["follow"])
+    try:
+        args.poll_interval = float(args.poll_interval or DEFAULT_POLL_SECONDS)
+    except ValueError:
+        parser.error(f"{supported_params['poll_interval']} must be a number of seconds.")
+    try:
+        args.downstream_depth = int(args.downstream_depth or 0)
+    except ValueError:
+        parser.error(f"{supported_params['downstream_depth']} must be a whole number.")
+    try:
+        args.concurrency = int(args.concurrency or 0)
+    except ValueError:
+        parser.error(f"{supported_params['concurrency']} must be a whole number.")
 
     log.debug(f"args in _parse_args_env(): {args}")
     return args
 
 
+def parse_pipeline_ids(specs: list) -> list:
+    """Parse pipeline IDs given on the command line or in the environment.
+
+    Args:
+        specs (list): Strings of items separated by commas or whitespace. Each item is a pipeline ID,
+            a range of IDs such as '23221-23240', '@<file>' for a file of items, or '-' for standard input.
+            Lines of a file starting with '#' are comments.
+
+    Raises:
+        ValueError: An item is not a pipeline ID, a range or a file.
+        OSError: A file could not be read.
+
+    Returns:
+        list: The pipeline IDs in the order given, without duplicates.
+    """
+    pipeline_ids = {}
+    for spec in specs:
+        for item in spec.replace(",", " ").split():
+            if item == "-":
+                pipeline_ids.update(dict.fromkeys(_pipeline_ids_in_text(sys.stdin.read())))
+            elif item.startswith("@"):
+                with open(item[1:]) as f:
+                    pipeline_ids.update(dict.fromkeys(_pipeline_ids_in_text(f.read())))
+            else:
+                pipeline_ids.update(dict.fromkeys(_pipeline_ids_in_item(item)))
+    if not pipeline_ids:
+        raise ValueError("No pipeline IDs given.")
+    return list(pipeline_ids)
+
+
+def _pipeline_ids_in_text(text: str):
+    """Pipeline IDs and ranges in the lines of a file. Files cannot refer to other files."""
+    for line in text.splitlines():
+        if line.strip().startswith("#"):
+            continue
+        for item in line.replace(",", " ").split():
+            yield from _pipeline_ids_in_item(item)
+
+
+def _pipeline_ids_in_item(item: str):
+    first, _, last = item.partition("-")
+    try:
+        first = int(first)
+        last = int(last) if last else first
+    except ValueError:
+        raise ValueError(f"'{item}' is not a pipeline ID or a range of pipeline IDs.") from None
+    if last < first:
+        raise ValueError(f"The range '{item}' ends before it starts.")
+    yield from range(first, last + 1)
+
+
 class ObjectDictNormalizer:
+    """Base of the compact records of normalized GitLab objects.
+
+    Each subclass maps GitLab API attributes to span attributes with flat_map and two_level_map.
+    The values are kept in slots named after the span attributes rather than in a dict per object,
+    and the values of the attributes listed in 'interned' are interned, e.g. stage and status, so
+    that thousands of jobs share one string per distinct value. Lists become tuples. The dict of
+    span attributes is built by the 'attributes' property when the span is started.
+    """
+
+    __slots__ = ("span_start", "span_end", "extra")
+    flat_map = []
+    two_level_map = []
+    # Span attributes with few distinct values, interned.
+    interned = frozenset()
+
+    def _set_attributes(self, gitlab_obj, extra_attrs: dict) -> None:
+        """Fill the slots with the mapped attributes of a GitLab object."""
+        for name, value in ObjectDictNormalizer.map_attributes(self.flat_map, self.two_level_map, gitlab_obj).items():
+            if name in self.interned:
+                if isinstance(value, str):
+                    value = sys.intern(value)
+                elif isinstance(value, list):
+                    value = tuple(sys.intern(item) if isinstance(item, str) else item for item in value)
+            elif isinstance(value, list):
+                value = tuple(value)
+            setattr(self, name, value)
+        # Span attributes beyond the mapped ones, e.g. from critical path analysis, or None.
+        self.extra = extra_attrs or None
+
+    def add_attributes(self, attributes: dict) -> None:
+        """Add key/value pairs to the span attributes."""
+        if self.extra is None:
+            self.extra = {}
+        self.extra.update(attributes)
+
+    @property
+    def attributes(self) -> dict:
+        """The span attributes, built from the slots. Changes to the dict are not kept, see add_attributes()."""
+        attributes = {item[0]: getattr(self, item[0]) for item in self.flat_map}
+        for item in self.two_level_map:
+            attributes[item[0]] = getattr(self, item[0])
+        if self.extra:
+            attributes.update(self.extra)
+        return attributes
+
     @staticmethod
     def map_attributes(flat_map: dict, nested_map: dict, gitlab_obj) -> dict:
         """Map attributes of a GitLab object to otel-compatible attributes dictionary.
@@ -278,17 +597,29 @@ class ObjectDictNormalizer:
         object_type = ObjectDictNormalizer.get_object_type_str(gitlab_obj)
         if not gitlab_obj.started_at and not gitlab_obj.finished_at:
             log.info(
-                "Appyling pipeline start time to missing "
-                f"started_at and finished_at times for {object_type} #{gitlab_obj.id}."
+                "Appyling pipeline start time to missing started_at and finished_at times for %s #%s.",
+                object_type,
+                gitlab_obj.id,
+                extra=SAMPLED,
             )
             gitlab_obj.started_at = pipeline_started_at
             gitlab_obj.finished_at = pipeline_started_at
         elif not gitlab_obj.started_at and gitlab_obj.finished_at:
-            log.info(f"Applying finished_at time for missing started_at time for {object_type} #{gitlab_obj.id}.")
+            log.info(
+                "Applying finished_at time for missing started_at time for %s #%s.",
+                object_type,
+                gitlab_obj.id,
+                extra=SAMPLED,
+            )
             gitlab_obj.started_at = gitlab_obj.finished_at
         elif not gitlab_obj.finished_at and gitlab_obj.started_at:
             # This has not been seen. Try to prevent an outlying data point in case it happens.
-            log.info(f"Applying started_at time for missing finished_at time for {object_type} #{gitlab_obj.id}.")
+            log.info(
+                "Applying started_at time for missing finished_at time for %s #%s.",
+                object_type,
+                gitlab_obj.id,
+                extra=SAMPLED,
+            )
             gitlab_obj.finished_at = gitlab_obj.started_at
 
         return (
@@ -302,6 +633,8 @@ class ObjectDictNormalizer:
         raw_type_str = str(type(gitlab_obj))
         if "ProjectPipelineJob" in raw_type_str:
             return "job"
+        elif "ProjectPipelineBridge" in raw_type_str:
+            return "bridge"
         elif "ProjectPipeline" in raw_type_str:
             return "pipeline"
         else:
@@ -321,6 +654,7 @@ class JobTraceData(ObjectDictNormalizer):
         ["stage", "stage", ""],
         ["started_at", "started_at", ""],
         ["status", "status", ""],
+        ["tag_list", "tag_list", []],
         ["web_url", "web_url", ""],
     ]
     # Each map item: [<trace label>, <GitLab API attribute>, <GitLab nested attribute>, <default value>]
@@ -330,6 +664,8 @@ class JobTraceData(ObjectDictNormalizer):
         ["runner_name", "runner", "name", ""],
         ["runner_description", "runner", "description", ""],
     ]
+    __slots__ = tuple(item[0] for item in flat_map + two_level_map)
+    interned = frozenset(["name", "ref", "stage", "status", "tag_list", "runner_name", "runner_description"])
 
     def __init__(self, gitlab_job, pipeline_started_at, **extra_attrs) -> None:
         """
@@ -339,14 +675,13 @@ class JobTraceData(ObjectDictNormalizer):
             **extra_attrs: Key/value pairs to be added to the attributes of a span.
         """
         self.span_start, self.span_end = ObjectDictNormalizer.map_spans(gitlab_job, pipeline_started_at)
-        self.attributes = ObjectDictNormalizer.map_attributes(self.flat_map, self.two_level_map, gitlab_job)
-
-        if extra_attrs:
-            self.attributes.update(extra_attrs)
+        self._set_attributes(gitlab_job, extra_attrs)
 
-        log.debug(
-            f"Job attributes generated: {self.attributes}, Times: span_start = {self.span_start}, span_end = {self.span_end}"
-        )
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(
+                "Job attributes generated.",
+                extra=fields(attributes=self.attributes, span_start=self.span_start, span_end=self.span_end),
+            )
 
 
 class PipelineTraceData(ObjectDictNormalizer):
@@ -367,6 +702,8 @@ class PipelineTraceData(ObjectDictNormalizer):
         ["user", "user", "name", ""],
         ["username", "user", "username", ""],
     ]
+    __slots__ = tuple(item[0] for item in flat_map + two_level_map) + ("project_name",)
+    interned = frozenset(["ref", "source", "status", "user", "username"])
 
     def __init__(self, gitlab_pipeline, project_name: str, **extra_attrs) -> None:
         """
@@ -375,13 +712,96 @@ class PipelineTraceData(ObjectDictNormalizer):
             project_name : The name of the project (Git repository) the pipeline ran in.
             **extra_attrs: Key/value pairs to be added to the attributes of a span.
         """
-        self.attributes = ObjectDictNormalizer.map_attributes(self.flat_map, self.two_level_map, gitlab_pipeline)
-        self.attributes["project_name"] = project_name
+        self._set_attributes(gitlab_pipeline, None)
+        self.project_name = project_name
         self.span_start, self.span_end = ObjectDictNormalizer.map_spans(gitlab_pipeline, gitlab_pipeline.started_at)
 
-        log.debug(
-            f"Pipeline attributes generated: {self.attributes}, Times: span_start = {self.span_start}, span_end = {self.span_end}"
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(
+                "Pipeline attributes generated.",
+                extra=fields(attributes=self.attributes, span_start=self.span_start, span_end=self.span_end),
+            )
+
+    @property
+    def attributes(self) -> dict:
+        """The span attributes, built from the slots. Changes to the dict are not kept, see add_attributes()."""
+        attributes = super().attributes
+        attributes["project_name"] = self.project_name
+        return attributes
+
+
+class PipelineIdGenerator:
+    """Generates trace and span IDs derived from a pipeline and its jobs.
+
+    The same pipeline always gets the same trace ID and pipeline span ID. Spans exported at
+    different times, even by different processes, therefore belong to the same trace.
+
+    The methods are those of the IdGenerator interface of the OpenTelemetry SDK. Other span
+    IDs are random, as with the RandomIdGenerator of the SDK.
+    """
+
+    def __init__(self, project_id: int, pipeline_id: int) -> None:
+        """
+        Args:
+            project_id (int): The ID of the project the pipeline ran in.
+            pipeline_id (int): The pipeline ID.
+        """
+        digest = hashlib.sha256(f"{GITLAB_URL}/projects/{project_id}/pipelines/{pipeline_id}".encode()).digest()
+        self.trace_id = int.from_bytes(digest[:16], "big")
+        self.pipeline_span_id = int.from_bytes(digest[16:24], "big")
+        self.next_span_id = None
+
+    def generate_trace_id(self) -> int:
+        return self.trace_id
+
+    def generate_span_id(self) -> int:
+        if self.next_span_id:
+            span_id, self.next_span_id = self.next_span_id, None
+            return span_id
+        # 0 is the invalid span ID.
+        return random.getrandbits(64) or 1
+
+    def job_span_id(self, job_id: int) -> int:
+        digest = hashlib.sha256(f"{self.trace_id}/jobs/{job_id}".encode()).digest()
+        return int.from_bytes(digest[:8], "big")
+
+    def pipeline_context(self) -> any:
+        """A context whose current span is the pipeline span, whether or not it was exported yet."""
+        from opentelemetry import trace
+        from opentelemetry.trace import NonRecordingSpan, SpanContext, TraceFlags
+
+        span_context = SpanContext(
+            trace_id=self.trace_id,
+            span_id=self.pipeline_span_id,
+            is_remote=False,
+            trace_flags=TraceFlags(TraceFlags.SAMPLED),
         )
+        return trace.set_span_in_context(NonRecordingSpan(span_context))
+
+
+class DownstreamPipeline:
+    """A pipeline triggered by a bridge job, with its jobs and its own downstream pipelines."""
+
+    def __init__(self, project, pipeline, jobs: list, bridges: list, depth: int) -> None:
+        """
+        Args:
+            project (Project): The GitLab project the pipeline ran in.
+            pipeline (ProjectPipeline): The downstream pipeline.
+            jobs (list): The jobs of the pipeline.
+            bridges (list): The bridge (trigger) jobs of the pipeline.
+            depth (int): 1 for pipelines triggered by the exported pipeline, 2 for the next level, etc.
+        """
+        self.project = project
+        self.pipeline = pipeline
+        self.jobs = jobs
+        self.bridges = bridges
+        self.depth = depth
+        # Bridge job ID -> DownstreamPipeline
+        self.children = {}
+        # The normalized data of the pipeline, its jobs and its bridges. See PipelineExporter._normalize_downstream().
+        self.span_data = None
+        self.job_span_datas = []
+        self.bridge_span_datas = []
 
 
 class TraceResourceData:
@@ -412,7 +832,7 @@ class TraceResourceData:
         }
         if extra_attrs:
             self.attributes.update(extra_attrs)
-        log.debug(f"Resource attributes generated: {self.attributes}")
+        log.debug("Resource attributes generated.", extra=fields(attributes=self.attributes))
 
 
 class PipelineExporter(GitlabProjectBase):
@@ -441,21 +861,48 @@ class PipelineExporter(GitlabProjectBase):
         group: str,
         project: str,
         access_token: str = "",
+        critical_path: bool = False,
+        metrics: bool = False,
+        downstream_depth: int = 0,
+        profiler=None,
+        self_tracer=None,
+        concurrency: int = 0,
     ) -> None:
         """
         Args:
             group (str): The name of a GitLab group.
             project (str): The name of a GitLab project (GitRepository).
             access_token (str): An access token for GitLab. The token must have "API" privileges.
+            critical_path (bool): Tag spans with the critical path of the pipeline and the slack time of each job.
+            metrics (bool): Export job and pipeline duration histograms to the trace endpoint after each trace.
+            downstream_depth (int): Levels of pipelines triggered by bridge jobs to nest in the trace.
+                0 leaves out bridge jobs and downstream pipelines.
+            profiler (PhaseProfiler, optional): Profiles the phases of each export. Defaults to no profiling.
+            self_tracer (SelfTracer, optional): Traces each export and its GitLab API requests to a service of
+                its own. Defaults to no self-tracing.
+            concurrency (int, optional): The most GitLab API requests in flight at the same time when pipelines
+                are prefetched, see prefetch(). Defaults to 0, no prefetching.
 
         Raises:
             RuntimeError: An error occurred during object initialization.
         """
-        super().__init__(group, project, access_token)
+        super().__init__(group, project, access_token, profiler, self_tracer, concurrency)
         self.pipeline = 0
-        self._have_trace_provider = False
-        log.debug(f"PipelineExporter initialized: {self}")
-
+        self.critical_path = critical_path
+        self.metrics = metrics
+        self.downstream_depth = downstream_depth
+        # (kind, endpoint) -> span or metric exporter shared by the traces sent to the endpoint.
+        self._exporters = {}
+        # Pipeline ID -> DownstreamPipeline of depth 0 retrieved by prefetch() and not exported yet.
+        self._prefetched = {}
+        # Pipeline ID -> the schedule that launched it, once retrieved by prefetch().
+        self._schedules = None
+        # The writer of the metric data points, and the start of the next one. See _export_metrics().
+        self._metrics_instance_id = os.urandom(8).hex()
+        self._metrics_start_ns = time.time_ns()
+        log.debug("PipelineExporter initialized: %s", self)
+
+    @traced("pipeline_id", "endpoint")
     def generate_trace(self, pipeline_id: int, endpoint: str = DEFAULT_GRPC_ENDPOINT, **extra_attrs):
         """Builds a trace from a CI pipeline in GitLab. The parent span represents the pipeline
         itself. A child span is created for each job ran during pipeline execution.
@@ -471,65 +918,523 @@ class PipelineExporter(GitlabProjectBase):
             RuntimeError: The exception is raised if an operation fails in the preparation or
             delivery of the trace. Context in provided in the exception string.
         """
-        self.pipeline = self._retrieve_pipeline(pipeline_id)
-        log.info(
-            f"Sending trace: project='{self.project.name}', ref='{self.pipeline.ref}', pipeline={self.pipeline.id} to {endpoint}."
-        )
-        log.debug(f"Retrieved pipeline from GitLab: {self.pipeline.asdict()}")
-
-        if self.pipeline.source == "schedule":
-            schedule = self._find_pipeline_schedule(pipeline_id)
+        with self._phase("fetch", pipeline_id=pipeline_id):
+            prefetched = self._prefetched.pop(pipeline_id, None)
+            self.pipeline = prefetched.pipeline if prefetched else self._retrieve_pipeline(pipeline_id)
+            log.info(
+                f"Sending trace: project='{self.project.name}', ref='{self.pipeline.ref}', pipeline={self.pipeline.id} to {endpoint}."
+            )
+            log.debug("Retrieved pipeline from GitLab.", extra=fields(pipeline=lazy(self.pipeline.asdict)))
+            self._add_schedule_attrs(pipeline_id, extra_attrs)
 
-            if schedule:
-                log.info(f"Schedule found for pipeline {pipeline_id}: {schedule}")
-                extra_attrs["schedule_id"] = schedule.id
-                # There is no 'name' attribute on GitLab schedule objects so 'description' is used.
-                extra_attrs["schedule_description"] = schedule.description
-                log.debug(f"Schedule information added to spans.")
+            if prefetched:
+                jobs, bridges, downstream = prefetched.jobs, prefetched.bridges, prefetched.children
             else:
-                log.warning(f"Schedule not found for pipeline {pipeline_id}. The schedule may have been deleted.")
-
-        pipeline_resources = TraceResourceData(self.group, self.project, self.pipeline, **extra_attrs)
-        if endpoint == "console":
-            tracer = self._get_console_tracer(pipeline_resources)
-        else:
-            tracer = self._get_grpc_tracer(pipeline_resources, endpoint)
+                jobs = self.pipeline.jobs.list(get_all=True)
+                bridges = self.pipeline.bridges.list(get_all=True) if self.downstream_depth > 0 else []
+                downstream = self._retrieve_downstream(bridges)
+            critical_path = self._find_critical_path(jobs + bridges) if self.critical_path else None
+
+        with self._phase("normalize"):
+            pipeline_resources = TraceResourceData(self.group, self.project, self.pipeline, **extra_attrs)
+            # The pipeline provides context that will be inherited by its jobs.
+            pipeline_span_data = PipelineTraceData(self.pipeline, self.project.name, **extra_attrs)
+            if critical_path:
+                pipeline_span_data.add_attributes(critical_path.pipeline_attributes())
+            job_span_datas = []
+            for job in jobs:
+                job_attrs = critical_path.job_attributes(job.name) if critical_path else {}
+                job_span_datas.append(JobTraceData(job, self.pipeline.started_at, **job_attrs))
+            bridge_span_datas = []
+            for bridge in bridges:
+                job_attrs = critical_path.job_attributes(bridge.name) if critical_path else {}
+                bridge_span_datas.append(JobTraceData(bridge, self.pipeline.started_at, **job_attrs))
+            for child in downstream.values():
+                self._normalize_downstream(child)
+        with self._phase("export_flush"):
+            provider = self._tracer_provider(pipeline_resources, endpoint)
+        tracer = provider.get_tracer(__name__)
+        try:
+            with self._phase("span_build"), tracer.start_as_current_span(
+                f"pipeline-{self.pipeline.id}",
+                start_time=pipeline_span_data.span_start,
+                attributes=pipeline_span_data.attributes,
+                end_on_exit=False,
+            ) as pipeline_span:
+                pipeline_span.set_attribute("started_at_nano", pipeline_span_data.span_start)
+                pipeline_span.set_attribute("finished_at_nano", pipeline_span_data.span_end)
+                log.debug(
+                    "Pipeline span started.",
+                    extra=fields(
+                        span_start=pipeline_span_data.span_start,
+                        span_end=pipeline_span_data.span_end,
+                        span=lazy(pipeline_span.to_json),
+                    ),
+                )
+
+                for job_span_data in job_span_datas:
+                    self._add_job_span(tracer, job_span_data)
+                for bridge, bridge_span_data in zip(bridges, bridge_span_datas):
+                    self._add_job_span(tracer, bridge_span_data, downstream.get(bridge.id))
+                pipeline_span.end(pipeline_span_data.span_end)
+                log.info(
+                    f"Sent trace: project='{self.project.name}', ref='{self.pipeline.ref}', pipeline={self.pipeline.id} to {endpoint}."
+                )
+        finally:
+            # Sends the spans. The connection to the endpoint stays open for the next trace.
+            with self._phase("export_flush"):
+                provider.shutdown()
+
+        if self.metrics:
+            with self._phase("export_flush"):
+                self._export_metrics(pipeline_span_data, job_span_datas, endpoint)
+
+    def _add_job_span(self, tracer, job_span_data: JobTraceData, downstream=None) -> None:
+        """Add a span for a job, or a bridge job and the downstream pipeline it triggered, to the current span.
 
-        # The pipeline provides context that will be inherited by its jobs.
-        pipeline_span_data = PipelineTraceData(self.pipeline, self.project.name, **extra_attrs)
+        Args:
+            tracer (Tracer): The tracer of the trace being built.
+            job_span_data (JobTraceData): The normalized data of the job.
+            downstream (DownstreamPipeline, optional): The pipeline triggered by a bridge job, normalized by
+              _normalize_downstream().
+        """
         with tracer.start_as_current_span(
-            f"pipeline-{self.pipeline.id}",
+            job_span_data.name,
+            start_time=job_span_data.span_start,
+            attributes=job_span_data.attributes,
+            end_on_exit=False,
+        ) as job_span:
+            if downstream:
+                self._add_downstream_spans(tracer, downstream)
+            job_span.end(job_span_data.span_end)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(
+                    "Job span ended.",
+                    extra=fields(
+                        span_start=job_span_data.span_start,
+                        span_end=job_span_data.span_end,
+                        span=lazy(job_span.to_json),
+                    ),
+                )
+
+    def _normalize_downstream(self, downstream: DownstreamPipeline) -> None:
+        """Normalize the data of a downstream pipeline, its jobs, and the pipelines it triggered."""
+        pipeline = downstream.pipeline
+        downstream.span_data = PipelineTraceData(pipeline, downstream.project.name)
+        downstream.span_data.add_attributes({"downstream_depth": downstream.depth})
+        downstream.job_span_datas = [JobTraceData(job, pipeline.started_at) for job in downstream.jobs]
+        downstream.bridge_span_datas = [JobTraceData(bridge, pipeline.started_at) for bridge in downstream.bridges]
+        for child in downstream.children.values():
+            self._normalize_downstream(child)
+
+    def _add_downstream_spans(self, tracer, downstream: DownstreamPipeline) -> None:
+        """Add a span for a downstream pipeline, and spans for its jobs, to the current (bridge job) span."""
+        pipeline_span_data = downstream.span_data
+        with tracer.start_as_current_span(
+            f"pipeline-{downstream.pipeline.id}",
             start_time=pipeline_span_data.span_start,
             attributes=pipeline_span_data.attributes,
             end_on_exit=False,
-        ):
-            pipeline_span = trace.get_current_span()
-            pipeline_span.set_attribute("started_at_nano", pipeline_span_data.span_start)
-            pipeline_span.set_attribute("finished_at_nano", pipeline_span_data.span_end)
-            log.debug(
-                f"pipeline_span: span time = {{span_start: {pipeline_span_data.span_start}, "
-                f"span_end: {pipeline_span_data.span_end}}}\n span data = {pipeline_span.to_json()}"
-            )
+        ) as pipeline_span:
+            for job_span_data in downstream.job_span_datas:
+                self._add_job_span(tracer, job_span_data)
+            for bridge, bridge_span_data in zip(downstream.bridges, downstream.bridge_span_datas):
+                self._add_job_span(tracer, bridge_span_data, downstream.children.get(bridge.id))
+            pipeline_span.end(pipeline_span_data.span_end)
 
-            jobs = self.pipeline.jobs.list()
-            for job in jobs:
-                job_span_data = JobTraceData(job, self.pipeline.started_at)
-                with tracer.start_as_current_span(
+    def prefetch(self, pipeline_ids: list) -> None:
+        """Retrieve pipelines concurrently ahead of generate_trace().
+
+        The pipelines, their jobs and bridge jobs, their downstream pipelines and the schedules of
+        the project are retrieved with up to 'concurrency' GitLab API requests in flight. Each
+        prefetched pipeline is kept until its trace is generated, so prefetch a batch at a time.
+        Pipelines that cannot be prefetched are retrieved by generate_trace() as usual.
+        Nothing is prefetched when the concurrency is 0.
+
+        Prefetching only saves time, so it never raises. A failure of the whole batch is logged.
+
+        Args:
+            pipeline_ids (list): The IDs of the pipelines to be exported next.
+        """
+        if not self.async_gitlab:
+            return
+        try:
+            with self._phase("fetch", pipelines=len(pipeline_ids)):
+                fetched = self.async_gitlab.run(self._fetch_pipelines, pipeline_ids)
+        except Exception:
+            log.exception(f"Prefetch of {len(pipeline_ids)} pipelines failed. They are retrieved one at a time.")
+            return
+        for pipeline_id, result in zip(pipeline_ids, fetched):
+            if isinstance(result, Exception):
+                log.warning(f"Pipeline {pipeline_id} not prefetched: {result}")
+            else:
+                self._prefetched[pipeline_id] = result
+
+    async def _fetch_pipelines(self, pipeline_ids: list) -> list:
+        """The DownstreamPipeline of depth 0, or the exception raised, for each pipeline ID."""
+        import asyncio
+
+        fetched = await asyncio.gather(
+            *(self._fetch_pipeline(self.project, pipeline_id, 0) for pipeline_id in pipeline_ids),
+            return_exceptions=True,
+        )
+        scheduled = any(
+            not isinstance(result, Exception) and result.pipeline.source == "schedule" for result in fetched
+        )
+        if scheduled and self._schedules is None:
+            try:
+                self._schedules = await self._fetch_schedules()
+            except RuntimeError as e:
+                log.warning(f"Schedules not prefetched: {e}")
+        return fetched
+
+    async def _fetch_pipeline(self, project, pipeline_id: int, depth: int) -> DownstreamPipeline:
+        """Retrieve a pipeline with its jobs and bridge jobs, and its downstream pipelines down to the
+        configured depth. Downstream pipelines that cannot be retrieved are logged and left out.
+        """
+        import asyncio
+
+        from gitlab.v4.objects import ProjectPipeline, ProjectPipelineBridge, ProjectPipelineJob
+
+        path = f"/projects/{project.id}/pipelines/{pipeline_id}"
+        reads = [self.async_gitlab.get(path), self.async_gitlab.list(f"{path}/jobs")]
+        if depth < self.downstream_depth:
+            reads.append(self.async_gitlab.list(f"{path}/bridges"))
+        pipeline_attrs, job_attrs, *bridge_attrs = await asyncio.gather(*reads)
+
+        pipeline = ProjectPipeline(project.pipelines, pipeline_attrs)
+        jobs = [ProjectPipelineJob(pipeline.jobs, attrs) for attrs in job_attrs]
+        bridges = [ProjectPipelineBridge(pipeline.bridges, attrs) for attrs in bridge_attrs[0]] if bridge_attrs else []
+        fetched = DownstreamPipeline(project, pipeline, jobs, bridges, depth)
+
+        # The trigger of bridge jobs without a downstream pipeline failed or has not created it yet.
+        triggers = [bridge for bridge in bridges if bridge.downstream_pipeline]
+        children = await asyncio.gather(
+            *(self._fetch_downstream(bridge, depth + 1) for bridge in triggers), return_exceptions=True
+        )
+        for bridge, child in zip(triggers, children):
+            if isinstance(child, Exception):
+                log.warning(f"Downstream pipeline left out of the trace: {child}")
+            else:
+                fetched.children[bridge.id] = child
+        return fetched
+
+    async def _fetch_downstream(self, bridge, depth: int) -> DownstreamPipeline:
+        from gitlab.v4.objects import Project
+
+        downstream_info = bridge.downstream_pipeline
+        try:
+            # Full objects come from 'get' rather than 'list' operations. The name is needed for spans.
+            project_attrs = await self.async_gitlab.get(f"/projects/{downstream_info['project_id']}")
+            project = Project(self.gl_client.projects, project_attrs)
+            downstream = await self._fetch_pipeline(project, downstream_info["id"], depth)
+        except RuntimeError as e:
+            raise RuntimeError(
+                f"Could not retrieve downstream pipeline {downstream_info['id']} of bridge job {bridge.id}: {e}"
+            ) from e
+        log.info(
+            f"Retrieved downstream pipeline {downstream.pipeline.id} of '{project.name}' "
+            f"triggered by bridge job '{bridge.name}'."
+        )
+        return downstream
+
+    async def _fetch_schedules(self) -> dict:
+        """Pipeline ID -> the schedule of the project that launched the pipeline."""
+        import asyncio
+
+        from gitlab.v4.objects import ProjectPipelineSchedule
+
+        path = f"/projects/{self.project.id}/pipeline_schedules"
+        schedule_attrs = await self.async_gitlab.list(path)
+        schedules = [ProjectPipelineSchedule(self.project.pipelineschedules, attrs) for attrs in schedule_attrs]
+        pipeline_lists = await asyncio.gather(
+            *(self.async_gitlab.list(f"{path}/{schedule.id}/pipelines") for schedule in schedules)
+        )
+        return {
+            pipeline["id"]: schedule for schedule, pipelines in zip(schedules, pipeline_lists) for pipeline in pipelines
+        }
+
+    def _retrieve_downstream(self, bridges: list) -> dict:
+        """Retrieve the pipelines triggered by bridge jobs, down to the configured depth.
+
+        Each downstream pipeline is retrieved by a worker thread as soon as the bridge job that
+        triggered it is known, so the round trips to GitLab overlap rather than run in sequence.
+        Downstream pipelines that cannot be retrieved are logged and left out of the trace.
+
+        Args:
+            bridges (list): The bridge jobs of the exported pipeline.
+
+        Returns:
+            dict: Bridge job ID to DownstreamPipeline for the bridge jobs of the exported pipeline.
+        """
+        top_level = {}
+        projects = {}
+
+        def retrieve(bridge, depth: int) -> DownstreamPipeline:
+            downstream_info = bridge.downstream_pipeline
+            project_id = downstream_info["project_id"]
+            try:
+                if project_id not in projects:
+                    # Full objects come from 'get' rather than 'list' operations. The name is needed for spans.
+                    projects[project_id] = self.gl_client.projects.get(project_id)
+                project = projects[project_id]
+                pipeline = project.pipelines.get(downstream_info["id"])
+                jobs = pipeline.jobs.list(get_all=True)
+                child_bridges = pipeline.bridges.list(get_all=True) if depth < self.downstream_depth else []
+            except gitlab.exceptions.GitlabError as e:
+                raise RuntimeError(
+                    f"Could not retrieve downstream pipeline {downstream_info['id']} of bridge job {bridge.id}: "
+                    f"{e.error_message}"
+                ) from e
+            return DownstreamPipeline(project, pipeline, jobs, child_bridges, depth)
+
+        with ThreadPoolExecutor(max_workers=DOWNSTREAM_WORKERS) as executor:
+            # Future -> (bridge job, DownstreamPipeline of the bridge job or None for the exported pipeline)
+            pending = {}
+
+            def submit(bridge_jobs: list, parent, depth: int) -> None:
+                for bridge in bridge_jobs:
+                    if not bridge.downstream_pipeline:
+                        # The trigger failed or has not created the downstream pipeline yet.
+                        continue
+                    # The context carries the current span of a SelfTracer into the worker thread.
+                    future = executor.submit(contextvars.copy_context().run, retrieve, bridge, depth)
+                    pending[future] = (bridge, parent)
+
+            submit(bridges, None, 1)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    bridge, parent = pending.pop(future)
+                    try:
+                        downstream = future.result()
+                    except RuntimeError as e:
+                        log.warning(f"Downstream pipeline left out of the trace: {e}")
+                        continue
+                    log.info(
+                        f"Retrieved downstream pipeline {downstream.pipeline.id} of '{downstream.project.name}' "
+                        f"triggered by bridge job '{bridge.name}'."
+                    )
+                    if parent:
+                        parent.children[bridge.id] = downstream
+                    else:
+                        top_level[bridge.id] = downstream
+                    submit(downstream.bridges, downstream, downstream.depth + 1)
+
+        return top_level
+
+    @traced("pipeline_id", "endpoint")
+    def follow_pipeline(
+        self,
+        pipeline_id: int,
+        endpoint: str = DEFAULT_GRPC_ENDPOINT,
+        poll_interval: float = DEFAULT_POLL_SECONDS,
+        **extra_attrs,
+    ):
+        """Builds a trace from a CI pipeline while the pipeline runs.
+
+        GitLab is polled for jobs that have finished since the previous poll. A span is exported
+        for each finished job right away. The pipeline span is exported once the pipeline completes,
+        along with spans for jobs that never ran, e.g. manual jobs. The method returns then.
+
+        Args:
+            pipeline_id (int): The ID of a pipeline that is running or completed.
+            endpoint (str, optional): 'console' or the URL of a GRPC endpoint. Defaults to DEFAULT_GRPC_ENDPOINT.
+            poll_interval (float, optional): Seconds between polls of GitLab. Defaults to DEFAULT_POLL_SECONDS.
+            **extra_attrs (dict): Key/value pairs to be added to the attributes and resources of all spans.
+
+        Raises:
+            RuntimeError: The exception is raised if an operation fails in the preparation or
+            delivery of the trace. Context in provided in the exception string.
+        """
+        with self._phase("fetch", pipeline_id=pipeline_id):
+            self.pipeline = self._retrieve_pipeline(pipeline_id)
+            log.info(f"Following pipeline: project='{self.project.name}', pipeline={self.pipeline.id}, to {endpoint}.")
+            self._add_schedule_attrs(pipeline_id, extra_attrs)
+
+        id_generator = PipelineIdGenerator(self.project.id, self.pipeline.id)
+        pipeline_resources = TraceResourceData(self.group, self.project, self.pipeline, **extra_attrs)
+        provider = self._tracer_provider(pipeline_resources, endpoint, id_generator)
+        tracer = provider.get_tracer(__name__)
+
+        exported_job_ids = set()
+        job_span_datas = []
+
+        def export_jobs(jobs: list, finished_only: bool) -> None:
+            pipeline_started_at = self.pipeline.started_at or self.pipeline.created_at
+            jobs = [
+                job
+                for job in jobs
+                if job.id not in exported_job_ids and (not finished_only or job.status in FINISHED_STATUSES)
+            ]
+            with self._phase("normalize"):
+                new_span_datas = [JobTraceData(job, pipeline_started_at) for job in jobs]
+            for job, job_span_data in zip(jobs, new_span_datas):
+                id_generator.next_span_id = id_generator.job_span_id(job.id)
+                job_span = tracer.start_span(
                     job.name,
+                    context=id_generator.pipeline_context(),
                     start_time=job_span_data.span_start,
                     attributes=job_span_data.attributes,
-                    end_on_exit=False,
-                ):
-                    job_span = trace.get_current_span()
-                    job_span.end(job_span_data.span_end)
-                    log.debug(
-                        f"job span: span time = {{span_start: {job_span_data.span_start}, "
-                        f"span_end: {job_span_data.span_end}}}\n span data = {job_span.to_json()}"
-                    )
+                )
+                job_span.end(job_span_data.span_end)
+                exported_job_ids.add(job.id)
+                job_span_datas.append(job_span_data)
+                log.info(
+                    "Exported span for job '%s' (%s) of pipeline %s.",
+                    job.name,
+                    job.status,
+                    self.pipeline.id,
+                    extra=SAMPLED,
+                )
+
+        try:
+            while True:
+                with self._phase("fetch"):
+                    jobs = self.pipeline.jobs.list(get_all=True)
+                with self._phase("span_build"):
+                    export_jobs(jobs, finished_only=True)
+                with self._phase("export_flush"):
+                    provider.force_flush()
+
+                if self.pipeline.status in FINISHED_STATUSES:
+                    break
+                time.sleep(poll_interval)
+                with self._phase("fetch"):
+                    self.pipeline = self._retrieve_pipeline(pipeline_id)
+
+            with self._phase("span_build"):
+                export_jobs(jobs, finished_only=False)
+            pipeline_span_data = PipelineTraceData(self.pipeline, self.project.name, **extra_attrs)
+            if self.critical_path:
+                critical_path = self._find_critical_path(jobs)
+                if critical_path:
+                    pipeline_span_data.add_attributes(critical_path.pipeline_attributes())
+            id_generator.next_span_id = id_generator.pipeline_span_id
+            pipeline_span = tracer.start_span(
+                f"pipeline-{self.pipeline.id}",
+                start_time=pipeline_span_data.span_start,
+                attributes=pipeline_span_data.attributes,
+            )
+            pipeline_span.set_attribute("started_at_nano", pipeline_span_data.span_start)
+            pipeline_span.set_attribute("finished_at_nano", pipeline_span_data.span_end)
             pipeline_span.end(pipeline_span_data.span_end)
-            log.info(
-                f"Sent trace: project='{self.project.name}', ref='{self.pipeline.ref}', pipeline={self.pipeline.id} to {endpoint}."
+        finally:
+            with self._phase("export_flush"):
+                provider.shutdown()
+
+        log.info(
+            f"Sent trace: project='{self.project.name}', ref='{self.pipeline.ref}', pipeline={self.pipeline.id} to {endpoint}."
+        )
+        if self.metrics:
+            with self._phase("export_flush"):
+                self._export_metrics(pipeline_span_data, job_span_datas, endpoint)
+
+    def _add_schedule_attrs(self, pipeline_id: int, extra_attrs: dict) -> None:
+        """Add the schedule that launched the current pipeline, if any, to the span attributes."""
+        if self.pipeline.source != "schedule":
+            return
+
+        schedule = self._find_pipeline_schedule(pipeline_id)
+        if schedule:
+            log.info(f"Schedule found for pipeline {pipeline_id}: {schedule}")
+            extra_attrs["schedule_id"] = schedule.id
+            # There is no 'name' attribute on GitLab schedule objects so 'description' is used.
+            extra_attrs["schedule_description"] = schedule.description
+            log.debug(f"Schedule information added to spans.")
+        else:
+            log.warning(f"Schedule not found for pipeline {pipeline_id}. The schedule may have been deleted.")
+
+    def _export_metrics(self, pipeline_span_data: PipelineTraceData, job_span_datas: list, endpoint: str) -> None:
+        """Export duration histograms for the current pipeline and its jobs.
+
+        Each histogram data point is a delta covering the time since the previous export of this
+        exporter, ending now. Stamping the points with the run time of the pipeline instead would
+        make the points of overlapping pipelines overlap in the same series, and backends reject
+        points of backfilled pipelines as too old. Job histograms are keyed by stage, status,
+        runner and ref. The pipeline histogram is keyed by source and ref.
+
+        Args:
+            pipeline_span_data (PipelineTraceData): The normalized pipeline data.
+            job_span_datas (list): The normalized data (JobTraceData) of each job.
+            endpoint (str): 'console' or the URL of a GRPC endpoint.
+
+        Raises:
+            RuntimeError: The metrics could not be exported.
+        """
+        from trace_utils import otlp_metrics
+
+        # The next delta starts where this one ends, so the points of this writer never overlap.
+        start_ns = self._metrics_start_ns
+        end_ns = max(time.time_ns(), start_ns + 1)
+        self._metrics_start_ns = end_ns
+
+        job_durations = defaultdict(list)
+        queued_durations = defaultdict(list)
+        for job_span_data in job_span_datas:
+            key = (
+                job_span_data.stage,
+                job_span_data.status,
+                job_span_data.runner_description or job_span_data.runner_name or "none",
+                job_span_data.ref,
             )
+            job_durations[key].append((job_span_data.span_end - job_span_data.span_start) / 10**9)
+            queued_durations[key].append(float(job_span_data.queued_duration or 0))
+
+        def job_points(durations: dict) -> list:
+            return [
+                ({"stage": stage, "status": status, "runner": runner, "ref": ref}, start_ns, end_ns, values)
+                for (stage, status, runner, ref), values in durations.items()
+            ]
+
+        pipeline_points = [
+            (
+                {"source": pipeline_span_data.source, "ref": pipeline_span_data.ref},
+                start_ns,
+                end_ns,
+                [(pipeline_span_data.span_end - pipeline_span_data.span_start) / 10**9],
+            )
+        ]
+
+        metrics = [
+            otlp_metrics.histogram_metric("ci.job.duration", "Run time of CI jobs.", "s", job_points(job_durations)),
+            otlp_metrics.histogram_metric(
+                "ci.job.queued_duration", "Time CI jobs waited for a runner.", "s", job_points(queued_durations)
+            ),
+            otlp_metrics.histogram_metric("ci.pipeline.duration", "Run time of CI pipelines.", "s", pipeline_points),
+        ]
+        # Per-pipeline values such as the pipeline ID stay out of the resource to keep metric cardinality low.
+        resource_attributes = {
+            "service.name": f"{self.project.name}-pipeline",
+            "gitlab_group": self.group.name,
+            "gitlab_project": self.project.name,
+            # Exporters run in parallel, e.g. in CI jobs and backfill processes, write separate delta series.
+            "service.instance.id": self._metrics_instance_id,
+        }
+        if ("metric", endpoint) not in self._exporters:
+            self._exporters[("metric", endpoint)] = otlp_metrics.metric_exporter(endpoint)
+        otlp_metrics.export_metrics(metrics, resource_attributes, endpoint, self._exporters[("metric", endpoint)])
+
+    def _find_critical_path(self, jobs: list) -> any:
+        """Analyze the job graph of the current pipeline.
+
+        The analysis enriches the trace but is not required for it. Failures are logged
+        and the trace is exported without critical path attributes.
+
+        Args:
+            jobs (list): The GitLab job objects of the pipeline.
+
+        Returns:
+            A CriticalPath object, or None if the analysis failed.
+        """
+        try:
+            critical_path = critical_path_for_jobs(self.gl_client, self.project, self.pipeline, jobs)
+        except RuntimeError as e:
+            log.warning(f"Critical path analysis failed for pipeline {self.pipeline.id}: {e}")
+            return None
+
+        log.info(f"Critical path for pipeline {self.pipeline.id}: {critical_path}")
+        return critical_path
 
     def _find_pipeline_schedule(self, pipeline_id: int) -> any:
         """Locate the schedule used to launch a CI pipeline.
@@ -550,6 +1455,9 @@ class PipelineExporter(GitlabProjectBase):
         Returns:
             A GitLab schedule object is returned when a match is found. Otherwise, None.
         """
+        if self._schedules and pipeline_id in self._schedules:
+            return self._schedules[pipeline_id]
+
         try:
             schedules = self.project.pipelineschedules.list(get_all=True)
         except gitlab.exceptions.GitlabError as e:
@@ -560,10 +1468,10 @@ class PipelineExporter(GitlabProjectBase):
         # locate the pipeline ID in a schedule instance.
         sched_for_pipeline = None
         for schedule in schedules:
-            log.debug(f"Processing schedule: {schedule}")
+            log.debug("Processing schedule: %s", schedule)
             sched_pipelines = schedule.pipelines.list(get_all=True, iterator=True)
             sched_pipeline_ids = [p.id for p in sched_pipelines]
-            log.debug(f"Pipelines for schedule: {sched_pipeline_ids}")
+            log.debug("Pipelines for schedule: %s", sched_pipeline_ids)
 
             if pipeline_id in sched_pipeline_ids:
                 sched_for_pipeline = schedule
@@ -574,54 +1482,40 @@ class PipelineExporter(GitlabProjectBase):
         else:
             return None
 
-    def _get_console_tracer(self, pipeline_resources: PipelineTraceData) -> any:
-        """Initialize an OpenTelemetry Tracer object that sends a trace to the console.
+    def _tracer_provider(self, pipeline_resources: TraceResourceData, endpoint: str, id_generator=None) -> any:
+        """Initialize an OpenTelemetry TracerProvider object for the trace of one pipeline.
 
         Data from the the pipeline is applied to attributes in the Resource of the
-        TracerProvider. The resource attributes are propagated to all spans.
+        TracerProvider. The resource attributes are propagated to all spans. Each trace gets
+        a provider of its own so that the resource attributes and pinned IDs of one pipeline
+        stay away from traces of other pipelines. The providers share the span exporter of
+        the endpoint. Shut the provider down to send the spans.
 
         Args:
-            pipeline_resources (_type_): Important key/value pairs including from
-            the relevant group, project, and pipeline.
+            pipeline_resources (TraceResourceData): Important key/value pairs including from
+                the relevant group, project, and pipeline.
+            endpoint (str): 'console' or the URL of a GRPC endpoint.
+            id_generator (PipelineIdGenerator, optional): Generates the trace and span IDs. Defaults to random IDs.
 
         Returns:
-            A Tracer object from the OpenTelemetry API
+            A TracerProvider object from the OpenTelemetry SDK
         """
-        processor = SimpleSpanProcessor(ConsoleSpanExporter())
-        resource = Resource(attributes=pipeline_resources.attributes)
-        provider = TracerProvider(resource=resource)
-        provider.add_span_processor(processor)
-        if not self._have_trace_provider:
-            # The Provider is set once. Avoid logged warnings by not violating the otel module's paradigm.
-            trace.set_tracer_provider(provider)
-            self._have_trace_provider = True
-
-        return trace.get_tracer(__name__)
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
 
-    def _get_grpc_tracer(self, pipeline_resources, endpoint):
-        """Initialize an OpenTelemetry Tracer object compatible with a GRPC endpoint.
+        if ("span", endpoint) not in self._exporters:
+            self._exporters[("span", endpoint)] = _span_exporter(endpoint)
 
-        Data from the the pipeline is applied to attributes in the Resource of the
-        TracerProvider. The resource attributes are propagated to all spans.
-
-        Args:
-            pipeline_resources (_type_): Important key/value pairs including from
-            the relevant group, project, and pipeline.
-
-        Returns:
-            A Tracer object from the OpenTelemetry API
-        """
-        if not self._have_trace_provider:
-            # The Provider is set once. Avoid logged warnings by not violating the otel module's paradigm.
-            resource = Resource(attributes=pipeline_resources.attributes)
-            trace.set_tracer_provider(TracerProvider(resource=resource))
-            self._have_trace_provider = True
-
-        otlp_exporter = OTLPSpanExporter(endpoint=endpoint)
-        span_processor = BatchSpanProcessor(otlp_exporter)
-        trace.get_tracer_provider().add_span_processor(span_processor)
+        resource = Resource(attributes=pipeline_resources.attributes)
+        provider = TracerProvider(resource=resource, id_generator=id_generator)
+        provider.add_span_processor(_span_processor(endpoint, SharedSpanExporter(self._exporters[("span", endpoint)])))
+        return provider
 
-        return trace.get_tracer(__name__)
+    def close(self) -> None:
+        """Shut down the exporters shared by the traces sent so far."""
+        for exporter in self._exporters.values():
+            exporter.shutdown()
+        self._exporters.clear()
 
     def _retrieve_pipeline(self, pipeline_id: int):
         """Retrieve the GitLab pipeline object for the given group name.
@@ -639,7 +1533,7 @@ class PipelineExporter(GitlabProjectBase):
         log.info(f"Retrieving pipeline #{pipeline_id}.")
         try:
             pipeline = self.project.pipelines.get(pipeline_id)
-            log.debug(f"Pipeline retrieved: {pipeline}.")
+            log.debug("Pipeline retrieved: %s.", pipeline)
         except gitlab.exceptions.GitlabError as e:
             raise RuntimeError(f"Could not retrieve pipeline {pipeline_id}: {e.error_message}") from e
 
@@ -660,5 +1554,56 @@ class PipelineExporter(GitlabProjectBase):
         return ", ".join(attrs)
 
 
+class SharedSpanExporter:
+    """Lets the span processors of several TracerProviders send spans through one exporter.
+
+    A span processor shuts its exporter down when its provider shuts down. For a shared
+    exporter that only flushes the spans. The owner of the exporter shuts it down.
+    """
+
+    def __init__(self, exporter) -> None:
+        """
+        Args:
+            exporter (SpanExporter): The exporter to share.
+        """
+        self.exporter = exporter
+
+    def export(self, spans) -> any:
+        return self.exporter.export(spans)
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return self.exporter.force_flush(timeout_millis)
+
+    def shutdown(self) -> None:
+        self.exporter.force_flush()
+
+
+def _span_exporter(endpoint: str) -> any:
+    """A span exporter for the console or a GRPC endpoint. Only the exporter for the type of endpoint is imported."""
+    if endpoint == "console":
+        from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+
+        return ConsoleSpanExporter()
+
+    from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+
+    return OTLPSpanExporter(endpoint=endpoint)
+
+
+def _span_processor(endpoint: str, exporter=None) -> any:
+    """A span processor sending spans to the console or to a GRPC endpoint.
+
+    Args:
+        endpoint (str): 'console' or the URL of a GRPC endpoint.
+        exporter (SpanExporter, optional): The exporter for the endpoint. Defaults to a new exporter.
+    """
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, SimpleSpanProcessor
+
+    exporter = exporter or _span_exporter(endpoint)
+    if endpoint == "console":
+        return SimpleSpanProcessor(exporter)
+    return BatchSpanProcessor(exporter)
+
+
 if __name__ == "__main__":
     sys.exit(main())
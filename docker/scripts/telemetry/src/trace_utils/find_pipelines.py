@@ -23,6 +23,7 @@ is in that virtual environment. A filesystem path is not specified:
 
 find_pipelines -h
 usage: find_pipelines [-h] --group GROUP --project PROJECT --start-date START_DATE --end-date END_DATE
+                      [--profile DIRECTORY] [--self-trace ENDPOINT] [--concurrency CONCURRENCY]
 
 Find completed pipelines for a GitLab project that executed between two dates.
 
@@ -33,6 +34,10 @@ optional arguments:
   --start-date START_DATE
                         The earliest execution date of a pipeline.
   --end-date END_DATE   The latest execution date of a pipeline.
+  --profile DIRECTORY   Profile the phases of the search. Writes DIRECTORY/<phase>.prof and prints the hot functions.
+  --self-trace ENDPOINT Trace the search, including every GitLab API request, to 'console' or a GRPC endpoint.
+  --concurrency CONCURRENCY
+                        Retrieve this many pages of pipelines at the same time.
 
 
 """
@@ -45,7 +50,8 @@ from datetime import datetime, timezone
 from dateutil.parser import parse
 
 from trace_utils.base_logger import get_logger
-from trace_utils.gitlab_common import GitlabProjectBase
+from trace_utils.gitlab_common import GitlabProjectBase, traced
+from trace_utils.profiling import PhaseProfiler, report
 
 log = get_logger(__name__)
 
@@ -55,16 +61,31 @@ def main() -> int:
     if args.debug:
         log.setLevel(logging.DEBUG)
 
-    try:
-        gl_project = PipelineFinder(args.group, args.project)
-    except RuntimeError as e:
-        log.exception(f"Could not create a PipelineFinder object.")
-        return 1
+    profiler = PhaseProfiler() if args.profile else None
+    self_tracer = None
+    if args.self_trace:
+        from trace_utils.self_tracing import SelfTracer
 
-    pipeline_ids = gl_project.pipelines_by_date(args.start_date, args.end_date)
+        self_tracer = SelfTracer(args.self_trace, gitlab_group=args.group, gitlab_project=args.project)
+    try:
+        try:
+            gl_project = PipelineFinder(
+                args.group, args.project, profiler=profiler, self_tracer=self_tracer, concurrency=args.concurrency
+            )
+        except RuntimeError as e:
+            log.exception(f"Could not create a PipelineFinder object.")
+            return 1
+
+        pipeline_ids = gl_project.pipelines_by_date(args.start_date, args.end_date)
+    finally:
+        if self_tracer:
+            self_tracer.shutdown()
     for p in pipeline_ids:
         print(p)
 
+    if profiler:
+        report(profiler, args.profile)
+
     return 0
 
 
@@ -81,6 +102,22 @@ def parse_args():
     )
     parser.add_argument("--start-date", required=True, help="The earliest execution date of a pipeline.")
     parser.add_argument("--end-date", help="The latest execution date of a pipeline. Defaults to the current time.")
+    parser.add_argument(
+        "--profile",
+        metavar="DIRECTORY",
+        help="Profile the phases of the search. Writes DIRECTORY/<phase>.prof and prints the hot functions.",
+    )
+    parser.add_argument(
+        "--self-trace",
+        metavar="ENDPOINT",
+        help="Trace the search, including every GitLab API request, to 'console' or a GRPC endpoint.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=0,
+        help="Retrieve this many pages of pipelines at the same time. Default is 0, one page at a time.",
+    )
     parser.add_argument("--debug", action="store_true")
 
     args = parser.parse_args()
@@ -100,18 +137,26 @@ class PipelineFinder(GitlabProjectBase):
     Once the object is initialized pipelines can be located between two specified dates.
     """
 
-    def __init__(self, group: str, project: str, access_token: str = "") -> list:
+    def __init__(
+        self, group: str, project: str, access_token: str = "", profiler=None, self_tracer=None, concurrency: int = 0
+    ) -> list:
         """
         Args:
             group (str): The name of a GitLab group.
             project (str): The name of a GitLab project (GitRepository).
             access_token (str): An access token for GitLab. The token must have "API" privileges.
+            profiler (PhaseProfiler, optional): Profiles the phases of the search. Defaults to no profiling.
+            self_tracer (SelfTracer, optional): Traces the search and its GitLab API requests. Defaults to no
+                self-tracing.
+            concurrency (int, optional): The pages of pipelines retrieved at the same time. Defaults to 0, one page
+                at a time through python-gitlab.
 
         Raises:
             RuntimeError: An error occurred during object initialization.
         """
-        super().__init__(group, project, access_token)
+        super().__init__(group, project, access_token, profiler, self_tracer, concurrency)
 
+    @traced("start_date", "end_date")
     def pipelines_by_date(self, start_date: datetime, end_date: datetime):
         """Locate pipelines that were started between two dates.
 
@@ -125,37 +170,71 @@ class PipelineFinder(GitlabProjectBase):
         pipelines_dates = []
         all_pipelines_found = False
 
-        current_page = 0
+        pages = self._pipeline_pages()
         while all_pipelines_found is False:
-            current_page += 1
-            pipelines = self.project.pipelines.list(page=current_page)
+            pipelines = next(pages)
+            if not pipelines:
+                # Past the oldest pipeline of the project.
+                break
             # The API returns newest Pipelines first. That is, reverse sorted by id, (hence, time).
-            for p in pipelines:
-                if p.status in ["canceled", "skipped"]:
-                    # Ignore pipelines that did not run.
-                    continue
+            with self._phase("normalize"):
+                for p in pipelines:
+                    if p.status in ["canceled", "skipped"]:
+                        # Ignore pipelines that did not run.
+                        continue
 
-                # The GitLab API returns strings not datetime object
-                pipeline_date = parse(p.created_at)
+                    # The GitLab API returns strings not datetime object
+                    pipeline_date = parse(p.created_at)
 
-                if pipeline_date > end_date:
-                    # Ignore early returns which happen after the specified end date. It's backwards...
-                    continue
-                elif pipeline_date < start_date:
-                    # Since the API returns newest first, all remaining pipelines are older than the start date.
-                    all_pipelines_found = True
-                    break
+                    if pipeline_date > end_date:
+                        # Ignore early returns which happen after the specified end date. It's backwards...
+                        continue
+                    elif pipeline_date < start_date:
+                        # Since the API returns newest first, all remaining pipelines are older than the start date.
+                        all_pipelines_found = True
+                        break
 
-                # Not earlier. Not later. Goldilocks.
-                pipelines_dates.append((p.id, pipeline_date))
+                    # Not earlier. Not later. Goldilocks.
+                    pipelines_dates.append((p.id, pipeline_date))
 
-                if all_pipelines_found:
-                    break
+                    if all_pipelines_found:
+                        break
 
         # Output a more conventional ordering.
         pipelines_dates.reverse()
         return pipelines_dates
 
+    def _pipeline_pages(self):
+        """Generate the pages of pipelines of the project, newest first.
+
+        With a concurrency, as many pages as the concurrency are retrieved at the same time.
+        Pages retrieved ahead and not needed are dropped.
+        """
+        current_page = 1
+        while True:
+            if not self.async_gitlab:
+                with self._phase("fetch", page=current_page):
+                    pipelines = self.project.pipelines.list(page=current_page)
+                yield pipelines
+                current_page += 1
+                continue
+
+            from gitlab.v4.objects import ProjectPipeline
+
+            count = self.async_gitlab.concurrency
+            with self._phase("fetch", page=current_page, pages=count):
+                pages = self.async_gitlab.run(
+                    self.async_gitlab.pages,
+                    f"/projects/{self.project.id}/pipelines",
+                    current_page,
+                    count,
+                    order_by="id",
+                    sort="desc",
+                )
+            for page in pages:
+                yield [ProjectPipeline(self.project.pipelines, attrs) for attrs in page]
+            current_page += count
+
     def __str__(self) -> str:
         return ", ".join(
             [
@@ -2,21 +2,53 @@
 Functions and global constants commonly imported by modules in this package.
 """
 
+import functools
+import inspect
 import logging
 import os
 import re
+import threading
+from contextlib import contextmanager
 from pathlib import Path
 
 import gitlab
+import requests
+from requests.adapters import HTTPAdapter
 
 from trace_utils.base_logger import get_logger
+from trace_utils.profiling import NULL_PROFILER
 
+# Statuses of jobs and pipelines that will not change again.
+FINISHED_STATUSES = ["success", "failed", "canceled", "skipped"]
 GITLAB_URL = "https://redacted"
 PAGINATION_COUNT = 200
+# Connections to GitLab kept open for reuse. At least as many as the threads making requests at
+# the same time, e.g. the DOWNSTREAM_WORKERS of export_pipeline_trace, or connections are dropped.
+# The thread pool of async_gitlab is capped at this size.
+POOL_MAXSIZE = 16
 
 
 log = get_logger(__name__)
 
+# Access token -> gitlab.Gitlab shared by the GitlabProjectBase objects of the process.
+_clients = {}
+_clients_lock = threading.RLock()
+_session = None
+
+
+def env_flag(var_name: str) -> bool:
+    """Interpret an environment variable as an on/off switch.
+
+    Values such as "1", "true" and "yes" turn the switch on. Undefined variables are off.
+
+    Args:
+        var_name (str): The environment variable name.
+
+    Returns:
+        bool: True if the switch is on.
+    """
+    return os.environ.get(var_name, "").strip().lower() in ("1", "t", "true", "y", "yes")
+
 
 def get_gitlab_token() -> str:
     """Retrieves a user's GitLab token.
@@ -136,6 +168,103 @@ def token_from_tokenfile(token_path: str = "") -> str:
     return token.strip()
 
 
+def gitlab_client(access_token: str) -> gitlab.Gitlab:
+    """Provide the GitLab client for an access token, shared by all users of the token in the process.
+
+    The clients of all tokens send requests through one HTTP session, see http_session().
+
+    Args:
+        access_token (str): An access token for GitLab. The token must have "API" privileges.
+
+    Returns:
+        gitlab.Gitlab: A client of GITLAB_URL using keyset pagination.
+    """
+    with _clients_lock:
+        if access_token not in _clients:
+            _clients[access_token] = gitlab.Gitlab(
+                url=GITLAB_URL,
+                private_token=access_token,
+                pagination="keyset",
+                order_by="id",
+                per_page=PAGINATION_COUNT,
+                session=http_session(),
+            )
+        return _clients[access_token]
+
+
+def http_session() -> requests.Session:
+    """Provide the HTTP session of the process for GitLab API requests.
+
+    Connections are kept alive and reused by every client, so pagination and repeated lookups do
+    not pay for a new TLS handshake. Responses are compressed as requested by default by requests.
+    The session may be used by several threads at once: the tokens are sent in the headers of each
+    request rather than kept in the session, and the connection pool is thread-safe.
+
+    GET responses are cached on disk when CI_TRACE_EXPORT_HTTP_CACHE is set, see http_cache.py.
+
+    Returns:
+        requests.Session: The session, created on first use.
+    """
+    global _session
+    with _clients_lock:
+        if _session is None:
+            # Imported here because http_cache imports this module.
+            from trace_utils.http_cache import CachingAdapter, cache_from_environment
+
+            cache = cache_from_environment()
+            if cache:
+                adapter = CachingAdapter(cache, pool_maxsize=POOL_MAXSIZE)
+            else:
+                adapter = HTTPAdapter(pool_maxsize=POOL_MAXSIZE)
+            _session = requests.Session()
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def _reset_after_fork() -> None:
+    """Drop the clients and the session inherited by a forked process.
+
+    Reading from the connections of the parent process would mix up the responses of both processes.
+    """
+    global _clients_lock, _session
+    _clients.clear()
+    _clients_lock = threading.RLock()
+    _session = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def traced(*arg_names):
+    """Decorate a method of a GitlabProjectBase subclass to trace each call when self-tracing is on.
+
+    Args:
+        *arg_names (str): Names of arguments of the method added to the span attributes.
+    """
+
+    def decorator(method):
+        signature = inspect.signature(method)
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not self.self_tracer:
+                return method(self, *args, **kwargs)
+
+            arguments = signature.bind(self, *args, **kwargs).arguments
+            attributes = {}
+            for name in arg_names:
+                if name in arguments:
+                    value = arguments[name]
+                    attributes[name] = value if isinstance(value, (str, bool, int, float)) else str(value)
+            with self.self_tracer.span(method.__qualname__, **attributes):
+                return method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
 class GitlabProjectBase:
     """The GitlabProjectBase is essentially a wrapper for group and project objects
     from the GitLab API.
@@ -145,25 +274,52 @@ class GitlabProjectBase:
     functionality to other GitLab constructs such as pipelines and schedules.
     """
 
-    def __init__(self, group: str, project: str, access_token: str = "") -> None:
+    def __init__(
+        self, group: str, project: str, access_token: str = "", profiler=None, self_tracer=None, concurrency: int = 0
+    ) -> None:
         """
         Args:
             group (str): The name of a GitLab group.
             project (str): The name of a GitLab project (GitRepository).
             access_token (str): An access token for GitLab. The token must have "API" privileges.
+            profiler (PhaseProfiler, optional): Profiles the phases of the work done. Defaults to no profiling.
+            self_tracer (SelfTracer, optional): Traces the phases of the work done and every GitLab API request.
+                Defaults to no self-tracing.
+            concurrency (int, optional): The most GitLab API requests in flight at the same time for bulk reads,
+                see async_gitlab.py. Defaults to 0, one request at a time through python-gitlab.
         """
+        self.profiler = profiler or NULL_PROFILER
+        self.self_tracer = self_tracer
         if not access_token:
             access_token = get_gitlab_token()
 
-        self.gl_client = gitlab.Gitlab(
-            url=GITLAB_URL,
-            private_token=access_token,
-            pagination="keyset",
-            order_by="id",
-            per_page=PAGINATION_COUNT,
-        )
-        self.group = self._retrieve_group(group)
-        self.project = self._retrieve_project(project)
+        self.gl_client = gitlab_client(access_token)
+        self.async_gitlab = None
+        if concurrency > 0:
+            from trace_utils.async_gitlab import AsyncGitlab
+
+            self.async_gitlab = AsyncGitlab(self.gl_client, concurrency)
+        if self.self_tracer:
+            self.self_tracer.instrument(self.gl_client)
+        with self._phase("resolve", group=group, project=project):
+            self.group = self._retrieve_group(group)
+            self.project = self._retrieve_project(project)
+
+    def _phase(self, name: str, **attributes):
+        """A context for a phase of the work, profiled and traced when these are on.
+
+        Args:
+            name (str): The phase, one of profiling.PHASES.
+            **attributes (dict): Key/value pairs added to the span of the phase.
+        """
+        if not self.self_tracer:
+            return self.profiler.phase(name)
+        return self._traced_phase(name, attributes)
+
+    @contextmanager
+    def _traced_phase(self, name: str, attributes: dict):
+        with self.profiler.phase(name), self.self_tracer.span(name, **attributes):
+            yield
 
     def _retrieve_group(self, group_name: str) -> any:
         """Retrieve the GitLab group object for the given group name.
@@ -0,0 +1,216 @@
+"""
+A disk-backed cache of GitLab API responses, revalidated with ETags.
+
+Re-exports of a pipeline and repeated searches request the same objects again: the group, the
+project, finished pipelines and their jobs. The cache stores the body and the ETag of each GET
+response in an SQLite file. The next request for the URL sends If-None-Match, and GitLab answers
+304 Not Modified with no body when the object has not changed. The body then comes from the cache.
+
+Responses are cached per URL and per access token. The cache is capped in size. The responses
+used least recently are evicted first, keeping finished pipelines and job lists of finished jobs
+until no other responses are left to evict. These do not change unless a job is retried.
+
+The cache is shared safely by the threads and the processes using the same file.
+
+
+# # # Usage: Environment
+
+CI_TRACE_EXPORT_HTTP_CACHE=~/.cache/trace_utils/gitlab.sqlite  # Turns the cache on
+CI_TRACE_EXPORT_HTTP_CACHE_MB=512  # Optional: the size cap, DEFAULT_CACHE_MB by default
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from requests import Response
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from trace_utils.base_logger import get_logger
+from trace_utils.gitlab_common import FINISHED_STATUSES
+
+DEFAULT_CACHE_MB = 512
+# Headers holding the credentials of a request. The responses differ by credentials.
+CREDENTIAL_HEADERS = ["PRIVATE-TOKEN", "JOB-TOKEN", "Authorization"]
+# Headers of a response describing the body as it was sent rather than as it is stored.
+TRANSFER_HEADERS = ["content-encoding", "content-length", "transfer-encoding", "connection"]
+# Seconds a process waits for another process writing to the cache.
+LOCK_TIMEOUT = 30.0
+
+log = get_logger(__name__)
+
+
+class HttpCache:
+    """Stores the ETag, headers and body of responses in an SQLite file."""
+
+    def __init__(self, path: str, max_bytes: int = DEFAULT_CACHE_MB * 2**20) -> None:
+        """
+        Args:
+            path (str): The SQLite file. It is created if it does not exist.
+            max_bytes (int, optional): The size cap of the stored bodies. Defaults to DEFAULT_CACHE_MB.
+        """
+        path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=LOCK_TIMEOUT, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, etag TEXT, headers TEXT, body BLOB, size INTEGER, permanent INTEGER, used REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS eviction ON responses (permanent, used)")
+
+    def get(self, key: str) -> tuple:
+        """The ETag, headers and body stored for a key, or None.
+
+        Args:
+            key (str): See cache_key().
+
+        Returns:
+            tuple: (str, dict, bytes) or None.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT etag, headers, body FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]), row[2]
+
+    def touch(self, key: str) -> None:
+        """Mark a stored response as used, moving it to the end of the eviction order."""
+        with self._lock:
+            self._db.execute("UPDATE responses SET used = ? WHERE key = ?", (time.time(), key))
+
+    def put(self, key: str, etag: str, headers: dict, body: bytes, permanent: bool) -> None:
+        """Store a response and evict others if the cache is over its size cap.
+
+        Args:
+            key (str): See cache_key().
+            etag (str): The ETag header of the response.
+            headers (dict): The headers of the response, without TRANSFER_HEADERS.
+            body (bytes): The decoded body of the response.
+            permanent (bool): Evict the response only after all responses that are not permanent.
+        """
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, etag, json.dumps(headers), body, len(body), int(permanent), time.time()),
+                )
+                self._evict()
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def _evict(self) -> None:
+        excess = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0] - self.max_bytes
+        if excess <= 0:
+            return
+        evicted = []
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY permanent, used"):
+            evicted.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self._db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        log.debug("Evicted %d responses from the HTTP cache.", len(evicted))
+
+
+class CachingAdapter(HTTPAdapter):
+    """An HTTPAdapter answering GET requests from an HttpCache when GitLab reports no change."""
+
+    def __init__(self, cache: HttpCache, **kwargs) -> None:
+        """
+        Args:
+            cache (HttpCache): Where responses are stored.
+            **kwargs (dict): Arguments of HTTPAdapter, e.g. pool_maxsize.
+        """
+        super().__init__(**kwargs)
+        self.cache = cache
+
+    def send(self, request, stream=False, **kwargs) -> Response:
+        if request.method != "GET" or stream:
+            # Streamed responses, e.g. artifacts, are too large to keep.
+            return super().send(request, stream=stream, **kwargs)
+
+        key = cache_key(request)
+        entry = self.cache.get(key)
+        if entry:
+            request.headers["If-None-Match"] = entry[0]
+        response = super().send(request, stream=stream, **kwargs)
+
+        if entry and response.status_code == 304:
+            self.cache.touch(key)
+            return self._cached_response(request, response, entry[1], entry[2])
+
+        etag = response.headers.get("ETag")
+        if response.status_code == 200 and etag:
+            headers = {name: value for name, value in response.headers.items() if name.lower() not in TRANSFER_HEADERS}
+            self.cache.put(key, etag, headers, response.content, is_permanent(response.content))
+        return response
+
+    def _cached_response(self, request, not_modified: Response, headers: dict, body: bytes) -> Response:
+        # Reading the empty body of the 304 response returns its connection to the pool.
+        not_modified.content
+        response = Response()
+        response.status_code = 200
+        response.reason = "OK"
+        response.headers = CaseInsensitiveDict(headers)
+        response.headers["Content-Length"] = str(len(body))
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = body
+        response._content_consumed = True
+        response.url = not_modified.url
+        response.request = request
+        response.connection = self
+        response.elapsed = not_modified.elapsed
+        return response
+
+
+def cache_key(request) -> str:
+    """The key of a request: its URL and a digest of its credentials."""
+    digest = hashlib.sha256()
+    for name in CREDENTIAL_HEADERS:
+        digest.update(request.headers.get(name, "").encode())
+    return f"{request.url} {digest.hexdigest()}"
+
+
+def is_permanent(body: bytes) -> bool:
+    """If a response is a finished pipeline or job, or a list of them."""
+    try:
+        value = json.loads(body)
+    except ValueError:
+        return False
+    if isinstance(value, dict):
+        return value.get("status") in FINISHED_STATUSES
+    if isinstance(value, list) and value:
+        return all(isinstance(item, dict) and item.get("status") in FINISHED_STATUSES for item in value)
+    return False
+
+
+def cache_from_environment() -> HttpCache:
+    """The HttpCache selected with CI_TRACE_EXPORT_HTTP_CACHE, or None.
+
+    Raises:
+        RuntimeError: CI_TRACE_EXPORT_HTTP_CACHE_MB is not a number.
+    """
+    path = os.environ.get("CI_TRACE_EXPORT_HTTP_CACHE")
+    if not path:
+        return None
+    try:
+        max_mb = float(os.environ.get("CI_TRACE_EXPORT_HTTP_CACHE_MB") or DEFAULT_CACHE_MB)
+    except ValueError as e:
+        raise RuntimeError(f"CI_TRACE_EXPORT_HTTP_CACHE_MB must be a number of megabytes: {e}") from e
+    log.info(f"Caching GitLab API responses in {path}.")
+    return HttpCache(path, int(max_mb * 2**20))
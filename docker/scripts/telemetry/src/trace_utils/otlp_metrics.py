@@ -0,0 +1,159 @@
+"""
+Builds and exports OpenTelemetry metrics with explicit timestamps.
+
+The metrics produced by this package describe CI activity that happened in the past, e.g. while
+a pipeline ran. The instruments of the OpenTelemetry metrics SDK stamp data points with the time
+of collection, so this module builds the metric data points directly and hands them to an
+exporter. The result is equivalent to what a MeterProvider would export had it been running
+while the pipeline executed.
+"""
+
+from bisect import bisect_left
+
+from opentelemetry.sdk.metrics.export import (
+    AggregationTemporality,
+    ConsoleMetricExporter,
+    Gauge,
+    Histogram,
+    HistogramDataPoint,
+    Metric,
+    MetricExportResult,
+    MetricsData,
+    NumberDataPoint,
+    ResourceMetrics,
+    ScopeMetrics,
+)
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.util.instrumentation import InstrumentationScope
+
+from trace_utils.base_logger import get_logger
+
+# Upper bounds, in seconds, of the histogram buckets for job and pipeline durations.
+DURATION_BOUNDARIES = (10, 30, 60, 120, 300, 600, 900, 1200, 1800, 2700, 3600, 5400, 7200, 10800, 14400)
+
+log = get_logger(__name__)
+
+
+def export_metrics(metrics: list, resource_attributes: dict, endpoint: str, exporter=None) -> None:
+    """Send metrics to the console or to a GRPC endpoint.
+
+    Args:
+        metrics (list): Metric objects, e.g. from gauge_metric() and histogram_metric().
+        resource_attributes (dict): Attributes of the Resource that produced the metrics.
+        endpoint (str): 'console' or the URL of a GRPC endpoint.
+        exporter (MetricExporter, optional): An exporter from metric_exporter() to reuse. The caller
+            shuts it down. Defaults to an exporter used for this call only.
+
+    Raises:
+        RuntimeError: The exporter reported a failure.
+    """
+    if not metrics:
+        log.info("No metrics to export.")
+        return
+
+    metrics_data = MetricsData(
+        resource_metrics=[
+            ResourceMetrics(
+                resource=Resource(attributes=resource_attributes),
+                scope_metrics=[
+                    ScopeMetrics(scope=InstrumentationScope(__name__), metrics=metrics, schema_url=""),
+                ],
+                schema_url="",
+            )
+        ]
+    )
+
+    if exporter:
+        result = exporter.export(metrics_data)
+    else:
+        exporter = metric_exporter(endpoint)
+        try:
+            result = exporter.export(metrics_data)
+        finally:
+            exporter.shutdown()
+
+    if result is not MetricExportResult.SUCCESS:
+        raise RuntimeError(f"Export of {len(metrics)} metrics to {endpoint} failed.")
+    log.info(f"Exported {len(metrics)} metrics to {endpoint}.")
+
+
+def metric_exporter(endpoint: str) -> any:
+    """A metric exporter for the console or a GRPC endpoint.
+
+    Args:
+        endpoint (str): 'console' or the URL of a GRPC endpoint.
+
+    Returns:
+        MetricExporter: The exporter. Shut it down when done.
+    """
+    if endpoint == "console":
+        return ConsoleMetricExporter()
+
+    # Imported here so that console exports do not load GRPC.
+    from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
+
+    return OTLPMetricExporter(endpoint=endpoint)
+
+
+def gauge_metric(name: str, description: str, unit: str, points: list) -> Metric:
+    """Build a gauge metric.
+
+    Args:
+        name (str): The metric name.
+        description (str): A description of the metric.
+        unit (str): The unit of the values, e.g. "s" or "1".
+        points (list): Data points in the form (<attributes: dict>, <time in ns: int>, <value: float>).
+
+    Returns:
+        Metric: A metric for export_metrics().
+    """
+    data_points = [
+        NumberDataPoint(attributes=attributes, start_time_unix_nano=0, time_unix_nano=time_ns, value=value)
+        for attributes, time_ns, value in points
+    ]
+    return Metric(name=name, description=description, unit=unit, data=Gauge(data_points=data_points))
+
+
+def histogram_metric(
+    name: str, description: str, unit: str, points: list, boundaries: tuple = DURATION_BOUNDARIES
+) -> Metric:
+    """Build a delta-temporality histogram metric.
+
+    Args:
+        name (str): The metric name.
+        description (str): A description of the metric.
+        unit (str): The unit of the values, e.g. "s".
+        points (list): Data points in the form
+            (<attributes: dict>, <start time in ns: int>, <end time in ns: int>, <values: list>).
+            Each data point aggregates the values observed between its start and end times.
+        boundaries (tuple, optional): Upper bounds of the histogram buckets. Defaults to DURATION_BOUNDARIES.
+
+    Returns:
+        Metric: A metric for export_metrics().
+    """
+    data_points = []
+    for attributes, start_ns, end_ns, values in points:
+        bucket_counts = [0] * (len(boundaries) + 1)
+        for value in values:
+            # Buckets include their upper bound.
+            bucket_counts[bisect_left(boundaries, value)] += 1
+        data_points.append(
+            HistogramDataPoint(
+                attributes=attributes,
+                start_time_unix_nano=start_ns,
+                time_unix_nano=end_ns,
+                count=len(values),
+                sum=sum(values),
+                bucket_counts=bucket_counts,
+                explicit_bounds=list(boundaries),
+                min=min(values),
+                max=max(values),
+            )
+        )
+
+    return Metric(
+        name=name,
+        description=description,
+        unit=unit,
+        data=Histogram(data_points=data_points, aggregation_temporality=AggregationTemporality.DELTA),
+    )
@@ -0,0 +1,133 @@
+"""
+Profiles the phases of pipeline exports with cProfile.
+
+The exporter and the finder mark their phases. Each phase has a profile of its own, accumulated
+over all pipelines:
+
+  resolve:       Looking up the GitLab group and project.
+  fetch:         Retrieving pipelines, jobs, downstream pipelines and schedules from GitLab.
+  normalize:     Converting GitLab objects to span attributes and times.
+  span_build:    Building spans, without the normalization of the data in them.
+  export_flush:  Sending spans and metrics to the endpoint.
+
+A phase entered while another phase runs pauses the other phase, so every call is counted in
+one phase only. Only the thread entering a phase is profiled. Work done by worker threads,
+e.g. retrieving downstream pipelines, shows up as waiting in the phase that started it.
+
+
+# # # Usage: Python API
+
+from trace_utils.profiling import PhaseProfiler
+
+profiler = PhaseProfiler()
+exporter = PipelineExporter("robot", "ApplicationRepo", profiler=profiler)
+exporter.generate_trace(23221)
+profiler.write("profiles")  # profiles/<phase>.prof, e.g. for python -m pstats or snakeviz
+print(profiler.summary(top=15))
+"""
+
+import io
+import os
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+
+# cProfile and pstats are imported by PhaseProfiler only. The modules importing NULL_PROFILER
+# start faster without them.
+
+# The number of functions listed per phase in a summary.
+DEFAULT_TOP = 15
+PHASES = ["resolve", "fetch", "normalize", "span_build", "export_flush"]
+
+
+class PhaseProfiler:
+    """Collects a cProfile profile and the wall time of each phase."""
+
+    def __init__(self) -> None:
+        import cProfile
+
+        self._profile_class = cProfile.Profile
+        # Phase -> cProfile.Profile
+        self.profiles = {}
+        # Phase -> [seconds, entries]
+        self.wall_times = {}
+        # The phases entered and not exited yet, innermost last.
+        self._active = []
+
+    @contextmanager
+    def phase(self, name: str):
+        """Profile the code run in the context as part of a phase."""
+        profile = self.profiles.setdefault(name, self._profile_class())
+        if self._active:
+            self.profiles[self._active[-1]].disable()
+        self._active.append(name)
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            wall_time = self.wall_times.setdefault(name, [0.0, 0])
+            wall_time[0] += time.perf_counter() - start
+            wall_time[1] += 1
+            self._active.pop()
+            if self._active:
+                self.profiles[self._active[-1]].enable()
+
+    def write(self, directory: str) -> list:
+        """Write the profile of each phase to <directory>/<phase>.prof.
+
+        Returns:
+            list: The paths of the files written.
+        """
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for name, profile in self._ordered_profiles():
+            path = os.path.join(directory, f"{name}.prof")
+            profile.dump_stats(path)
+            paths.append(path)
+        return paths
+
+    def summary(self, top: int = DEFAULT_TOP) -> str:
+        """The wall time of each phase and its functions with the most time spent in them.
+
+        Wall times of nested phases are included in the wall times of the phases around them.
+        """
+        import pstats
+
+        out = io.StringIO()
+        for name, profile in self._ordered_profiles():
+            seconds, entries = self.wall_times.get(name, (0.0, 0))
+            out.write(f"Phase {name}: {seconds:.3f} s wall time, entered {entries} times\n")
+            stats = pstats.Stats(profile, stream=out)
+            stats.sort_stats(pstats.SortKey.TIME).print_stats(top)
+        return out.getvalue()
+
+    def _ordered_profiles(self) -> list:
+        order = {name: i for i, name in enumerate(PHASES)}
+        return sorted(self.profiles.items(), key=lambda item: order.get(item[0], len(order)))
+
+
+def report(profiler: PhaseProfiler, directory: str, top: int = DEFAULT_TOP) -> None:
+    """Write the profiles of a command line run and print the summary to stderr.
+
+    Args:
+        profiler (PhaseProfiler): The profiler used by the run.
+        directory (str): Where to write the <phase>.prof files.
+        top (int, optional): The number of functions listed per phase. Defaults to DEFAULT_TOP.
+    """
+    paths = profiler.write(directory)
+    print(profiler.summary(top), file=sys.stderr)
+    print(f"Wrote profiles: {', '.join(paths)}", file=sys.stderr)
+
+
+class NullProfiler:
+    """Stands in for a PhaseProfiler when profiling is off."""
+
+    _context = nullcontext()
+
+    def phase(self, name: str):
+        return self._context
+
+
+NULL_PROFILER = NullProfiler()
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+
+"""
+This module computes runner utilization timelines from GitLab CI jobs.
+
+Each job contributes two intervals: the time it waited in the queue and the time it ran on a
+runner. A sweep over the sorted start and end points of the intervals produces, per runner and
+per runner tag, a time series of fixed-width buckets containing:
+
+  concurrent_max: The largest number of jobs running at once during the bucket.
+  concurrent_avg: The time-weighted average number of jobs running during the bucket.
+  busy_fraction:  The fraction of the bucket during which at least one job was running.
+  queued_avg:     The time-weighted average number of jobs waiting in the queue (queue pressure).
+  queued_max:     The largest number of jobs waiting in the queue at once during the bucket.
+
+The sweep sorts the interval end points once per runner or tag and then makes a single pass,
+so millions of jobs are handled in O(n log n) time.
+
+On the command line, pipelines whose jobs cannot be retrieved are left out of the timelines and
+listed at the end. The exit code is 1 if any were left out.
+
+
+# # # Usage Option 1: Python API
+
+from trace_utils.runner_utilization import RunnerUtilization
+
+utilization = RunnerUtilization(bucket_seconds=300)
+for job_span_data in job_trace_data:  # JobTraceData objects
+    utilization.add_job(job_span_data)
+utilization.write_csv("utilization.csv")
+utilization.export_metrics(endpoint="console")
+
+# # # Usage Option 2: Parameters on the Command Line
+
+runner_utilization -h
+usage: runner_utilization [-h] --group GROUP --project PROJECT --start-date START_DATE [--end-date END_DATE]
+                          [--bucket-seconds BUCKET_SECONDS] [--csv CSV] [--endpoint ENDPOINT] [--debug]
+"""
+
+import argparse
+import csv
+import logging
+import sys
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import NamedTuple
+
+import gitlab
+from dateutil.parser import parse
+
+from trace_utils import otlp_metrics
+from trace_utils.base_logger import get_logger
+from trace_utils.export_pipeline_trace import JobTraceData
+from trace_utils.find_pipelines import PipelineFinder
+
+DEFAULT_BUCKET_SECONDS = 300
+# Jobs that were not picked up by a tagged runner are counted under this tag.
+UNTAGGED = "(untagged)"
+
+CSV_COLUMNS = [
+    "dimension",
+    "key",
+    "bucket_start",
+    "concurrent_max",
+    "concurrent_avg",
+    "busy_fraction",
+    "queued_avg",
+    "queued_max",
+]
+
+log = get_logger(__name__)
+
+
+def main() -> int:
+    args = parse_args()
+    if args.debug:
+        log.setLevel(logging.DEBUG)
+
+    try:
+        finder = PipelineFinder(args.group, args.project)
+    except RuntimeError:
+        log.exception("Could not create a PipelineFinder object.")
+        return 1
+
+    utilization = RunnerUtilization(args.bucket_seconds)
+    failed = []
+    for pipeline_id, pipeline_date in finder.pipelines_by_date(args.start_date, args.end_date):
+        try:
+            jobs = finder.project.pipelines.get(pipeline_id, lazy=True).jobs.list(get_all=True, iterator=True)
+            for job in jobs:
+                utilization.add_job(JobTraceData(job, pipeline_date.isoformat()))
+        except gitlab.exceptions.GitlabError as e:
+            # The jobs of the other pipelines still make up the timelines.
+            log.error(f"Jobs of pipeline {pipeline_id} could not be retrieved: {e.error_message}")
+            failed.append(pipeline_id)
+
+    log.info(f"Computing utilization for {utilization.num_jobs} jobs.")
+    if args.csv:
+        utilization.write_csv(args.csv)
+    if args.endpoint:
+        try:
+            utilization.export_metrics(args.endpoint, gitlab_group=args.group, gitlab_project=args.project)
+        except RuntimeError:
+            log.exception("Export of runner utilization metrics failed.")
+            return 1
+
+    if failed:
+        print(f"Pipelines left out: {', '.join(str(pipeline_id) for pipeline_id in failed)}")
+        return 1
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="runner_utilization",
+        description="Compute runner concurrency, busy fraction and queue pressure for jobs run between two dates.",
+    )
+    parser.add_argument("--group", required=True, help="The GitLab group where the project resides.")
+    parser.add_argument(
+        "--project",
+        required=True,
+        help="The GitLab project (Git repository) where the pipelines were executed.",
+    )
+    parser.add_argument("--start-date", required=True, help="The earliest execution date of a pipeline.")
+    parser.add_argument("--end-date", help="The latest execution date of a pipeline. Defaults to the current time.")
+    parser.add_argument(
+        "--bucket-seconds",
+        type=int,
+        default=DEFAULT_BUCKET_SECONDS,
+        help=f"The width of each time series bucket. Default is {DEFAULT_BUCKET_SECONDS}.",
+    )
+    parser.add_argument("--csv", help="Write the time series to this CSV file. Use '-' for stdout.")
+    parser.add_argument(
+        "--endpoint", help="Export the time series as OTLP metrics. Can be 'console' or a GRPC endpoint."
+    )
+    parser.add_argument("--debug", action="store_true")
+
+    args = parser.parse_args()
+    if not args.csv and not args.endpoint:
+        parser.error("At least one of --csv or --endpoint must be supplied.")
+    if args.endpoint and not args.endpoint.startswith("http") and args.endpoint != "console":
+        parser.error("The endpoint must be a valid network address or 'console'.")
+
+    # Convert string input to Python objects.
+    args.start_date = parse(args.start_date)
+    if args.end_date:
+        args.end_date = parse(args.end_date)
+    else:
+        args.end_date = datetime.now(timezone.utc)
+
+    return args
+
+
+class UtilizationSample(NamedTuple):
+    """Utilization of one runner or runner tag during one time bucket."""
+
+    dimension: str
+    key: str
+    bucket_start: int
+    concurrent_max: int
+    concurrent_avg: float
+    busy_fraction: float
+    queued_avg: float
+    queued_max: int
+
+
+class RunnerUtilization:
+    """Accumulates job intervals and sweeps them into utilization time series.
+
+    Jobs are grouped by runner and by each runner tag of the job. The time series
+    for a runner or a tag spans from its first event to its last event. Buckets
+    are aligned to the epoch so series of different runners and tags line up.
+    """
+
+    def __init__(self, bucket_seconds: int = DEFAULT_BUCKET_SECONDS) -> None:
+        """
+        Args:
+            bucket_seconds (int, optional): The width of each time series bucket. Defaults to DEFAULT_BUCKET_SECONDS.
+        """
+        if bucket_seconds <= 0:
+            raise ValueError("bucket_seconds must be a positive number of seconds.")
+        self.bucket_seconds = bucket_seconds
+        self.num_jobs = 0
+        # (dimension, key) -> [(time, running delta, queued delta), ...]
+        self._events = defaultdict(list)
+
+    def add_job(self, job_span_data: JobTraceData) -> None:
+        """Add a job using the normalized times and attributes of its span."""
+        runner = ""
+        if job_span_data.runner_id:
+            runner = f"{job_span_data.runner_name or job_span_data.runner_description}#{job_span_data.runner_id}"
+        self.add_interval(
+            job_span_data.span_start / 10**9,
+            job_span_data.span_end / 10**9,
+            float(job_span_data.queued_duration or 0),
+            runner,
+            job_span_data.tag_list or [],
+        )
+
+    def add_interval(self, started: float, finished: float, queued: float, runner: str, tags: list) -> None:
+        """Add a job interval.
+
+        Args:
+            started (float): When the job started running, in seconds since the epoch.
+            finished (float): When the job finished, in seconds since the epoch.
+            queued (float): The number of seconds the job waited in the queue before it started.
+            runner (str): The runner that ran the job. Jobs without a runner are only counted by tag.
+            tags (list): The runner tags of the job.
+        """
+        if finished <= started and queued <= 0:
+            # Never queued and never ran, e.g. skipped and manual jobs.
+            return
+
+        self.num_jobs += 1
+        events = ((started - queued, 0, 1), (started, 1, -1), (finished, -1, 0))
+        keys = [("tag", tag) for tag in (tags or [UNTAGGED])]
+        if runner:
+            keys.append(("runner", runner))
+        for key in keys:
+            self._events[key].extend(events)
+
+    def samples(self):
+        """Sweep the job intervals into utilization samples.
+
+        Yields:
+            UtilizationSample: Samples ordered by dimension, key and bucket start.
+        """
+        for dimension, key in sorted(self._events):
+            yield from self._sweep(dimension, key, self._events[(dimension, key)])
+
+    def _sweep(self, dimension: str, key: str, events: list):
+        width = self.bucket_seconds
+        events.sort()
+
+        first_bucket = int(events[0][0] // width)
+        last_bucket = int(events[-1][0] // width)
+        num_buckets = last_bucket - first_bucket + 1
+        running_area = [0.0] * num_buckets
+        queued_area = [0.0] * num_buckets
+        busy_time = [0.0] * num_buckets
+        running_max = [0] * num_buckets
+        queued_max = [0] * num_buckets
+
+        running = queued = 0
+        previous_time = events[0][0]
+        for time, running_delta, queued_delta in events:
+            # The counts are constant between two events. Spread the segment over the buckets it covers.
+            segment_start = previous_time
+            while segment_start < time:
+                bucket = int(segment_start // width)
+                segment_end = min(time, (bucket + 1) * width)
+                duration = segment_end - segment_start
+                index = bucket - first_bucket
+                running_area[index] += running * duration
+                queued_area[index] += queued * duration
+                if running:
+                    busy_time[index] += duration
+                running_max[index] = max(running_max[index], running)
+                queued_max[index] = max(queued_max[index], queued)
+                segment_start = segment_end
+
+            running += running_delta
+            queued += queued_delta
+            previous_time = time
+
+        for index in range(num_buckets):
+            yield UtilizationSample(
+                dimension,
+                key,
+                (first_bucket + index) * width,
+                running_max[index],
+                running_area[index] / width,
+                busy_time[index] / width,
+                queued_area[index] / width,
+                queued_max[index],
+            )
+
+    def write_csv(self, path: str) -> None:
+        """Write the utilization samples to a CSV file.
+
+        Args:
+            path (str): The file to write. '-' writes to stdout.
+        """
+        out = sys.stdout if path == "-" else open(path, "w", newline="")
+        try:
+            writer = csv.writer(out)
+            writer.writerow(CSV_COLUMNS)
+            num_samples = 0
+            for sample in self.samples():
+                writer.writerow(
+                    [
+                        sample.dimension,
+                        sample.key,
+                        datetime.fromtimestamp(sample.bucket_start, timezone.utc).isoformat(),
+                        sample.concurrent_max,
+                        f"{sample.concurrent_avg:.4f}",
+                        f"{sample.busy_fraction:.4f}",
+                        f"{sample.queued_avg:.4f}",
+                        sample.queued_max,
+                    ]
+                )
+                num_samples += 1
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        log.info(f"Wrote {num_samples} utilization samples to {path}.")
+
+    def export_metrics(self, endpoint: str, **resource_attrs) -> None:
+        """Export the utilization samples as OTLP gauges.
+
+        Each sample is a data point stamped with the end of its bucket. Data points carry the
+        'dimension' attribute ('runner' or 'tag') and a 'runner' or 'tag' attribute naming the key.
+
+        Args:
+            endpoint (str): 'console' or the URL of a GRPC endpoint.
+            **resource_attrs (dict): Key/value pairs added to the resource of the metrics.
+
+        Raises:
+            RuntimeError: The metrics could not be exported.
+        """
+        if not self.num_jobs:
+            log.info("No jobs were added. There are no utilization metrics to export.")
+            return
+
+        points = defaultdict(list)
+        for sample in self.samples():
+            attributes = {"dimension": sample.dimension, sample.dimension: sample.key}
+            time_ns = (sample.bucket_start + self.bucket_seconds) * 10**9
+            for field in ("concurrent_max", "concurrent_avg", "busy_fraction", "queued_avg", "queued_max"):
+                points[field].append((attributes, time_ns, getattr(sample, field)))
+
+        metrics = [
+            otlp_metrics.gauge_metric(
+                "ci.runner.concurrent_jobs.max", "Most jobs running at once.", "{job}", points["concurrent_max"]
+            ),
+            otlp_metrics.gauge_metric(
+                "ci.runner.concurrent_jobs.avg", "Average number of jobs running.", "{job}", points["concurrent_avg"]
+            ),
+            otlp_metrics.gauge_metric(
+                "ci.runner.busy_fraction", "Fraction of time running at least one job.", "1", points["busy_fraction"]
+            ),
+            otlp_metrics.gauge_metric(
+                "ci.runner.queued_jobs.avg", "Average number of jobs waiting in the queue.", "{job}", points["queued_avg"]
+            ),
+            otlp_metrics.gauge_metric(
+                "ci.runner.queued_jobs.max", "Most jobs waiting in the queue at once.", "{job}", points["queued_max"]
+            ),
+        ]
+        resource_attrs.setdefault("service.name", "gitlab-runner-utilization")
+        resource_attrs["bucket_seconds"] = self.bucket_seconds
+        otlp_metrics.export_metrics(metrics, resource_attrs, endpoint)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""
+Traces the work of the exporter and the finder themselves.
+
+The spans go to a service of their own, SERVICE_NAME by default, so exporter latency and GitLab
+API cost can be watched next to the pipeline traces. An export or a search is the root span.
+Its children are the phases (see profiling.py), e.g. group resolution, fetching, normalization
+of each job and the OTLP flush, and a span for every GitLab API request.
+
+The spans of the exporter are never the current span of the OpenTelemetry context. Otherwise
+the spans of the pipeline traces would become their children. SelfTracer keeps a current span
+of its own instead.
+
+
+# # # Usage: Python API
+
+from trace_utils.self_tracing import SelfTracer
+
+self_tracer = SelfTracer("http://localhost:4518")
+exporter = PipelineExporter("robot", "ApplicationRepo", self_tracer=self_tracer)
+exporter.generate_trace(23221)
+self_tracer.shutdown()
+"""
+
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+SERVICE_NAME = "trace-utils-exporter"
+
+# Path segments with IDs, replaced so that requests for different objects get the same span name.
+_ID_SEGMENT = re.compile(r"/\d+(?=/|$)")
+
+
+class SelfTracer:
+    """Sends spans of the operations of PipelineExporter, PipelineFinder and GitlabProjectBase."""
+
+    def __init__(self, endpoint: str, service_name: str = SERVICE_NAME, **resource_attrs) -> None:
+        """
+        Args:
+            endpoint (str): 'console' or the URL of a GRPC endpoint.
+            service_name (str, optional): The service.name of the spans. Defaults to SERVICE_NAME.
+            **resource_attrs (dict): Key/value pairs added to the resource of the spans.
+        """
+        from opentelemetry import context, trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter, SimpleSpanProcessor
+
+        self._trace = trace
+        self._empty_context = context.Context()
+        self._current = ContextVar("self_tracing_current_span", default=None)
+
+        resource_attrs["service.name"] = service_name
+        self._provider = TracerProvider(resource=Resource(attributes=resource_attrs))
+        if endpoint == "console":
+            self._provider.add_span_processor(SimpleSpanProcessor(ConsoleSpanExporter()))
+        else:
+            from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+
+            self._provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=endpoint)))
+        self._tracer = self._provider.get_tracer(__name__)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """A span for the code run in the context, a child of the current span of this tracer."""
+        span = self._tracer.start_span(name, context=self._parent_context(), attributes=attributes)
+        token = self._current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.record_exception(e)
+            span.set_status(self._trace.Status(self._trace.StatusCode.ERROR, str(e)))
+            raise
+        finally:
+            self._current.reset(token)
+            span.end()
+
+    def instrument(self, gl_client) -> None:
+        """Add a span for every API request made by a python-gitlab client.
+
+        Clients share their HTTP session (see gitlab_common.http_session()), so the requests of
+        all clients of the process are traced once instrumented.
+        """
+        hooks = gl_client.session.hooks["response"]
+        if self._request_hook not in hooks:
+            hooks.append(self._request_hook)
+
+    def shutdown(self) -> None:
+        """Send the remaining spans."""
+        self._provider.shutdown()
+
+    def _parent_context(self) -> any:
+        parent = self._current.get()
+        if parent is None:
+            # Not the context of the current thread, which may hold a span of a pipeline trace.
+            return self._empty_context
+        return self._trace.set_span_in_context(parent, self._empty_context)
+
+    def _request_hook(self, response, *args, **kwargs) -> None:
+        # Response hooks run when the response arrives. The request started 'elapsed' earlier.
+        end_ns = time.time_ns()
+        start_ns = end_ns - int(response.elapsed.total_seconds() * 10**9)
+        request = response.request
+        path = _ID_SEGMENT.sub("/:id", request.path_url.split("?")[0])
+        attributes = {
+            "http.request.method": request.method,
+            "url.full": request.url,
+            "http.response.status_code": response.status_code,
+        }
+        # Reading the body here would defeat streamed responses. Chunked responses have no length.
+        if "Content-Length" in response.headers:
+            attributes["http.response.body.size"] = int(response.headers["Content-Length"])
+        span = self._tracer.start_span(
+            f"GitLab {request.method} {path}",
+            context=self._parent_context(),
+            start_time=start_ns,
+            attributes=attributes,
+        )
+        if response.status_code >= 400:
+            span.set_status(self._trace.Status(self._trace.StatusCode.ERROR, response.reason or ""))
+        span.end(end_ns)
@@ -1,5 +1,14 @@
 #!/usr/bin/env python3
 """
+Deletes images from ECR repositories according to the retention rules in registry_retention.py.
+
+Commands:
+  clean:      Delete images that no rule retains. This is the default.
+  plan:       Write the images clean would delete to a deletion plan file, for review.
+  apply:      Delete the images of a deletion plan whose tags have not changed since.
+  lifecycle:  Compile the rules to an ECR lifecycle policy per repository, so ECR prunes
+              images by itself. Policies can be simulated against captured image listings
+              before they are applied.
 
 Environment Variables:
   Environment variables are used to facilitate CI pipelines rather than command line parameters.
@@ -7,6 +16,17 @@ Environment Variables:
   Imported:
     DRY_RUN: With the value of "true", deletion candidates are identified but not deleted from ECR.
              If undefined or "false", images are deleteed.
+    MAX_WORKERS: The number of repositories scanned at the same time. Defaults to 8.
+    REPORT_FILE: The JSON lines report of retained and deleted images. Defaults to
+             clean-ecr-report.jsonl.
+    SCAN_CHECKPOINT: The file keeping the results of scanned repositories, so an interrupted
+             run resumes where it stopped. Defaults to ~/.cache/clean-ecr/scan-checkpoint.jsonl.
+    DEPLOYED_VERSIONS_FILE: A file listing the versions deployed in the field, one per line.
+             When set, the database is not queried. For local testing.
+    DEPLOYED_VERSIONS_CACHE, DEPLOYED_VERSIONS_TTL_HOURS: The snapshot of the versions
+             deployed in the field, shared with the other cleanup script, and how long it
+             is used before the database is queried again. Default to
+             ~/.cache/registry-retention/deployed-versions.json and 6 hours.
 
   Required in the Environment but not Imported:
     PG_USER: The user to query the database for releases deployed to robots in the field.
@@ -15,43 +35,53 @@ Environment Variables:
 
 """
 
+import argparse
 import boto3
+import json
 import os
-import pytz
-import re
 import sys
-from datetime import datetime, timedelta, timezone
-
-from psycopg2 import OperationalError
+from pathlib import Path
 
+import ecr_lifecycle
 from redacted_common_py import constants
-from dataapi.robots.oee import get_oee_config_permutations
-
-MFR = "redacted/main-full-runtime"
-REPO_PREFIXES = [
-    "redacted/main",
-    "redacted/arm",
-    "redacted/hwif",
-    "redacted/fiddle",
-    "redacted/gong",
-]
-TAG_KEEP_PATTERNS = [
-    re.compile(r"^.*latest$"),
-    re.compile(r"^dev_nightly$"),
-    re.compile(r"^rel-\d{4}\.\d{2}\.\d{2}(?:_\d+)?$"),
-    re.compile(r"^rel-\d{4}\.\d{2}\.\d{2}_nightly$"),
-]
+from registry_retention import (
+    DELETABLE,
+    Image,
+    JsonlReport,
+    RegistryBackend,
+    RetentionEngine,
+    RetentionPolicy,
+    ScanCheckpoint,
+    gb_str_from_bytes,
+    get_deployed_containers,
+    has_repo_prefix,
+    read_plan,
+    report_retained,
+    write_plan,
+)
+
 KEEP_DAYS = 90
-LOCAL_TZ = "America/Denver"
+REPORT_FILE = os.getenv("REPORT_FILE", "clean-ecr-report.jsonl")
+SCAN_CHECKPOINT = os.getenv(
+    "SCAN_CHECKPOINT", str(Path.home() / ".cache" / "clean-ecr" / "scan-checkpoint.jsonl")
+)
+# batch_delete_image accepts up to 100 image ids per call.
+DELETE_BATCH_SIZE = 99
+# describe_images accepts up to 100 image ids per call.
+DESCRIBE_BATCH_SIZE = 100
 
 
 def main() -> int:
     errs = 0
+    args = parse_args()
 
     dry_run = os.getenv("DRY_RUN", "False").lower() in ("1", "t", "true", "y", "yes")
 
-    client = boto3.client("ecr")
-    repository_names = all_repo_names(client)
+    backend = EcrBackend(boto3.client("ecr"))
+    if args.command == "apply":
+        # The plan holds the decisions, so the rules are not evaluated again.
+        return apply(backend, args.plan, dry_run)
+
     try:
         all_field_versions = get_deployed_containers()
     except RuntimeError as e:
@@ -59,203 +89,336 @@ def main() -> int:
         errs += 1
 
     if not errs:
-        print("Analyzing deletion candidates. This can take awhile.")
-        categorized_images = categorize_images(client, repository_names, all_field_versions)
-        deletion_data = delete_images(client, categorized_images, dry_run)
-
-        report_skipped(categorized_images, all_field_versions)
-        report_deleted(deletion_data["deletion_report"])
-        if dry_run:
-            print(
-                f"{deletion_data['num_images']} images, "
-                f"({gb_str_from_bytes(deletion_data['num_bytes'])} GB) would be deleted."
-            )
+        print(
+            "All images deployed in the field: "
+            f"{sorted(all_field_versions)} ({len(all_field_versions)} images)"
+        )
+        policy = RetentionPolicy(KEEP_DAYS, all_field_versions)
+        if args.command == "lifecycle":
+            errs += lifecycle(backend, policy, args, dry_run)
+        elif args.command == "plan":
+            plan(backend, policy, args.plan)
         else:
-            print(
-                f"{deletion_data['num_images']} images deleted and "
-                f"({gb_str_from_bytes(deletion_data['num_bytes'])} GB) were reclaimed."
-            )
-
-    return 0
-
-
-def all_repo_names(client) -> list:
-    repositories = []
-    paginator = client.get_paginator("describe_repositories")
-    for page in paginator.paginate():
-        for repo in page["repositories"]:
-            if any([repo["repositoryName"].startswith(prefix) for prefix in REPO_PREFIXES]):
-                repositories.append(repo["repositoryName"])
-    return repositories
-
-
-def batch(iterable, n=1):
-    """Yield successive n-sized chunks from iterable."""
-    length = len(iterable)
-    for i in range(0, length, n):
-        yield iterable[i : min(i + n, length)]
-
+            errs += clean(backend, policy, dry_run)
+
+    return errs
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Delete images from ECR by retention rules.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("clean", help="Delete images that no rule retains. The default.")
+    plan_parser = subparsers.add_parser("plan", help="Write a deletion plan without deleting.")
+    plan_parser.add_argument("plan", help="The deletion plan file to write.")
+    apply_parser = subparsers.add_parser("apply", help="Delete the images of a deletion plan.")
+    apply_parser.add_argument("plan", help="A deletion plan file written by 'plan'.")
+    lifecycle_parser = subparsers.add_parser(
+        "lifecycle", help="Compile the retention rules to ECR lifecycle policies."
+    )
+    lifecycle_parser.add_argument(
+        "--out-dir", help="Write a policy file per repository here. Defaults to stdout."
+    )
+    lifecycle_parser.add_argument(
+        "--capture", help="Save the image listings of the repositories to this file."
+    )
+    lifecycle_parser.add_argument(
+        "--simulate",
+        metavar="LISTINGS",
+        help="Simulate the policies against image listings saved with --capture.",
+    )
+    lifecycle_parser.add_argument(
+        "--apply",
+        action="store_true",
+        help="Set the lifecycle policy of each repository. Skipped when DRY_RUN is true.",
+    )
+    return parser.parse_args()
+
+
+def clean(backend: "EcrBackend", policy: RetentionPolicy, dry_run: bool) -> int:
+    repository_names = backend.repositories()
+    print("Analyzing deletion candidates. This can take awhile.")
+    engine = RetentionEngine(backend, policy)
+    checkpoint = ScanCheckpoint(SCAN_CHECKPOINT, policy)
+    report = JsonlReport(REPORT_FILE)
+    totals = {"images": 0, "bytes": 0}
+    # Each repository's deletable images are deleted as soon as its scan completes.
+    # Images of repositories resumed from the checkpoint may be deleted already,
+    # which EcrBackend.delete() does not count as a failure.
+    # Deletions are reported as requested; failures are reported afterwards.
+    repo_deletions = deletions(
+        engine.scan(repository_names, checkpoint),
+        policy,
+        report,
+        totals,
+        "would delete" if dry_run else "delete requested",
+    )
+    if dry_run:
+        failed = []
+        for _ in repo_deletions:
+            pass
+    else:
+        failed = engine.delete(repo_deletions)
+    report.write("delete failed", failed)
+    report.close()
+    checkpoint.clear()
+
+    num_images = totals["images"] - len(failed)
+    num_bytes = gb_str_from_bytes(totals["bytes"] - sum(image.size for image in failed))
+    if dry_run:
+        print(f"{num_images} images, ({num_bytes} GB) would be deleted.")
+    else:
+        print(f"{num_images} images deleted and ({num_bytes} GB) were reclaimed.")
+
+    return len(failed)
+
+
+def plan(backend: "EcrBackend", policy: RetentionPolicy, plan_path: str):
+    repository_names = backend.repositories()
+    print("Analyzing deletion candidates. This can take awhile.")
+    engine = RetentionEngine(backend, policy)
+    checkpoint = ScanCheckpoint(SCAN_CHECKPOINT, policy)
+    report = JsonlReport(REPORT_FILE)
+    totals = {"images": 0, "bytes": 0}
+    scan_results = engine.scan(repository_names, checkpoint)
+    write_plan(
+        plan_path,
+        (
+            image
+            for _, images in deletions(scan_results, policy, report, totals, "planned")
+            for image in images
+        ),
+        policy,
+    )
+    report.close()
+    checkpoint.clear()
+    print(
+        f"{totals['images']} images ({gb_str_from_bytes(totals['bytes'])} GB) planned for "
+        f"deletion in {plan_path}"
+    )
+
+
+def apply(backend: "EcrBackend", plan_path: str, dry_run: bool) -> int:
+    planned = read_plan(plan_path)
+    engine = RetentionEngine(backend, None)
+    verified, changed, failed = engine.apply(planned, dry_run)
+    failed_digests = {(image.repo, image.digest) for image in failed}
+    deleted = [image for image in verified if (image.repo, image.digest) not in failed_digests]
+    report = JsonlReport(REPORT_FILE)
+    report.write("changed since planned", changed)
+    report.write("delete failed", failed)
+    report.write("would delete" if dry_run else "deleted", deleted)
+    report.close()
+    num_bytes = sum(image.size for image in deleted)
+    if dry_run:
+        print(f"{len(deleted)} images, ({gb_str_from_bytes(num_bytes)} GB) would be deleted.")
+    else:
+        print(
+            f"{len(deleted)} images deleted and "
+            f"({gb_str_from_bytes(num_bytes)} GB) were reclaimed."
+        )
+    return len(failed)
+
+
+def lifecycle(backend: "EcrBackend", policy: RetentionPolicy, args, dry_run: bool) -> int:
+    errs = 0
+    if args.simulate:
+        images_by_repo = ecr_lifecycle.read_listings(args.simulate)
+        repository_names = sorted(images_by_repo)
+    else:
+        repository_names = backend.repositories()
+
+    if args.capture:
+        engine = RetentionEngine(backend, policy)
+        num_images = ecr_lifecycle.write_listings(
+            args.capture,
+            (
+                image
+                for _, categorized in engine.scan(repository_names)
+                for images in categorized.values()
+                for image in images
+            ),
+        )
+        print(f"Saved {num_images} image listings to {args.capture}")
 
-def categorize_images(client, repository_names: list, all_field_versions: list):
-    categorized_images = {}
     for repo in repository_names:
-        repo_categorized_images = categorize_images_by_repo(client, repo, all_field_versions)
-        if repo_categorized_images:
-            categorized_images[repo] = repo_categorized_images
-
-    return categorized_images
-
-
-def categorize_images_by_repo(client, repository_name: str, all_field_versions: dict) -> dict:
-    images = {"recent": [], "fielded": [], "keep_pattern": [], "deletable": []}
-
-    # Paginate through list of images in the repository
-    image_paginator = client.get_paginator("list_images")
-    for image_page in image_paginator.paginate(
-        registryId=constants.RESOURCES.AWS_ACCT_ID, repositoryName=repository_name
-    ):
-        for image in image_page["imageIds"]:
-            image_size = 0
-
-            # Paginate through image details to find out when it was pushed
-            detail_paginator = client.get_paginator("describe_images")
-            for detail_page in detail_paginator.paginate(
-                repositoryName=repository_name, imageIds=[image]
-            ):
-                retain = False
-                for image_details in detail_page["imageDetails"]:
-                    image_size = image_details.get("imageSizeInBytes", 0)
-                    image_tags = image_details.get("imageTags", [])
-
-                    if image_tags:
-                        for tag in image_tags:
-                            if matches_keep_pattern(tag):
-                                images["keep_pattern"].append(tag)
-                                retain = True
-                                break
-                    else:
-                        # No tags in the image details.
-                        tag = image.get("imageTag", "")
-
-                    if not retain and tag and is_fielded(tag, repository_name, all_field_versions):
-                        images["fielded"].append(tag)
-                        retain = True
-
-                    if not retain and is_recent(image_details["imagePushedAt"]):
-                        # imagePushedAt is local, "datetime(...., tzinfo=tzlocal())"
-                        images["recent"].append(tag)
-                        retain = True
-
-                    if retain:
-                        # A reason was found to retain this image. No need to reclassify it.
-                        break
-                if retain:
-                    break
-
-            if not retain:
-                # Every reason to retain this image has been eliminated.
-                # deletable example: ({"imageDigest": "sha256:e92e8...", "imageTag": "rel-2022.09.16"}, 9935662402)
-                images["deletable"].append((image, image_size))
-
-    return images
-
-
-def delete_images(client, categorized_images: dict, dry_run: bool):
-    total_bytes_deleted = 0
-    total_images_deleted = 0
-    deletion_report = []
-    for repo_name, repo_images in categorized_images.items():
-        repo_candidates = repo_images.get("deletable")
-        if not repo_candidates:
-            print(f"No deletion candidates found in: {repo_name}")
+        try:
+            lifecycle_policy = ecr_lifecycle.compile_policy(policy, repo)
+        except RuntimeError as e:
+            print(f"No lifecycle policy for {repo}, clean-ecr.py handles it: {e}")
+            if args.apply and not dry_run:
+                errs += remove_lifecycle_policy(backend, repo)
             continue
+        policy_text = json.dumps(lifecycle_policy, indent=2)
 
-        # Iterate images to separate data and to generate a report.
-        deletable_images = []
-        for image_data in repo_candidates:
-            # The 'image' is formatted for the ECR client, e.g. {"imageDigest": "sha256:e92e8...", "imageTag": "rel-2022.09.16"}
-            image = image_data[0]
-            num_bytes = image_data[1]
+        if args.out_dir:
+            path = Path(args.out_dir) / f"{repo.replace('/', '__')}.json"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(policy_text + "\n")
+            print(f"Lifecycle policy for {repo} written to {path}")
+        elif not args.simulate:
+            print(f"Lifecycle policy for {repo}:\n{policy_text}")
 
-            deletable_images.append(image)
-            total_bytes_deleted += num_bytes
-            tag = image.get("imageTag", "untagged")
+        if args.simulate:
+            errs += report_simulation(repo, policy, lifecycle_policy, images_by_repo[repo])
+
+        if args.apply:
             if dry_run:
-                deletion_report.append(
-                    f"Dry run deletion candidate: {repo_name}/{tag} = {num_bytes} bytes"
-                )
+                print(f"Dry run, lifecycle policy not set: {repo}")
             else:
-                deletion_report.append(f"Image deleted: {repo_name}/{tag} = {num_bytes} bytes")
-
-        # Then, batch the deletions for the repository.
-        total_images_deleted += len(deletable_images)
-        if not dry_run:
-            for btch in batch(deletable_images, n=99):
-                client.batch_delete_image(repositoryName=repo_name, imageIds=btch)
-
-    return {
-        "num_images": total_images_deleted,
-        "num_bytes": total_bytes_deleted,
-        "deletion_report": deletion_report,
-    }
-
+                backend.client.put_lifecycle_policy(
+                    registryId=constants.RESOURCES.AWS_ACCT_ID,
+                    repositoryName=repo,
+                    lifecyclePolicyText=policy_text,
+                )
+                print(f"Lifecycle policy set: {repo}")
 
-def gb_str_from_bytes(num_bytes: int) -> str:
-    return f"{num_bytes / (1024**3):.2f}"
+    return errs
 
 
-def get_deployed_containers() -> list:
+def remove_lifecycle_policy(backend: "EcrBackend", repo: str) -> int:
+    """Remove a lifecycle policy set by an earlier run, which may expire retained images."""
     try:
-        df = get_oee_config_permutations()
-    except OperationalError as e:
-        raise RuntimeError(e)
-    df = df[~df.site.isin(["sim", "hilsim", "TOR_DEN_1"])]
-    all_versions = df["container_version"].unique().tolist()
-
-    return all_versions
-
+        backend.client.delete_lifecycle_policy(
+            registryId=constants.RESOURCES.AWS_ACCT_ID, repositoryName=repo
+        )
+    except backend.client.exceptions.LifecyclePolicyNotFoundException:
+        return 0
+    except Exception as e:
+        print(f"Lifecycle policy not removed: {repo}: {e}")
+        return 1
+    print(f"Lifecycle policy removed: {repo}")
+    return 0
 
-def matches_keep_pattern(tag: str) -> bool:
-    for keep_pattern in TAG_KEEP_PATTERNS:
-        if keep_pattern.match(tag):
-            return True
-    return False
 
+def report_simulation(
+    repo: str, policy: RetentionPolicy, lifecycle_policy: dict, images: list
+) -> int:
+    outcomes = ecr_lifecycle.compare(policy, lifecycle_policy, images)
+    for image in outcomes["unsafe"]:
+        print(f"Unsafe - the lifecycle policy expires a retained image: {repo}/{image.name}")
+    expired = outcomes["expired"]
+    client = outcomes["client"]
+    print(
+        f"{repo}: {len(expired)} images ({gb_str_from_bytes(sum(i.size for i in expired))} GB) "
+        f"expired by the lifecycle policy, {len(client)} images "
+        f"({gb_str_from_bytes(sum(i.size for i in client))} GB) left to clean-ecr.py."
+    )
+    return len(outcomes["unsafe"])
 
-def is_fielded(tag: str, repository: str, all_field_versions) -> bool:
-    if repository is MFR and tag in all_field_versions:
-        return True
-    return False
 
+def batch(iterable, n=1):
+    """Yield successive n-sized chunks from iterable."""
+    length = len(iterable)
+    for i in range(0, length, n):
+        yield iterable[i : min(i + n, length)]
 
-def is_recent(push_time: datetime) -> bool:
-    # push_time is in local timezone
-    local_tz = pytz.timezone(LOCAL_TZ)
-    cutoff_time = datetime.now(local_tz) - timedelta(days=KEEP_DAYS)
-    return push_time >= cutoff_time
 
+def deletions(
+    scan_results, policy: RetentionPolicy, report: JsonlReport, totals: dict, action: str
+):
+    """Report scan results and yield the deletable images of each repository.
 
-def report_deleted(deletion_data):
-    deletion_data.sort()
-    print("\n".join(deletion_data))
+    Results are not kept, so memory use does not grow with the number of repositories.
 
+    Args:
+        action (str): How deletable images are reported, e.g. "deleted".
 
-def report_skipped(categorized_images: dict, deployed_images: list) -> None:
-    print("All images deployed in the field: " f"{deployed_images} ({len(deployed_images)} images)")
-    for repo in categorized_images:
-        per_repo_images = categorized_images[repo]
-        recent = [f"Retained - Recent: {repo}: {tag}" for tag in per_repo_images["recent"]]
-        fielded = [
-            f"Retained - Deployed in the field: {repo}: {tag}" for tag in per_repo_images["fielded"]
-        ]
-        keep_pattern = [
-            f"Retained - 'keep pattern' match: {repo}: {tag}"
-            for tag in per_repo_images["keep_pattern"]
-        ]
+    Yields:
+        tuple: (<repository>, [Image, ...]).
+    """
+    for repo, categorized in scan_results:
+        report_retained(report, repo, categorized)
+        deletable = categorized[DELETABLE]
+        if not deletable:
+            continue
+        report.write(action, deletable, policy.deletion_reason)
+        totals["images"] += len(deletable)
+        totals["bytes"] += sum(image.size for image in deletable)
+        yield repo, deletable
+
+
+class EcrBackend(RegistryBackend):
+    """Elastic Container Registry repositories. boto3 clients are thread-safe."""
+
+    def __init__(self, client) -> None:
+        self.client = client
+
+    def repositories(self) -> list:
+        repositories = []
+        paginator = self.client.get_paginator("describe_repositories")
+        for page in paginator.paginate():
+            for repo in page["repositories"]:
+                if has_repo_prefix(repo["repositoryName"]):
+                    repositories.append(repo["repositoryName"])
+        return repositories
+
+    def scan(self, repo: str):
+        # describe_images without imageIds pages through every image in the repository,
+        # up to 1000 images per call, including tags, push time and size.
+        detail_paginator = self.client.get_paginator("describe_images")
+        for detail_page in detail_paginator.paginate(
+            registryId=constants.RESOURCES.AWS_ACCT_ID,
+            repositoryName=repo,
+            PaginationConfig={"PageSize": 1000},
+        ):
+            for image_details in detail_page["imageDetails"]:
+                # imagePushedAt is local, "datetime(...., tzinfo=tzlocal())"
+                yield Image(
+                    repo,
+                    image_details.get("imageTags", []),
+                    image_details["imageDigest"],
+                    image_details.get("imageSizeInBytes", 0),
+                    image_details["imagePushedAt"],
+                )
 
-    for categorized in [recent, fielded, keep_pattern]:
-        categorized.sort()
-        print("\n".join(categorized))
+    def delete(self, repo: str, images: list) -> list:
+        # Deleting by digest removes the image along with all of its tags.
+        by_digest = {image.digest: image for image in images}
+        failed = []
+        for btch in batch(list(by_digest), n=DELETE_BATCH_SIZE):
+            response = self.client.batch_delete_image(
+                repositoryName=repo, imageIds=[{"imageDigest": digest} for digest in btch]
+            )
+            for failure in response.get("failures", []):
+                digest = failure["imageId"].get("imageDigest")
+                if failure.get("failureCode") == "ImageNotFound":
+                    # Already deleted, e.g. by a run that was interrupted.
+                    continue
+                print(f"Deletion failed - {repo}/{digest}: {failure.get('failureReason')}")
+                if digest in by_digest:
+                    failed.append(by_digest[digest])
+        return failed
+
+    def verify(self, repo: str, images: list) -> list:
+        verified = []
+        for btch in batch(images, n=DESCRIBE_BATCH_SIZE):
+            current = self._current_tags(repo, [image.digest for image in btch])
+            for image in btch:
+                # Deleting by digest would also delete tags added since the plan was made.
+                if image.digest in current and sorted(current[image.digest]) == sorted(image.tags):
+                    verified.append(image)
+        return verified
+
+    def _current_tags(self, repo: str, digests: list) -> dict:
+        """The current tags of the images with the given digests. Deleted images are left out."""
+        try:
+            response = self.client.describe_images(
+                registryId=constants.RESOURCES.AWS_ACCT_ID,
+                repositoryName=repo,
+                imageIds=[{"imageDigest": digest} for digest in digests],
+            )
+        except self.client.exceptions.ImageNotFoundException:
+            if len(digests) == 1:
+                return {}
+            # The whole call fails if one image is gone. Look the images up one at a time.
+            current = {}
+            for digest in digests:
+                current.update(self._current_tags(repo, [digest]))
+            return current
+        return {
+            details["imageDigest"]: details.get("imageTags", [])
+            for details in response["imageDetails"]
+        }
 
 
 if __name__ == "__main__":
@@ -1,5 +1,11 @@
 #!/usr/bin/env python3
 """
+Deletes image tags from the GitLab registry according to the retention rules in registry_retention.py.
+
+Commands:
+  clean:  Delete tags that no rule retains. This is the default.
+  plan:   Write the tags clean would delete to a deletion plan file, for review.
+  apply:  Delete the tags of a deletion plan that still point to the planned digests.
 
 Environment Variables:
   Environment variables are used to facilitate CI pipelines rather than command line parameters.
@@ -7,52 +13,122 @@ Environment Variables:
   Imported:
     DRY_RUN: With the value of "true", deletion candidates are identified but not deleted from
              the GitLab registry. If undefined or "false", images are deleteed.
-  
+    MAX_WORKERS: The number of registry requests made at the same time. Defaults to 8.
+    LAYER_CACHE: The file caching the layers of manifests inspected by earlier runs.
+                 Defaults to ~/.cache/clean-gitlab-registry/layers.json. In CI, point this
+                 at a path kept by the GitLab CI cache.
+    REGISTRY_USER, REGISTRY_PASSWORD: Credentials for registry HEAD requests. Default to
+                 CI_REGISTRY_USER and CI_REGISTRY_PASSWORD. Without credentials, every
+                 manifest is downloaded.
+    GITLAB_TOKEN: A token with API access to the projects owning the registry repositories.
+                 With a token, the tags of a repository are deleted with a single bulk
+                 deletion request. Without one, tags are deleted one at a time. GitLab
+                 deletes the tags of a bulk request in the background, so they are
+                 reported as "delete requested" rather than "deleted". The token is also
+                 used to look up the digests of tags when the registry does not provide them.
+    GITLAB_URL: The GitLab server for bulk deletion. Defaults to CI_SERVER_URL.
+    REPORT_FILE: The JSON lines report of retained and deleted tags. Defaults to
+                 clean-gitlab-registry-report.jsonl.
+    SCAN_CHECKPOINT: The file keeping the results of scanned repositories, so an interrupted
+                 run resumes where it stopped. Defaults to
+                 ~/.cache/clean-gitlab-registry/scan-checkpoint.jsonl.
+    DEPLOYED_VERSIONS_FILE: A file listing the versions deployed in the field, one per line.
+                 When set, the database is not queried. For local testing.
+    DEPLOYED_VERSIONS_CACHE, DEPLOYED_VERSIONS_TTL_HOURS: The snapshot of the versions
+                 deployed in the field, shared with the other cleanup script, and how long it
+                 is used before the database is queried again. Default to
+                 ~/.cache/registry-retention/deployed-versions.json and 6 hours.
+
   Required in the Environment but not Imported:
     PG_USER: The user to query the database for releases deployed to robots in the field.
     PGPASSWORD: The password for PG_USER
     RDSHOST: The database server name.
 """
 
+import argparse
+import heapq
+import json
 import os
 import re
 import sys
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from datetime import datetime, timedelta
+from datetime import date, timedelta
+from pathlib import Path
 
-from psycopg2 import OperationalError
+import gitlab
+import requests
 
 from redacted_common_py import constants
 from redacted_cli.util.docker_util import RegistryClient
-from dataapi.robots.oee import get_oee_config_permutations
+from registry_retention import (
+    DELETABLE,
+    KEEP_PATTERN,
+    MAX_WORKERS,
+    Image,
+    JsonlReport,
+    ProgressCounter,
+    RegistryBackend,
+    RetentionEngine,
+    RetentionPolicy,
+    ScanCheckpoint,
+    gb_str_from_bytes,
+    get_deployed_containers,
+    group_by_repo,
+    has_repo_prefix,
+    read_plan,
+    report_retained,
+    tag_date,
+    write_plan,
+)
 
-MFR = "redacted/main-full-runtime"
 REGISTRY_URL = "gitlab-registry"
-REPO_PREFIXES = [
-    "redacted/arm",
-    "redacted/hwif",
-    "redacted/fiddle",
-    "redacted/gong",
-    "redacted/main",
-]
-TAG_KEEP_PATTERNS = [
-    re.compile(r"^.*latest$"),
-    re.compile(r"^dev_nightly$"),
-    re.compile(r"^rel-\d{4}\.\d{2}\.\d{2}(?:_\d+)?$"),
-    re.compile(r"^rel-\d{4}\.\d{2}\.\d{2}_nightly$"),
-]
+# Tags without a date are never recent.
 KEEP_DAYS = 30
-DATE_PATTERN = r".*(\d{4})\D?(0[1-9]|1[0-2])\D?([12]\d|0[1-9]|3[01]).*$"
+GITLAB_URL = os.getenv("GITLAB_URL", os.getenv("CI_SERVER_URL", ""))
+# Registry requests are attempted this many times before giving up.
+REQUEST_ATTEMPTS = 3
+RETRY_DELAY_SECONDS = 2
+
+LAYER_CACHE = os.getenv(
+    "LAYER_CACHE", str(Path.home() / ".cache" / "clean-gitlab-registry" / "layers.json")
+)
+REPORT_FILE = os.getenv("REPORT_FILE", "clean-gitlab-registry-report.jsonl")
+SCAN_CHECKPOINT = os.getenv(
+    "SCAN_CHECKPOINT",
+    str(Path.home() / ".cache" / "clean-gitlab-registry" / "scan-checkpoint.jsonl"),
+)
+# Cached manifests not seen by a run for this long are dropped from the cache.
+LAYER_CACHE_MAX_AGE_DAYS = 90
+MANIFEST_MEDIA_TYPES = ", ".join(
+    [
+        "application/vnd.docker.distribution.manifest.v2+json",
+        "application/vnd.oci.image.manifest.v1+json",
+    ]
+)
+
+# Each worker thread gets a RegistryClient and a requests Session of its own.
+_thread_local = threading.local()
+# Registry bearer tokens by scope, shared by the worker threads.
+_registry_tokens = {}
 
 
 def main() -> int:
     errs = 0
+    args = parse_args()
 
     dry_run = os.getenv("DRY_RUN", "False").lower() in ("1", "t", "true", "y", "yes")
 
-    client = RegistryClient(hostname=REGISTRY_URL)
-    repository_names = find_repo_names(client)
-    repository_names.sort()
+    if args.command == "apply":
+        # The plan holds the decisions, so the rules are not evaluated again.
+        errs += apply(GitlabRegistryBackend(None, gitlab_client()), args.plan, dry_run)
+        if errs:
+            print("Fatal errors incurred. Script exiting.")
+        return errs
+
     try:
         all_field_versions = get_deployed_containers()
     except RuntimeError as e:
@@ -60,12 +136,57 @@ def main() -> int:
         errs += 1
 
     if not errs:
-        categorized_images = categorize_repo_images(client, repository_names, all_field_versions)
+        print(
+            "All images deployed in the field: "
+            f"{sorted(all_field_versions)} ({len(all_field_versions)} images)"
+        )
+        policy = RetentionPolicy(KEEP_DAYS, all_field_versions)
+        backend = GitlabRegistryBackend(policy, gitlab_client())
+        repository_names = backend.repositories()
+        engine = RetentionEngine(backend, policy)
+        checkpoint = ScanCheckpoint(SCAN_CHECKPOINT, policy)
+        report = JsonlReport(REPORT_FILE)
+        categorized_images = categorize_repo_images(engine, repository_names, checkpoint, report)
         print("Analyzing deletion candidates. This can take awhile.")
-        delete_targets, reclaimed_bytes = delete_images(client, categorized_images, dry_run)
-
-        report_skipped(categorized_images, all_field_versions)
-        report_deleted(delete_targets, reclaimed_bytes, dry_run)
+        layer_cache = LayerCache(LAYER_CACHE)
+        layer_index, ranked = rank_deletions(categorized_images, layer_cache)
+        layer_cache.save()
+        # The scan is complete. A deletion that is interrupted scans again.
+        checkpoint.clear()
+
+        if args.command == "plan":
+            unknown = backend.fill_digests(ranked)
+            if unknown:
+                print(
+                    f"Warning: the digests of {len(unknown)} planned tags are unknown, e.g. "
+                    f"{unknown[0].repo}:{unknown[0].tags[0]}. apply skips them as 'digest unknown'."
+                )
+            num_images = write_plan(args.plan, ranked, policy)
+            report.write("planned", ranked, policy.deletion_reason)
+            report.close()
+            freed_bytes = layer_index.freed_bytes(
+                layer_index.image_id(image.repo, image.tags[0]) for image in ranked
+            )
+            print(
+                f"{num_images} images ({gb_str_from_bytes(freed_bytes)} GB) planned for "
+                f"deletion in {args.plan}"
+            )
+            return errs
+
+        deleted, requested, reclaimed_bytes, requested_bytes, failed = delete_images(
+            engine, layer_index, ranked, dry_run
+        )
+        errs += len(failed)
+        report.write("delete failed", failed)
+        report.write("delete requested", requested, policy.deletion_reason)
+        report.write("would delete" if dry_run else "deleted", deleted, policy.deletion_reason)
+        report.close()
+        report_deleted(len(deleted), reclaimed_bytes, dry_run)
+        if requested:
+            print(
+                f"{len(requested)} images ({gb_str_from_bytes(requested_bytes)} GB more) "
+                "requested for deletion by GitLab in the background."
+            )
 
     if errs:
         print("Fatal errors incurred. Script exiting.")
@@ -73,87 +194,487 @@ def main() -> int:
     return errs
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Delete image tags from the GitLab registry.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("clean", help="Delete tags that no rule retains. The default.")
+    plan_parser = subparsers.add_parser("plan", help="Write a deletion plan without deleting.")
+    plan_parser.add_argument("plan", help="The deletion plan file to write.")
+    apply_parser = subparsers.add_parser("apply", help="Delete the tags of a deletion plan.")
+    apply_parser.add_argument("plan", help="A deletion plan file written by 'plan'.")
+    return parser.parse_args()
+
+
+def gitlab_client() -> gitlab.Gitlab:
+    """A GitLab API client for bulk deletion and digest lookups, or None without a token."""
+    if os.getenv("GITLAB_TOKEN") and GITLAB_URL:
+        return gitlab.Gitlab(url=GITLAB_URL, private_token=os.getenv("GITLAB_TOKEN"))
+    return None
+
+
+def apply(backend: "GitlabRegistryBackend", plan_path: str, dry_run: bool) -> int:
+    planned = read_plan(plan_path)
+    engine = RetentionEngine(backend, None)
+    verified, changed, failed = engine.apply(planned, dry_run)
+    failed_tags = {(image.repo, image.tags[0]) for image in failed}
+    deleted = [image for image in verified if (image.repo, image.tags[0]) not in failed_tags]
+    # Tags whose planned or current digest is unknown were not compared, so they are not changed.
+    unknown_ids = {id(image) for image in backend.unknown_digests}
+    unknown = [image for image in changed if id(image) in unknown_ids]
+    changed = [image for image in changed if id(image) not in unknown_ids]
+    if unknown:
+        print(f"{len(unknown)} tags not deleted because their digests are unknown.")
+    report = JsonlReport(REPORT_FILE)
+    report.write("digest unknown", unknown)
+    report.write("changed since planned", changed)
+    report.write("delete failed", failed)
+    report.write("would delete" if dry_run else "deleted", deleted)
+    report.close()
+    # The planned sizes are the bytes freed by deleting the whole plan in order.
+    report_deleted(len(deleted), sum(image.size for image in deleted), dry_run)
+    return len(failed)
+
+
 def categorize_repo_images(
-    client: RegistryClient, repository_names: list, all_field_versions: list
+    engine: RetentionEngine,
+    repository_names: list,
+    checkpoint: ScanCheckpoint,
+    report: JsonlReport,
 ) -> dict:
     categorized_repos = {}
-    for repo in repository_names:
-        print(f"Evaluating repository: {repo}")
-        categorized_repos[repo] = {
-            "recent": [],
-            "fielded": [],
-            "prefixed": [],
-            "deletable": [],
-            "untagged": [],
-        }
-        tags = client.list_tags(repo)
-        if tags:
-            categorized_repos[repo]["untagged"] = False
-            for tag in tags:
-                if has_prefix(tag):
-                    categorized_repos[repo]["prefixed"].append(tag)
-                    continue
-
-                if is_fielded(tag, repo, all_field_versions):
-                    categorized_repos[repo]["fielded"].append(tag)
-                    continue
-
-                if is_recent(tag):
-                    categorized_repos[repo]["recent"].append(tag)
-                    continue
-
-                categorized_repos[repo]["deletable"].append(tag)
-        else:
-            categorized_repos[repo]["untagged"] = True
-
-        # For nicer reports
-        for category in ["prefixed", "fielded", "recent", "deletable"]:
-            categorized_repos[repo][category].sort()
+    for repo, categorized in engine.scan(repository_names, checkpoint):
+        report_retained(report, repo, categorized)
+        categorized_repos[repo] = categorized
 
     return categorized_repos
 
 
-def delete_images(client: RegistryClient, categorized_images: dict, dry_run: bool):
-    # num_images_deleted = 0
-    delete_targets = {}
-    all_layers = {}
-    for repo, images in categorized_images.items():
-        images_deletable = images["deletable"]
-        images_deletable.sort()
-        for image in images_deletable:
-            image_layers = get_image_layers(client, repo, image)
-            # Layers are deduplicated by overwriting shared layer infomation
-            # with the same layer information from a different image.
-            all_layers.update(image_layers)
-            image_bytes = sum(image_layers.values())
-            delete_targets[f"{repo}:{image}"] = image_bytes
-            if not dry_run:
-                client.delete(repo, image)
-
-    # Deduplicated bytes reclaimed cannot be easily calcuated outsie of this function. Return explicitly.
-    # But the sum of the per-image bytes is not deduplicated.
-    # return num_images_deleted, sum(all_layers.values())
-    return delete_targets, sum(all_layers.values())
-
-
-def find_repo_names(client: RegistryClient) -> list:
-    repositories = client.list_repositories()
-    return [r for r in repositories if any([r.startswith(p) for p in REPO_PREFIXES])]
-
+class GitlabRegistryBackend(RegistryBackend):
+    """The GitLab container registry, accessed with a RegistryClient per worker thread.
+
+    Tags are treated as separate images. The push time of a tag is the date in its name.
+
+    With a GitLab API client, the retention rules are translated to a regular expression of
+    tags to keep and a repository's tags are deleted by a single bulk deletion request.
+    Tags the expression cannot tell apart from retained ones are deleted one at a time.
+    """
+
+    def __init__(self, policy: RetentionPolicy, gl_client: gitlab.Gitlab = None) -> None:
+        self.policy = policy
+        self.gl_client = gl_client
+        # The images of bulk deletion requests, deleted by GitLab in the background.
+        self.requested = []
+        # The images verify() could not compare, their planned or current digest being unknown.
+        self.unknown_digests = []
+        # repository -> the tags listed by scan()
+        self._tags = {}
+        # repository -> its GitLab registry repository object, see gitlab_repository()
+        self._repositories = {}
+
+    def repositories(self) -> list:
+        repositories = thread_client().list_repositories()
+        return sorted(r for r in repositories if has_repo_prefix(r))
+
+    def scan(self, repo: str):
+        tags = with_retries(thread_client().list_tags, repo) or []
+        self._tags[repo] = tags
+        for tag in tags:
+            yield Image(repo, [tag], pushed_at=tag_date(tag))
+
+    def delete(self, repo: str, images: list) -> list:
+        # Bulk deletion is checked against the tags of a repository scanned by this run.
+        if self.gl_client and repo in self._tags:
+            try:
+                images = self.bulk_delete(repo, images)
+            except (RuntimeError, gitlab.exceptions.GitlabError) as e:
+                print(f"Bulk deletion not used for {repo}: {e}")
+
+        # Tags of a repository are deleted one at a time in the order given.
+        failed = []
+        for image in images:
+            try:
+                with_retries(thread_client().delete, repo, image.tags[0])
+            except Exception as e:
+                print(f"Deletion failed - {repo}:{image.name}: {e}")
+                failed.append(image)
+        return failed
+
+    def verify(self, repo: str, images: list) -> list:
+        # A tag moved to another manifest since the plan was made is not deleted. Nor is a
+        # tag whose digest is unknown, which is recorded in unknown_digests.
+        verified = []
+        for image in images:
+            digest = self.tag_digest(repo, image.tags[0]) if image.digest else ""
+            if not digest:
+                self.unknown_digests.append(image)
+            elif digest == image.digest:
+                verified.append(image)
+        return verified
+
+    def tag_digest(self, repo: str, tag: str) -> str:
+        """The manifest digest of a tag, from the registry or else from the GitLab API.
+
+        Returns:
+            str: The manifest digest, or "" if neither provided it.
+        """
+        digest = get_tag_digest(repo, tag)
+        if digest or not self.gl_client:
+            return digest
+        try:
+            return self.gitlab_repository(repo).tags.get(tag).digest or ""
+        except (RuntimeError, gitlab.exceptions.GitlabError) as e:
+            print(f"Digest lookup failed in GitLab for {repo}:{tag}: {e}")
+            return ""
+
+    def fill_digests(self, images: list) -> list:
+        """Look up the digests missing from images with tag_digest().
+
+        Returns:
+            list: The images whose digests are still unknown.
+        """
+        for image in images:
+            if not image.digest:
+                image.digest = self.tag_digest(image.repo, image.tags[0])
+        return [image for image in images if not image.digest]
+
+    def bulk_delete(self, repo: str, images: list) -> list:
+        """Request GitLab to delete every tag of a repository not matched by keep_regex().
+
+        The expression is first checked against the tags listed by scan(). If it would
+        delete a tag the rules retain, no request is made.
+
+        GitLab deletes the tags in the background, so failures are not reported back.
+        The images of the request are added to 'requested'. No age limit is sent: GitLab
+        would silently spare tags younger than the limit. Recent tags are retained by the
+        keep expression instead.
+
+        Raises:
+            RuntimeError: The expression would delete a retained tag, or the GitLab
+                repository was not found.
+            gitlab.exceptions.GitlabError: The request failed.
+
+        Returns:
+            list: The images the request leaves in place, to be deleted one at a time.
+        """
+        keep = self.keep_regex(repo)
+        bulk_deleted = {tag for tag in self._tags.get(repo, []) if not keep.match(tag)}
+        retained = bulk_deleted - {image.tags[0] for image in images}
+        if retained:
+            raise RuntimeError(
+                f"the keep expression matches {len(retained)} retained tags, e.g. {min(retained)}"
+            )
+        if bulk_deleted:
+            self.gitlab_repository(repo).tags.delete_in_bulk(
+                name_regex_delete=".*", name_regex_keep=keep.pattern
+            )
+            print(f"Bulk deletion requested - {repo}: {len(bulk_deleted)} tags")
+        self.requested.extend(image for image in images if image.tags[0] in bulk_deleted)
+        return [image for image in images if image.tags[0] not in bulk_deleted]
+
+    def keep_regex(self, repo: str) -> re.Pattern:
+        """A regular expression matching every tag of a repository that the rules retain.
+
+        The expression is valid for Python and for GitLab, which uses RE2. Tags with a
+        recent date anywhere in their name are matched, even when their last date, which
+        the rules look at, is old. Such tags are deleted one at a time.
+        """
+        alternatives = [KEEP_PATTERN.pattern]
+        if repo == self.policy.fielded_repo:
+            alternatives += [re.escape(version) for version in sorted(self.policy.field_versions)]
+        # Recent dates run from tomorrow, for tags from clocks ahead of this one, to the
+        # day after the cutoff day, as a date is recent if its midnight is after the cutoff.
+        today = date.today()
+        for days in range(-1, self.policy.keep_days):
+            day = today - timedelta(days=days)
+            alternatives.append(f".*{day:%Y}\\D?{day:%m}\\D?{day:%d}.*")
+        return re.compile(f"^(?:{'|'.join(alternatives)})$")
+
+    def gitlab_repository(self, repo: str):
+        """The registry repository object of the GitLab project owning a repository path."""
+        if repo in self._repositories:
+            return self._repositories[repo]
+        # The project path is the repository path or one of its leading parts.
+        parts = repo.split("/")
+        for num_parts in range(len(parts), 1, -1):
+            try:
+                project = self.gl_client.projects.get("/".join(parts[:num_parts]))
+            except gitlab.exceptions.GitlabGetError:
+                continue
+            for repository in project.repositories.list(iterator=True):
+                if repository.path == repo:
+                    self._repositories[repo] = repository
+                    return repository
+        raise RuntimeError(f"no GitLab project owns the registry repository {repo}")
+
+
+class LayerCache:
+    """Layer digests and sizes of image manifests, kept on disk between runs.
+
+    Manifests are content addressed, so the layers of a manifest digest never change.
+    A tag whose current digest is in the cache does not need its manifest downloaded.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = Path(path)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # manifest digest -> {"layers": {layer digest: size}, "last_seen": <epoch seconds>}
+        self._manifests = {}
+        try:
+            with open(self.path) as f:
+                self._manifests = json.load(f).get("manifests", {})
+            print(f"Loaded {len(self._manifests)} cached manifests from {self.path}")
+        except (OSError, ValueError) as e:
+            print(f"Layer cache not loaded, starting empty: {e}")
+
+    def get(self, digest: str):
+        with self._lock:
+            entry = self._manifests.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry["last_seen"] = time.time()
+            return entry["layers"]
+
+    def put(self, digest: str, layers: dict) -> None:
+        with self._lock:
+            self._manifests[digest] = {"layers": layers, "last_seen": time.time()}
+
+    def save(self) -> None:
+        cutoff = time.time() - LAYER_CACHE_MAX_AGE_DAYS * 24 * 3600
+        with self._lock:
+            manifests = {d: e for d, e in self._manifests.items() if e["last_seen"] >= cutoff}
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # Write then rename so an interrupted run cannot leave a truncated cache.
+            tmp_path = self.path.with_suffix(".tmp")
+            with open(tmp_path, "w") as f:
+                json.dump({"manifests": manifests}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Layer cache not saved: {e}")
+            return
+        print(
+            f"Layer cache: {self.hits} hits, {self.misses} misses, {len(manifests)} manifests saved to {self.path}"
+        )
 
-def gb_str_from_bytes(num_bytes: int) -> str:
-    return f"{num_bytes / (1024**3):.2f}"
 
+class LayerIndex:
+    """Registry-wide index of the images referencing each layer.
+
+    Layers are stored once no matter how many images share them, so the bytes freed by
+    deleting a set of images are the sizes of the layers referenced by no other image.
+    Layer digests are interned to integer ids and the references are kept in arrays of
+    ids, which keeps the index small for registries with many thousands of tags.
+    """
+
+    def __init__(self) -> None:
+        # image id -> (repository, tag)
+        self.images = []
+        self._image_ids = {}
+        # layer digest -> layer id
+        self._layer_ids = {}
+        # layer id -> layer size in bytes
+        self._layer_sizes = array("Q")
+        # layer id -> ids of the images referencing the layer
+        self._layer_refs = []
+        # image id -> ids of the layers of the image
+        self._image_layers = []
+
+    def add_image(self, repo: str, tag: str, layers: dict) -> int:
+        image_id = len(self.images)
+        self.images.append((repo, tag))
+        self._image_ids[(repo, tag)] = image_id
+        layer_ids = array("I")
+        for digest, size in layers.items():
+            layer_id = self._layer_ids.get(digest)
+            if layer_id is None:
+                layer_id = len(self._layer_sizes)
+                self._layer_ids[digest] = layer_id
+                self._layer_sizes.append(size)
+                self._layer_refs.append(array("I"))
+            self._layer_refs[layer_id].append(image_id)
+            layer_ids.append(layer_id)
+        self._image_layers.append(layer_ids)
+        return image_id
+
+    def image_id(self, repo: str, tag: str) -> int:
+        return self._image_ids[(repo, tag)]
+
+    def freed_bytes(self, image_ids) -> int:
+        """The bytes freed once the given images are deleted and the registry is garbage collected."""
+        image_ids = set(image_ids)
+        layer_ids = {
+            layer_id for image_id in image_ids for layer_id in self._image_layers[image_id]
+        }
+        return sum(
+            self._layer_sizes[layer_id]
+            for layer_id in layer_ids
+            if all(ref in image_ids for ref in self._layer_refs[layer_id])
+        )
 
-def get_deployed_containers() -> list:
-    try:
-        df = get_oee_config_permutations()
-    except OperationalError as e:
-        raise RuntimeError(e)
-    df = df[~df.site.isin(["sim", "hilsim", "TOR_DEN_1"])]
-    all_versions = df["container_version"].unique().tolist()
+    def rank_by_marginal_bytes(self, image_ids) -> list:
+        """Order deletion candidates so the images freeing the most storage come first.
+
+        The marginal bytes of a candidate are the sizes of its layers that no image other
+        than the candidate still references. Deleting a candidate can only raise the
+        marginal bytes of the remaining ones, so a greedy pass with a lazily updated heap
+        picks the largest remaining candidate at every step. The marginal bytes of all
+        candidates add up to freed_bytes() of the candidate set.
+
+        Args:
+            image_ids: The ids of the deletion candidates.
+
+        Returns:
+            list: (image id, marginal bytes) tuples, largest first.
+        """
+        candidates = set(image_ids)
+        remaining_refs = array("I", (len(refs) for refs in self._layer_refs))
+        marginal = {}
+        for image_id in candidates:
+            marginal[image_id] = sum(
+                self._layer_sizes[layer_id]
+                for layer_id in self._image_layers[image_id]
+                if remaining_refs[layer_id] == 1
+            )
+        # Ties are broken by image id, which follows the sorted repository and tag order.
+        heap = [(-num_bytes, image_id) for image_id, num_bytes in marginal.items()]
+        heapq.heapify(heap)
+
+        ranked = []
+        deleted = set()
+        while heap:
+            neg_bytes, image_id = heapq.heappop(heap)
+            if image_id in deleted or -neg_bytes != marginal[image_id]:
+                # A stale entry; the image was re-queued with a larger value.
+                continue
+            deleted.add(image_id)
+            ranked.append((image_id, -neg_bytes))
+            for layer_id in self._image_layers[image_id]:
+                remaining_refs[layer_id] -= 1
+                if remaining_refs[layer_id] != 1:
+                    continue
+                # The layer is now referenced by a single image. If that image is a
+                # candidate, deleting it frees the layer too.
+                for ref in self._layer_refs[layer_id]:
+                    if ref in candidates and ref not in deleted:
+                        marginal[ref] += self._layer_sizes[layer_id]
+                        heapq.heappush(heap, (-marginal[ref], ref))
+                        break
+
+        return ranked
+
+
+def rank_deletions(categorized_images: dict, layer_cache: LayerCache) -> tuple:
+    """Inspect every image and order the deletable ones by the bytes their deletion frees.
+
+    An image whose manifest cannot be inspected has unknown layers. A retained one is
+    assumed to hold every layer of the other images of its repository, so that no layer
+    it may share is counted as freed. A deletable one is deleted but frees no bytes.
+
+    Returns:
+        tuple: (<LayerIndex>, <deletable images, most bytes freed first>). The size of a
+        deletable image is set to the bytes its deletion frees and its digest is set to
+        the manifest digest of its tag.
+    """
+    # Every tag is inspected, not only the deletable ones, because layers shared with
+    # retained images are not freed. The layer cache keeps repeated runs cheap.
+    # Image inspection runs on a thread pool. Order is preserved by map().
+    targets = [
+        (repo, image.tags[0])
+        for repo, images in categorized_images.items()
+        for category_images in images.values()
+        for image in category_images
+    ]
+    deletable = {
+        (repo, image.tags[0]): image
+        for repo, images in categorized_images.items()
+        for image in images[DELETABLE]
+    }
+    progress = ProgressCounter("Images inspected", len(targets))
+
+    def inspect(target):
+        try:
+            digest_layers = with_retries(
+                get_cached_image_layers, thread_client(), *target, layer_cache
+            )
+        except Exception as e:
+            print(f"Inspection failed - {target[0]}:{target[1]}: {e}")
+            digest_layers = "", {}
+        progress.increment()
+        return digest_layers
+
+    layer_index = LayerIndex()
+    # repository -> the layers of its inspected images
+    repo_layers = {}
+    uninspected = []
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for target, (digest, layers) in zip(targets, executor.map(inspect, targets)):
+            if target in deletable:
+                deletable[target].digest = digest
+            elif not layers:
+                uninspected.append(target)
+                continue
+            layer_index.add_image(*target, layers)
+            repo_layers.setdefault(target[0], {}).update(layers)
+    for target in uninspected:
+        layer_index.add_image(*target, repo_layers.get(target[0], {}))
+    if uninspected:
+        print(
+            f"{len(uninspected)} retained images not inspected, "
+            "assumed to hold every layer of their repository"
+        )
 
-    return all_versions
+    # Deleting the images that free the most storage first means an interrupted
+    # run has still relieved as much storage pressure as it could.
+    ranked = []
+    for image_id, marginal_bytes in layer_index.rank_by_marginal_bytes(
+        layer_index.image_id(*target) for target in sorted(deletable)
+    ):
+        image = deletable[layer_index.images[image_id]]
+        image.size = marginal_bytes
+        ranked.append(image)
+
+    return layer_index, ranked
+
+
+def delete_images(engine: RetentionEngine, layer_index: LayerIndex, ranked: list, dry_run: bool):
+    """Delete images ranked by rank_deletions().
+
+    Returns:
+        tuple: (<deleted images>, <images of bulk deletion requests>, <bytes reclaimed>,
+        <bytes reclaimed once GitLab deletes the requested images too>,
+        <images that could not be deleted>)
+    """
+    failed = []
+    if not dry_run:
+        # The engine deletes repositories concurrently, each in ranked order.
+        failed = engine.delete(group_by_repo(ranked))
+    failed_tags = {(image.repo, image.tags[0]) for image in failed}
+    requested_tags = {(image.repo, image.tags[0]) for image in engine.backend.requested}
+    deleted = []
+    requested = []
+    for image in ranked:
+        target = (image.repo, image.tags[0])
+        if target in requested_tags:
+            requested.append(image)
+        elif target not in failed_tags:
+            deleted.append(image)
+
+    # With failed deletes the per-image marginal bytes no longer add up, so the totals
+    # are computed over the images actually deleted.
+    reclaimed_bytes = layer_index.freed_bytes(
+        layer_index.image_id(image.repo, image.tags[0]) for image in deleted
+    )
+    requested_bytes = (
+        layer_index.freed_bytes(
+            layer_index.image_id(image.repo, image.tags[0]) for image in deleted + requested
+        )
+        - reclaimed_bytes
+    )
+    return deleted, requested, reclaimed_bytes, requested_bytes, failed
 
 
 def get_image_layers(client: RegistryClient, repository_name: str, image: str) -> int:
@@ -170,56 +691,102 @@ def get_image_layers(client: RegistryClient, repository_name: str, image: str) -
     return layer_info
 
 
-def get_image_size(client: RegistryClient, repository_name: str, image: str) -> int:
+def get_cached_image_layers(
+    client: RegistryClient, repository_name: str, image: str, layer_cache: LayerCache
+) -> tuple:
+    """The manifest digest and the layers of a tag. The digest is "" if it is unknown."""
+    digest = get_tag_digest(repository_name, image)
+    if digest:
+        layers = layer_cache.get(digest)
+        if layers is not None:
+            return digest, layers
+
     layers = get_image_layers(client, repository_name, image)
-    if layers:
-        return sum(layers.values())
+    if digest and layers:
+        layer_cache.put(digest, layers)
+    return digest, layers
 
-    return 0
 
+def get_tag_digest(repository_name: str, tag: str) -> str:
+    """Look up the manifest digest of a tag with a HEAD request.
 
-def has_prefix(tag: str) -> bool:
-    for prefix_pattern in TAG_KEEP_PATTERNS:
-        if prefix_pattern.match(tag):
-            return True
-    return False
+    A HEAD request returns the digest in a header without transferring the manifest.
 
+    Returns:
+        str: The manifest digest, or "" if the registry did not provide one.
+    """
+    session = thread_session()
+    url = f"https://{REGISTRY_URL}/v2/{repository_name}/manifests/{tag}"
+    scope = f"repository:{repository_name}:pull"
+    try:
+        response = session.head(url, headers=registry_headers(scope), timeout=30)
+        if response.status_code == 401:
+            # Registries issue bearer tokens per repository scope. Get one and try again.
+            _registry_tokens[scope] = get_registry_token(
+                session, response.headers.get("WWW-Authenticate", "")
+            )
+            response = session.head(url, headers=registry_headers(scope), timeout=30)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        print(f"Digest lookup failed for {repository_name}:{tag}: {e}")
+        return ""
+
+    return response.headers.get("Docker-Content-Digest", "")
+
+
+def get_registry_token(session: requests.Session, challenge: str) -> str:
+    """Request a bearer token as described by a registry's WWW-Authenticate challenge."""
+    params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+    realm = params.pop("realm", "")
+    if not realm:
+        raise requests.RequestException(
+            f"Unsupported registry authentication challenge: {challenge}"
+        )
 
-def is_fielded(tag: str, repository: str, all_field_versions) -> bool:
-    if repository == MFR and tag in all_field_versions:
-        return True
-    return False
+    user = os.getenv("REGISTRY_USER", os.getenv("CI_REGISTRY_USER"))
+    password = os.getenv("REGISTRY_PASSWORD", os.getenv("CI_REGISTRY_PASSWORD"))
+    auth = (user, password) if user and password else None
+    response = session.get(realm, params=params, auth=auth, timeout=30)
+    response.raise_for_status()
+    body = response.json()
+    return body.get("token") or body.get("access_token", "")
 
 
-def is_recent(tag: str) -> bool:
-    pushed_at = None
-    match = re.search(DATE_PATTERN, tag)
-    if match:
-        pushed_at = datetime.strptime(
-            f"{match.group(1)}.{match.group(2)}.{match.group(3)}",
-            "%Y.%m.%d",
-        )
-        # Dates are in local time.
-        # pushed_at is tz-naive
-        cutoff_date = datetime.now() - timedelta(days=KEEP_DAYS)
-        if pushed_at and pushed_at >= cutoff_date:
-            return True
+def registry_headers(scope: str) -> dict:
+    headers = {"Accept": MANIFEST_MEDIA_TYPES}
+    token = _registry_tokens.get(scope)
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    return headers
+
 
-    return False
+def thread_client() -> RegistryClient:
+    """The RegistryClient of the calling thread."""
+    if not hasattr(_thread_local, "client"):
+        _thread_local.client = RegistryClient(hostname=REGISTRY_URL)
+    return _thread_local.client
 
 
-def report_deleted(delete_targets: dict, total_bytes: int, dry_run: bool):
-    report_lines = []
-    for repo_tag, bytes_deleted in delete_targets.items():
-        image_gb = gb_str_from_bytes(bytes_deleted)
-        if dry_run:
-            report_lines.append(f"Deleted (simulated) - {repo_tag}: size = {image_gb} GB")
-        else:
-            report_lines.append(f"Deleted - {repo_tag}: size = {image_gb} GB")
+def thread_session() -> requests.Session:
+    """The requests Session of the calling thread."""
+    if not hasattr(_thread_local, "session"):
+        _thread_local.session = requests.Session()
+    return _thread_local.session
 
-    print("\n".join(report_lines))
 
-    num_images = len(delete_targets)
+def with_retries(func, *args):
+    """Call a registry function, retrying with a growing delay when it raises."""
+    for attempt in range(1, REQUEST_ATTEMPTS + 1):
+        try:
+            return func(*args)
+        except Exception as e:
+            if attempt == REQUEST_ATTEMPTS:
+                raise
+            print(f"Attempt {attempt} of {func.__name__} failed, retrying: {e}")
+            time.sleep(RETRY_DELAY_SECONDS * attempt)
+
+
+def report_deleted(num_images: int, total_bytes: int, dry_run: bool):
     gb_deleted = gb_str_from_bytes(total_bytes)
     if dry_run:
         print(f"{num_images} images, " f"({gb_deleted} GB) would be reclaimed.")
@@ -227,29 +794,5 @@ def report_deleted(delete_targets: dict, total_bytes: int, dry_run: bool):
         print(f"{num_images} images deleted and " f"({gb_deleted} GB) were reclaimed.")
 
 
-def report_skipped(categorized_images: dict, deployed_images) -> None:
-    print("All images deployed in the field: " f"{deployed_images} ({len(deployed_images)} images)")
-
-    recent = []
-    fielded = []
-    prefixed = []
-    untagged = []
-    for repo in categorized_images.keys():
-        per_repo_images = categorized_images[repo]
-        recent += [f"Retained - Recent: {repo}: {tag}" for tag in per_repo_images["recent"]]
-        fielded += [
-            f"Retained - Deployed in the field: {repo}: {tag}" for tag in per_repo_images["fielded"]
-        ]
-        prefixed += [
-            f"Retained - Prefix match: {repo}: {tag}" for tag in per_repo_images["prefixed"]
-        ]
-        if per_repo_images["untagged"]:
-            untagged.append(f"Retained - No tags found in repo: {repo}")
-
-    for categorized in [recent, fielded, prefixed, untagged]:
-        categorized.sort()
-        print("\n".join(categorized))
-
-
 if __name__ == "__main__":
     sys.exit(main())
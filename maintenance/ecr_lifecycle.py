@@ -0,0 +1,319 @@
+"""
+Compiles the registry retention rules to ECR lifecycle policies and simulates them.
+
+ECR applies lifecycle policies by itself, so routine pruning does not need image
+listings to be downloaded. A policy holds:
+  - A rule per keep pattern. Each selects the matching tagged images and expires only
+    images beyond a count no repository reaches, so the images are never expired. An
+    image selected by a rule cannot be expired by a rule with a lower priority.
+  - A last rule expiring every other image pushed more than keep_days days ago.
+
+The repository of the versions deployed in the field gets no policy. Its keep rules would
+be frozen when the policy is compiled, and ECR would expire a version deployed or rolled
+back to afterwards. clean-ecr.py queries the deployed versions on every run instead.
+
+Lifecycle tag patterns only support the '*' wildcard. Keep patterns are translated to
+wildcard patterns that match every tag the regular expression matches, and possibly
+more. Images kept only because of a broader wildcard are left to clean-ecr.py.
+
+A tag pattern list selects images having all of its patterns, which is why every
+pattern gets a rule of its own.
+"""
+
+import json
+import re
+from datetime import datetime, timedelta, timezone
+
+from registry_retention import DELETABLE, TAG_KEEP_PATTERNS, Image, RetentionPolicy
+
+# Keep rules expire images beyond this count, which no repository reaches.
+KEEP_COUNT = 1000000
+# ECR rejects lifecycle policies with more rules.
+MAX_RULES = 50
+# ECR rejects tag patterns with more wildcards.
+MAX_WILDCARDS = 4
+
+# Marks a token of a regular expression that becomes a wildcard.
+_WILD = None
+
+
+def compile_policy(policy: RetentionPolicy, repo: str) -> dict:
+    """Compile the retention rules for a repository to a lifecycle policy.
+
+    Args:
+        policy (RetentionPolicy): The rules to compile.
+        repo (str): The repository the lifecycle policy is for.
+
+    Raises:
+        RuntimeError: The repository is the fielded repository, or the rules need more
+            lifecycle rules than ECR allows. Leave the repository to clean-ecr.py.
+
+    Returns:
+        dict: The lifecycle policy. json.dumps() gives the policy text.
+    """
+    if repo == policy.fielded_repo:
+        raise RuntimeError(
+            f"{repo} keeps the versions deployed in the field, which change between runs."
+        )
+
+    keeps = []
+    for regex in TAG_KEEP_PATTERNS:
+        for pattern in wildcard_patterns(regex):
+            if pattern not in [p for p, _ in keeps]:
+                keeps.append((pattern, f"Keep tags matching {regex}"))
+    if len(keeps) + 1 > MAX_RULES:
+        raise RuntimeError(
+            f"{repo} needs {len(keeps) + 1} lifecycle rules, more than the {MAX_RULES} ECR allows."
+        )
+
+    rules = [
+        {
+            "rulePriority": priority,
+            "description": description,
+            "selection": {
+                "tagStatus": "tagged",
+                "tagPatternList": [pattern],
+                "countType": "imageCountMoreThan",
+                "countNumber": KEEP_COUNT,
+            },
+            "action": {"type": "expire"},
+        }
+        for priority, (pattern, description) in enumerate(keeps, start=1)
+    ]
+    # A rule selecting any tag status must have the lowest priority.
+    rules.append(
+        {
+            "rulePriority": len(rules) + 1,
+            "description": f"Expire images pushed more than {policy.keep_days} days ago",
+            "selection": {
+                "tagStatus": "any",
+                "countType": "sinceImagePushed",
+                "countUnit": "days",
+                "countNumber": policy.keep_days,
+            },
+            "action": {"type": "expire"},
+        }
+    )
+    return {"rules": rules}
+
+
+def wildcard_patterns(regex: str) -> list:
+    """Translate a regular expression to lifecycle tag patterns.
+
+    The patterns match every tag the expression matches, and possibly more. Literal
+    characters are kept and everything else, e.g. classes, groups and repeated
+    characters, becomes a '*' wildcard.
+
+    Args:
+        regex (str): A regular expression matched against a whole tag.
+
+    Returns:
+        list: A pattern per alternative of the expression.
+    """
+    return [_branch_pattern(branch) for branch in _split_alternatives(regex)]
+
+
+def _split_alternatives(regex: str) -> list:
+    branches = []
+    depth = 0
+    start = 0
+    i = 0
+    while i < len(regex):
+        c = regex[i]
+        if c == "\\":
+            i += 1
+        elif c == "[":
+            i = _class_end(regex, i)
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "|" and depth == 0:
+            branches.append(regex[start:i])
+            start = i + 1
+        i += 1
+    branches.append(regex[start:])
+    return branches
+
+
+def _class_end(regex: str, i: int) -> int:
+    """The index of the ']' closing the character class opened at index i."""
+    i += 1
+    if i < len(regex) and regex[i] == "^":
+        i += 1
+    if i < len(regex) and regex[i] == "]":
+        # A ']' first in a class is a literal.
+        i += 1
+    while i < len(regex) and regex[i] != "]":
+        if regex[i] == "\\":
+            i += 1
+        i += 1
+    return i
+
+
+def _group_end(regex: str, i: int) -> int:
+    """The index of the ')' closing the group opened at index i."""
+    depth = 0
+    while i < len(regex):
+        c = regex[i]
+        if c == "\\":
+            i += 1
+        elif c == "[":
+            i = _class_end(regex, i)
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    return i
+
+
+def _branch_pattern(regex: str) -> str:
+    anchored_start = regex.startswith("^")
+    anchored_end = regex.endswith("$") and not regex.endswith("\\$")
+    regex = regex[int(anchored_start) : len(regex) - int(anchored_end)]
+
+    # Literal characters, or _WILD for anything else.
+    tokens = [] if anchored_start else [_WILD]
+    i = 0
+    while i < len(regex):
+        c = regex[i]
+        if c == "\\":
+            escaped = regex[i + 1 : i + 2]
+            # \d, \w, \b etc. are classes or assertions. Others are escaped literals.
+            tokens.append(_WILD if escaped.isalnum() else escaped)
+            i += 1
+        elif c == "[":
+            tokens.append(_WILD)
+            i = _class_end(regex, i)
+        elif c == "(":
+            tokens.append(_WILD)
+            i = _group_end(regex, i)
+        elif c in "*+?{":
+            # A repeated or optional token can be any number of characters.
+            if c == "{":
+                i = regex.index("}", i)
+            if tokens:
+                tokens[-1] = _WILD
+        elif c in ".^$":
+            tokens.append(_WILD)
+        else:
+            tokens.append(c)
+        i += 1
+    if not anchored_end:
+        tokens.append(_WILD)
+
+    pattern = re.sub(r"\*+", "*", "".join("*" if token is _WILD else token for token in tokens))
+
+    segments = pattern.split("*")
+    if len(segments) - 1 > MAX_WILDCARDS:
+        # Dropping the literals between wildcards only broadens the pattern.
+        segments = segments[:MAX_WILDCARDS] + segments[-1:]
+        pattern = "*".join(segments)
+    return pattern
+
+
+def simulate(lifecycle_policy: dict, images: list, now: datetime = None) -> set:
+    """Evaluate a lifecycle policy the way ECR does.
+
+    Args:
+        lifecycle_policy (dict): A policy from compile_policy().
+        images (list): The Image objects of one repository.
+        now (datetime, optional): The evaluation time. Defaults to the current time.
+
+    Returns:
+        set: The digests of the images the policy expires.
+    """
+    now = now or datetime.now(timezone.utc)
+    selected = set()
+    expired = set()
+    for rule in sorted(lifecycle_policy["rules"], key=lambda r: r["rulePriority"]):
+        selection = rule["selection"]
+        matching = [
+            image
+            for image in images
+            if image.digest not in selected and _selects(selection, image.tags)
+        ]
+        selected.update(image.digest for image in matching)
+        if selection["countType"] == "imageCountMoreThan":
+            matching.sort(key=lambda image: image.pushed_at, reverse=True)
+            expired.update(image.digest for image in matching[selection["countNumber"] :])
+        else:
+            cutoff_time = now - timedelta(days=selection["countNumber"])
+            expired.update(image.digest for image in matching if image.pushed_at < cutoff_time)
+    return expired
+
+
+def _selects(selection: dict, tags: list) -> bool:
+    status = selection["tagStatus"]
+    if status == "untagged":
+        return not tags
+    if status == "any":
+        return True
+    if not tags:
+        return False
+    patterns = [
+        re.compile(".*".join(re.escape(part) for part in pattern.split("*")))
+        for pattern in selection.get("tagPatternList", [])
+    ]
+    patterns += [
+        re.compile(re.escape(prefix) + ".*") for prefix in selection.get("tagPrefixList", [])
+    ]
+    # An image is selected when every pattern matches one of its tags.
+    return all(any(pattern.fullmatch(tag) for tag in tags) for pattern in patterns)
+
+
+def compare(policy: RetentionPolicy, lifecycle_policy: dict, images: list) -> dict:
+    """Compare what a lifecycle policy expires with what the retention rules delete.
+
+    Returns:
+        dict: Image lists by outcome:
+            "expired":  Expired by the lifecycle policy and deletable by the rules.
+            "unsafe":   Expired by the lifecycle policy but retained by the rules.
+                        Should always be empty.
+            "client":   Deletable by the rules but kept by the lifecycle policy.
+                        clean-ecr.py still deletes these.
+    """
+    expired = simulate(lifecycle_policy, images)
+    outcomes = {"expired": [], "unsafe": [], "client": []}
+    for image in images:
+        deletable = policy.classify(image) == DELETABLE
+        if image.digest in expired:
+            outcomes["expired" if deletable else "unsafe"].append(image)
+        elif deletable:
+            outcomes["client"].append(image)
+    return outcomes
+
+
+def write_listings(path: str, images) -> int:
+    """Write images as JSON lines for later simulation. Returns the number written."""
+    count = 0
+    with open(path, "w") as f:
+        for image in images:
+            record = {
+                "repo": image.repo,
+                "tags": image.tags,
+                "digest": image.digest,
+                "size": image.size,
+                "pushed_at": image.pushed_at.isoformat(),
+            }
+            f.write(json.dumps(record) + "\n")
+            count += 1
+    return count
+
+
+def read_listings(path: str) -> dict:
+    """Read images written by write_listings().
+
+    Returns:
+        dict: Repository -> [Image, ...].
+    """
+    images_by_repo = {}
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            record["pushed_at"] = datetime.fromisoformat(record["pushed_at"])
+            images_by_repo.setdefault(record["repo"], []).append(Image(**record))
+    return images_by_repo
@@ -0,0 +1,568 @@
+"""
+Retention rules and the scan/delete engine shared by the registry cleanup scripts.
+
+clean-ecr.py and clean-gitlab-registry.py apply the same rules to different registries.
+Each script supplies a RegistryBackend that lists the images of a repository and deletes
+images. The RetentionEngine scans repositories concurrently, classifies each image with
+a RetentionPolicy and streams the results back one repository at a time.
+
+An image is retained, in order of precedence, when:
+  keep_pattern: A tag matches one of TAG_KEEP_PATTERNS.
+  fielded:      A tag of the main full runtime repository is deployed in the field.
+  recent:       The image was pushed within the last keep_days days.
+Every other image is deletable.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+MFR = "redacted/main-full-runtime"
+REPO_PREFIXES = [
+    "redacted/arm",
+    "redacted/hwif",
+    "redacted/fiddle",
+    "redacted/gong",
+    "redacted/main",
+]
+TAG_KEEP_PATTERNS = [
+    r"^.*latest$",
+    r"^dev_nightly$",
+    r"^rel-\d{4}\.\d{2}\.\d{2}(?:_\d+)?$",
+    r"^rel-\d{4}\.\d{2}\.\d{2}_nightly$",
+]
+# All keep patterns in one expression, so a tag is matched in a single pass.
+KEEP_PATTERN = re.compile("|".join(f"(?:{pattern})" for pattern in TAG_KEEP_PATTERNS))
+DATE_PATTERN = re.compile(r".*(\d{4})\D?(0[1-9]|1[0-2])\D?([12]\d|0[1-9]|3[01]).*$")
+# Versions deployed to these sites are not in the field.
+NON_FIELD_SITES = ["sim", "hilsim", "TOR_DEN_1"]
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "8"))
+# A snapshot of the versions deployed in the field, shared by the cleanup scripts.
+DEPLOYED_VERSIONS_CACHE = os.getenv(
+    "DEPLOYED_VERSIONS_CACHE",
+    str(Path.home() / ".cache" / "registry-retention" / "deployed-versions.json"),
+)
+DEPLOYED_VERSIONS_TTL_HOURS = float(os.getenv("DEPLOYED_VERSIONS_TTL_HOURS", "6"))
+# A file listing deployed versions, one per line, used instead of the database.
+DEPLOYED_VERSIONS_FILE = os.getenv("DEPLOYED_VERSIONS_FILE", "")
+
+KEEP = "keep_pattern"
+FIELDED = "fielded"
+RECENT = "recent"
+DELETABLE = "deletable"
+CATEGORIES = [KEEP, FIELDED, RECENT, DELETABLE]
+RETAINED = [KEEP, FIELDED, RECENT]
+
+
+@dataclass
+class Image:
+    """An image in a registry repository.
+
+    Registries without image metadata, such as the GitLab registry, leave digest,
+    size and pushed_at unset.
+    """
+
+    repo: str
+    tags: list = field(default_factory=list)
+    digest: str = ""
+    size: int = 0
+    pushed_at: datetime = None
+
+    @property
+    def name(self) -> str:
+        return ",".join(self.tags) or self.digest or "untagged"
+
+    def to_record(self) -> dict:
+        record = {"repo": self.repo, "tags": self.tags, "digest": self.digest, "size": self.size}
+        record["pushed_at"] = self.pushed_at.isoformat() if self.pushed_at else None
+        return record
+
+    @classmethod
+    def from_record(cls, record: dict) -> "Image":
+        pushed_at = record.get("pushed_at")
+        return cls(
+            record["repo"],
+            record.get("tags", []),
+            record.get("digest", ""),
+            record.get("size", 0),
+            datetime.fromisoformat(pushed_at) if pushed_at else None,
+        )
+
+
+class ProgressCounter:
+    """A thread-safe counter that periodically prints progress."""
+
+    def __init__(self, action: str, total: int = 0, report_every: int = 100) -> None:
+        self.action = action
+        self.total = total
+        self.report_every = report_every
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def increment(self, n: int = 1) -> None:
+        with self._lock:
+            reports_before = self.count // self.report_every
+            self.count += n
+            if self.count // self.report_every > reports_before or self.count == self.total:
+                total = f"/{self.total}" if self.total else ""
+                print(f"{self.action}: {self.count}{total}")
+
+
+class RetentionPolicy:
+    """Decides whether an image is retained and why."""
+
+    def __init__(
+        self, keep_days: int, field_versions: frozenset = frozenset(), fielded_repo: str = MFR
+    ) -> None:
+        """
+        Args:
+            keep_days (int): Images pushed within this many days are retained.
+            field_versions (frozenset): Container versions deployed in the field.
+            fielded_repo (str, optional): The repository whose tags are deployed. Defaults to MFR.
+        """
+        self.keep_days = keep_days
+        self.field_versions = frozenset(field_versions)
+        self.fielded_repo = fielded_repo
+
+    def classify(self, image: Image) -> str:
+        """The category of an image: KEEP, FIELDED, RECENT or DELETABLE."""
+        if any(matches_keep_pattern(tag) for tag in image.tags):
+            return KEEP
+        if image.repo == self.fielded_repo and not self.field_versions.isdisjoint(image.tags):
+            return FIELDED
+        if self.is_recent(image.pushed_at):
+            return RECENT
+        return DELETABLE
+
+    def deletion_reason(self, image: Image) -> str:
+        """Why a deletable image is not retained, for deletion plans."""
+        if image.pushed_at is None:
+            return "no push date"
+        return f"pushed {image.pushed_at:%Y-%m-%d}, over {self.keep_days} days ago"
+
+    def is_recent(self, pushed_at: datetime) -> bool:
+        if pushed_at is None:
+            return False
+        # Naive times are compared with the local time, aware ones in their own time zone.
+        cutoff_time = datetime.now(pushed_at.tzinfo) - timedelta(days=self.keep_days)
+        return pushed_at >= cutoff_time
+
+
+class RegistryBackend:
+    """The registry operations used by the RetentionEngine.
+
+    Methods are called from worker threads, one repository per thread at a time.
+    """
+
+    def repositories(self) -> list:
+        """The names of the repositories to clean."""
+        raise NotImplementedError
+
+    def scan(self, repo: str):
+        """Yield an Image for each image in a repository."""
+        raise NotImplementedError
+
+    def delete(self, repo: str, images: list) -> list:
+        """Delete images from a repository.
+
+        Returns:
+            list: The images that could not be deleted.
+        """
+        raise NotImplementedError
+
+    def verify(self, repo: str, images: list) -> list:
+        """Check images of a deletion plan against the registry.
+
+        Returns:
+            list: The images whose tags still point to the planned digests.
+        """
+        raise NotImplementedError
+
+
+class RetentionEngine:
+    """Applies a RetentionPolicy to the repositories of a RegistryBackend."""
+
+    def __init__(
+        self, backend: RegistryBackend, policy: RetentionPolicy, max_workers: int = MAX_WORKERS
+    ) -> None:
+        self.backend = backend
+        self.policy = policy
+        self.max_workers = max_workers
+
+    def scan(self, repositories: list, checkpoint: "ScanCheckpoint" = None):
+        """Scan and classify repositories concurrently.
+
+        Args:
+            repositories (list): The repositories to scan.
+            checkpoint (ScanCheckpoint, optional): Repositories completed by an earlier,
+                interrupted scan are yielded from the checkpoint instead of being scanned
+                again. Each completed repository is added to the checkpoint.
+
+        Yields:
+            tuple: (<repository>, {<category>: [Image, ...]}) as each repository's scan
+            completes. Repositories are not yielded in any particular order.
+        """
+        remaining = list(repositories)
+        if checkpoint and checkpoint.completed:
+            print(f"Resuming scan: {len(checkpoint.completed)} repositories from {checkpoint.path}")
+            remaining = [repo for repo in remaining if repo not in checkpoint.completed]
+            yield from checkpoint.results()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = {executor.submit(self._scan_repo, repo) for repo in remaining}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    if checkpoint:
+                        checkpoint.record(*result)
+                    yield result
+
+    def _scan_repo(self, repo: str):
+        categorized = {category: [] for category in CATEGORIES}
+        for image in self.backend.scan(repo):
+            categorized[self.policy.classify(image)].append(image)
+        return repo, categorized
+
+    def delete(self, deletions) -> list:
+        """Delete images concurrently, one repository per worker.
+
+        Args:
+            deletions: (<repository>, [Image, ...]) tuples. Deletion of a repository's
+                images starts as soon as its tuple is produced, so a generator lets
+                deletions overlap a scan.
+
+        Returns:
+            list: The images that could not be deleted.
+        """
+        progress = ProgressCounter("Images deleted")
+
+        def delete_repo(repo: str, images: list) -> list:
+            failed = self.backend.delete(repo, images)
+            progress.increment(len(images))
+            return failed
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [
+                executor.submit(delete_repo, repo, images) for repo, images in deletions if images
+            ]
+            for future in futures:
+                failed.extend(future.result())
+        return failed
+
+    def apply(self, planned: dict, dry_run: bool) -> tuple:
+        """Delete the images of a deletion plan that have not changed since it was made.
+
+        Each repository is verified and deleted by one worker, so a repository's images
+        are deleted right after they are verified.
+
+        Args:
+            planned (dict): Repository -> [Image, ...], e.g. from read_plan().
+            dry_run (bool): Verify the images without deleting them.
+
+        Returns:
+            tuple: (<verified images>, <changed images>, <images that could not be deleted>)
+        """
+        progress = ProgressCounter(
+            "Images verified", sum(len(images) for images in planned.values())
+        )
+
+        def apply_repo(repo: str, images: list) -> tuple:
+            verified = self.backend.verify(repo, images)
+            progress.increment(len(images))
+            failed = self.backend.delete(repo, verified) if verified and not dry_run else []
+            return verified, failed
+
+        verified = []
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [
+                executor.submit(apply_repo, repo, images) for repo, images in planned.items()
+            ]
+            for future in futures:
+                repo_verified, repo_failed = future.result()
+                verified += repo_verified
+                failed += repo_failed
+        verified_ids = {id(image) for image in verified}
+        changed = [
+            image
+            for images in planned.values()
+            for image in images
+            if id(image) not in verified_ids
+        ]
+        return verified, changed, failed
+
+
+class ScanCheckpoint:
+    """Scan results of completed repositories, kept in a JSON lines file.
+
+    A result is appended as soon as a repository's scan completes, so an interrupted
+    scan resumes from the last completed repository. Results are read back one line at
+    a time and never held in memory together.
+
+    The first line records the policy and the day of the scan. A checkpoint of another
+    policy or day is discarded, since its results may no longer be right.
+    """
+
+    def __init__(self, path: str, policy: RetentionPolicy) -> None:
+        self.path = Path(path)
+        versions = "\n".join(sorted(policy.field_versions)).encode()
+        self.header = {
+            "keep_days": policy.keep_days,
+            "field_versions": hashlib.sha256(versions).hexdigest(),
+            "day": date.today().isoformat(),
+        }
+        self.completed = set()
+        valid_size = self._load()
+        if valid_size:
+            # Drop a line left incomplete by the interruption.
+            self._file = open(self.path, "r+")
+            self._file.truncate(valid_size)
+            self._file.seek(valid_size)
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, "w")
+            self._write(self.header)
+
+    def _load(self) -> int:
+        """Find the completed repositories. Returns the size of the valid part of the file."""
+        valid_size = 0
+        try:
+            with open(self.path) as f:
+                for number, line in enumerate(iter(f.readline, "")):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    if number == 0:
+                        if record != self.header:
+                            return 0
+                    else:
+                        self.completed.add(record["repo"])
+                    valid_size += len(line.encode())
+        except OSError:
+            return 0
+        return valid_size
+
+    def results(self):
+        """Yield the (<repository>, {<category>: [Image, ...]}) results of completed scans."""
+        with open(self.path) as f:
+            next(f)
+            for line in f:
+                record = json.loads(line)
+                categorized = {
+                    category: [Image.from_record(image) for image in record["images"][category]]
+                    for category in CATEGORIES
+                }
+                yield record["repo"], categorized
+
+    def record(self, repo: str, categorized: dict) -> None:
+        images = {
+            category: [image.to_record() for image in images]
+            for category, images in categorized.items()
+        }
+        self._write({"repo": repo, "images": images})
+        self.completed.add(repo)
+
+    def _write(self, record: dict) -> None:
+        self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self._file.flush()
+
+    def clear(self) -> None:
+        """Remove the checkpoint once its results are no longer needed."""
+        self._file.close()
+        self.path.unlink(missing_ok=True)
+
+
+class JsonlReport:
+    """A report of retained and deleted images, written a JSON line at a time."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.counts = {}
+        self._lock = threading.Lock()
+        self._file = open(path, "w")
+
+    def write(self, action: str, images, reason=None) -> None:
+        """Report images.
+
+        Args:
+            action (str): What happened to the images, e.g. "retained" or "deleted".
+            images: Image objects.
+            reason (optional): A reason for all images, or a function of an image.
+        """
+        lines = []
+        for image in images:
+            record = {
+                "action": action,
+                "repo": image.repo,
+                "tag": ",".join(image.tags),
+                "digest": image.digest,
+                "size": image.size,
+            }
+            if reason:
+                record["reason"] = reason(image) if callable(reason) else reason
+            lines.append(json.dumps(record, separators=(",", ":")) + "\n")
+        if not lines:
+            return
+        with self._lock:
+            self._file.writelines(lines)
+            self._file.flush()
+            self.counts[action] = self.counts.get(action, 0) + len(lines)
+
+    def close(self) -> None:
+        self._file.close()
+        summary = ", ".join(f"{count} {action}" for action, count in sorted(self.counts.items()))
+        print(f"Report written to {self.path}: {summary or 'no images'}")
+
+
+def get_deployed_containers() -> frozenset:
+    """The container versions deployed to robots in the field.
+
+    The versions come from DEPLOYED_VERSIONS_FILE if it is set, e.g. for local testing.
+    Otherwise they come from a snapshot no older than DEPLOYED_VERSIONS_TTL_HOURS, which
+    is refreshed from the database when it expires. A stale snapshot is never used, since
+    a version deployed since could be deleted.
+
+    Raises:
+        RuntimeError: The database query failed.
+    """
+    if DEPLOYED_VERSIONS_FILE:
+        with open(DEPLOYED_VERSIONS_FILE) as f:
+            versions = frozenset(line.strip() for line in f if line.strip())
+        print(f"Read {len(versions)} deployed versions from {DEPLOYED_VERSIONS_FILE}")
+        return versions
+
+    cache_path = Path(DEPLOYED_VERSIONS_CACHE)
+    try:
+        with open(cache_path) as f:
+            snapshot = json.load(f)
+        age_hours = (datetime.now().timestamp() - snapshot["fetched_at"]) / 3600
+        if 0 <= age_hours < DEPLOYED_VERSIONS_TTL_HOURS:
+            print(f"Using deployed versions from {cache_path}, {age_hours:.1f} hours old")
+            return frozenset(snapshot["versions"])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    versions = query_deployed_containers()
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"fetched_at": datetime.now().timestamp(), "versions": sorted(versions)}, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Deployed versions snapshot not saved: {e}")
+    return versions
+
+
+def query_deployed_containers() -> frozenset:
+    """Query the database for the container versions deployed in the field.
+
+    Raises:
+        RuntimeError: The database query failed.
+    """
+    # Imported here so that runs served by a snapshot or DEPLOYED_VERSIONS_FILE
+    # do not pay for the data API and its dependencies.
+    from psycopg2 import OperationalError
+
+    from dataapi.robots.oee import get_oee_config_permutations
+
+    try:
+        df = get_oee_config_permutations()
+    except OperationalError as e:
+        raise RuntimeError(e)
+    # get_oee_config_permutations() takes no filters, so sites are filtered here.
+    return frozenset(df.loc[~df.site.isin(NON_FIELD_SITES), "container_version"].unique())
+
+
+def gb_str_from_bytes(num_bytes: int) -> str:
+    return f"{num_bytes / (1024**3):.2f}"
+
+
+def group_by_repo(images) -> list:
+    """Group images by repository, keeping their order.
+
+    Returns:
+        list: (<repository>, [Image, ...]) tuples.
+    """
+    by_repo = {}
+    for image in images:
+        by_repo.setdefault(image.repo, []).append(image)
+    return list(by_repo.items())
+
+
+def has_repo_prefix(repo: str) -> bool:
+    return repo.startswith(tuple(REPO_PREFIXES))
+
+
+def matches_keep_pattern(tag: str) -> bool:
+    return KEEP_PATTERN.match(tag) is not None
+
+
+def tag_date(tag: str) -> datetime:
+    """The date embedded in a tag, e.g. rel-2024.05.01, as a naive local time, or None."""
+    match = DATE_PATTERN.match(tag)
+    if not match:
+        return None
+    try:
+        return datetime(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+    except ValueError:
+        # e.g. a day that does not exist in the month
+        return None
+
+
+def read_plan(path: str) -> dict:
+    """Read a deletion plan written by write_plan().
+
+    Returns:
+        dict: Repository -> [Image, ...], in plan order.
+    """
+    planned = {}
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            tags = record["tag"].split(",") if record["tag"] else []
+            image = Image(record["repo"], tags, record["digest"], record["size"])
+            planned.setdefault(image.repo, []).append(image)
+    return planned
+
+
+def write_plan(path: str, images, policy: RetentionPolicy) -> int:
+    """Write a deletion plan, a JSON line per image with its repository, tags, digest,
+    size and the reason it is deleted.
+
+    Returns:
+        int: The number of images in the plan.
+    """
+    count = 0
+    with open(path, "w") as f:
+        for image in images:
+            record = {
+                "repo": image.repo,
+                "tag": ",".join(image.tags),
+                "digest": image.digest,
+                "size": image.size,
+                "reason": policy.deletion_reason(image),
+            }
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+            count += 1
+    return count
+
+
+def report_retained(report: JsonlReport, repo: str, categorized: dict) -> None:
+    """Report the retained images of a repository along with the reason they were kept."""
+    for category in RETAINED:
+        report.write("retained", categorized[category], category)
+    num_retained = sum(len(categorized[category]) for category in RETAINED)
+    print(
+        f"Evaluated repository: {repo}: {num_retained} retained, "
+        f"{len(categorized[DELETABLE])} deletable"
+    )